@@ -15,7 +15,8 @@ from temboardagent.types import (
     T_SESSIONID,
     T_USERNAME,
 )
-from temboardagent.tools import validate_parameters
+from temboardagent.tools import Response, hash_etag, validate_parameters
+from temboardagent.instrumentation import REGISTRY
 from temboardagent.usermgmt import auth_user, gen_sessionid
 from temboardagent.notification import NotificationMgmt, Notification
 from temboardagent.inventory import SysInfo, PgInfo
@@ -33,11 +34,7 @@ def check_sessionid(http_header, sessions):
                         [('X-Session', T_SESSIONID, False)])
     try:
         xsession = http_header['X-Session'].encode('utf-8')
-        session = sessions.get_by_sessionid(xsession)
-        session.time = time.time()
-        username = session.username
-        sessions.update(session)
-        return username
+        return sessions.touch(xsession).username
     except SharedItem_not_found:
         raise HTTPError(401, "Invalid session.")
 
@@ -102,10 +99,7 @@ def logout(http_context, app, sessions):
         raise HTTPError(500, "Internal error.")
 
 
-@add_route('GET', b'/discover', check_session=False)
-def get_discover(http_context, app, sessions):
-    logger.info('Starting discovery.')
-
+def check_discover_key(http_context, app):
     # Optionnal validation of key. For compatibility, we accept unauthenticated
     # /discover. But for better reliability, we validate a key sent by HTTP
     # header. temboard-agent-register sends key to prevent configuration
@@ -114,6 +108,33 @@ def get_discover(http_context, app, sessions):
     if request_key and request_key != app.config.temboard['key']:
         raise HTTPError(401, "Invalid key")
 
+
+def discover_etag(http_context, app):
+    check_discover_key(http_context, app)
+    sysinfo = SysInfo()
+    try:
+        # Postgres informations change only on restart.
+        with app.postgres.connect() as conn:
+            pg_start = conn.query_scalar(
+                "SELECT pg_postmaster_start_time()::text")
+    except Exception as e:
+        logger.debug("Can't get Postgres start time: %s.", e)
+        pg_start = None
+    return hash_etag(
+        app.config.temboard['hostname'],
+        app.config.temboard['plugins'],
+        app.config.postgresql['port'],
+        sysinfo.n_cpu(),
+        sysinfo.memory_size(),
+        pg_start,
+    )
+
+
+@add_route('GET', b'/discover', check_session=False, etag=discover_etag)
+def get_discover(http_context, app, sessions):
+    logger.info('Starting discovery.')
+    check_discover_key(http_context, app)
+
     discover = dict(
         hostname=None,
         cpu=None,
@@ -181,7 +202,11 @@ def profile(http_context, app, sessions):
         raise HTTPError(401, "Invalid session.")
 
 
-@add_route('GET', b'/notifications', check_key=True)
+def notifications_etag(http_context, app):
+    return hash_etag(NotificationMgmt.get_last_change(app.config))
+
+
+@add_route('GET', b'/notifications', check_key=True, etag=notifications_etag)
 def notifications(http_context, app, sessions):
     logger.info("Get notifications.")
     try:
@@ -194,6 +219,13 @@ def notifications(http_context, app, sessions):
         raise HTTPError(500, "Internal error.")
 
 
+@add_route('GET', b'/metrics', check_key=True)
+def get_metrics(http_context, app, sessions):
+    # Prometheus text exposition format.
+    return Response(
+        REGISTRY.exposition(), content_type='text/plain; version=0.0.4')
+
+
 @add_route('GET', b'/status', check_session=False)
 def get_status(http_context, app, sessions):
     logger.info('Starting /status.')
@@ -52,6 +52,10 @@ class Application(BaseApplication):
             OptionSpec(s, 'user', default='postgres'),
             OptionSpec(s, 'password'),
             OptionSpec(s, 'dbname', default='postgres'),
+            OptionSpec(s, 'pool_size', default=4, validator=int),
+            OptionSpec(s, 'pool_max_total', default=10, validator=int),
+            OptionSpec(s, 'pool_max_idle', default=60, validator=int),
+            OptionSpec(s, 'pool_max_lifetime', default=3600, validator=int),
         )
 
         return specs
@@ -64,8 +68,12 @@ class Application(BaseApplication):
             if name.startswith('postgresql_'):
                 yield spec
 
+    # Pool of Postgres connections, set by HTTP process.
+    postgres_pool = None
+
     def apply_config(self):
-        self.postgres = Postgres(app=self, **self.config.postgresql)
+        self.postgres = Postgres(
+            app=self, pool=self.postgres_pool, **self.config.postgresql)
         return super().apply_config()
 
     def check_compatibility(self, pg_version):
@@ -0,0 +1,132 @@
+# Cache of database sizes.
+#
+# pg_database_size() stats every file of a database, which is very expensive
+# on clusters with millions of relation files. Sizes are stored in dbsize.db
+# SQLite database, shared by processes, and computed again only when older
+# than max_age seconds. Each call computes stale sizes, oldest first, until
+# budget seconds are spent, and returns cached sizes of other databases. The
+# remaining budget is applied as statement_timeout of each size query, so a
+# single huge database can't block the caller. A size failing to compute is
+# retried after max_age, keeping its previous value. Until an exact size is
+# known, the estimated size is reported, if budget allows to compute it.
+#
+# The estimate method sums pg_class.relpages of each database instead,
+# without walking files. relpages is updated by VACUUM, ANALYZE and CREATE
+# INDEX.
+
+import logging
+import os
+import time
+from textwrap import dedent
+
+from . import storage
+from .postgres import statement_timeout
+
+
+logger = logging.getLogger(__name__)
+
+METHODS = {
+    'exact': "SELECT pg_database_size(%s) AS size",
+    'estimate': dedent("""\
+    SELECT COALESCE(SUM(relpages), 0)::bigint
+           * current_setting('block_size')::bigint AS size
+    FROM pg_class
+    """),
+}
+
+
+def method(raw):
+    # Validator of size computation method.
+    if raw not in METHODS:
+        raise ValueError(
+            "Unknown size method %s, must be one of %s."
+            % (raw, ', '.join(sorted(METHODS))))
+    return raw
+
+
+def bootstrap(home):
+    with storage.transaction(os.path.join(home, 'dbsize.db')) as conn:
+        conn.execute(dedent("""
+            CREATE TABLE IF NOT EXISTS sizes (
+                method TEXT,
+                dbname TEXT,
+                time REAL,
+                size INTEGER,
+                PRIMARY KEY (method, dbname)
+            )
+        """))
+
+
+class SizeCache:
+    """Sizes of databases in bytes, computed at most every max_age
+    seconds."""
+
+    def __init__(self, home, max_age=300, budget=1., method='exact'):
+        self.home = home
+        self.path = os.path.join(home, 'dbsize.db')
+        self.max_age = max_age
+        self.budget = budget
+        self.method = method
+
+    def sizes(self, conn, postgres, dbnames):
+        """Returns size of dbnames by database name.
+
+        conn computes exact sizes. Estimation connects to each database with
+        postgres. At least one stale size is tried per call. Databases
+        without exact size yet fall back to estimation. Size is None if
+        neither is known.
+        """
+        cached = dict(
+            (dbname, (time_, size))
+            for dbname, time_, size in storage.connect(self.path).execute(
+                "SELECT dbname, time, size FROM sizes WHERE method = ?",
+                (self.method,))
+        )
+        start = time.time()
+        stale = sorted(
+            (cached.get(dbname, (0, None))[0], dbname)
+            for dbname in dbnames
+            if start - cached.get(dbname, (0, None))[0] > self.max_age
+        )
+
+        computed = []
+        for i, (_, dbname) in enumerate(stale):
+            remaining = self.budget - (time.time() - start)
+            if i and remaining <= 0:
+                logger.debug(
+                    "Size computation budget spent, %d sizes left stale.",
+                    len(stale) - i)
+                break
+            try:
+                size = self.compute(conn, postgres, dbname, remaining)
+            except Exception as e:
+                logger.error(
+                    "Failed to compute size of database %s: %s", dbname, e)
+                # Retry after max_age, don't starve other databases.
+                size = cached.get(dbname, (0, None))[1]
+            cached[dbname] = (time.time(), size)
+            computed.append((self.method, dbname) + cached[dbname])
+
+        if computed:
+            with storage.transaction(self.path) as db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?)",
+                    computed)
+
+        sizes = dict(
+            (dbname, cached.get(dbname, (0, None))[1]) for dbname in dbnames)
+        missing = [dbname for dbname in dbnames if sizes[dbname] is None]
+        remaining = self.budget - (time.time() - start)
+        if missing and self.method == 'exact' and remaining > 0:
+            fallback = SizeCache(
+                self.home, self.max_age, remaining, method='estimate')
+            sizes.update(fallback.sizes(conn, postgres, missing))
+        return sizes
+
+    def compute(self, conn, postgres, dbname, timeout):
+        if self.method == 'exact':
+            with statement_timeout(conn, timeout):
+                return conn.query_scalar(METHODS['exact'], (dbname,))
+        with postgres.copy(dbname=dbname).connect() as dbconn:
+            with statement_timeout(dbconn, timeout):
+                return dbconn.query_scalar(METHODS['estimate'])
@@ -9,10 +9,11 @@ class ConfigurationError(UserError):
 
 class HTTPError(Exception):
     """ HTTP server errors """
-    def __init__(self, code, message):
+    def __init__(self, code, message, headers=None):
         Exception.__init__(self, message)
         self.code = code
         self.message = {'error': str(message)}
+        self.headers = headers or dict()
 
 
 class SharedItem_not_found(Exception):
@@ -1,35 +1,373 @@
+import itertools
 import logging
 import time
 
 import json
+import queue
+import selectors
+import socket
 import sys
+import threading
+import zlib
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from socket import error as SocketError
-from socketserver import ThreadingMixIn
-from urllib.parse import urlparse, parse_qs, unquote_plus
+from socket import error as SocketError, timeout as SocketTimeout
+from urllib.parse import urlparse, parse_qs
 import ssl
 
-from temboardagent.routing import get_routes
+from temboardagent.routing import resolve_route
 from temboardagent.errors import HTTPError
-from temboardagent.tools import JSONEncoder
+from temboardagent.tools import Response, iterencode_json
 from temboardagent import __version__ as temboard_version
 from .sharedmemory import Sessions
 from .api import check_sessionid
-from .errors import UserError
+from .errors import NotificationError, UserError
+from .instrumentation import Counter, Gauge, Histogram
+from .notification import NotificationMgmt, Notification
+from .postgres import Pool
 from .toolkit.services import Service
 
 
 logger = logging.getLogger(__name__)
+# Seconds of inactivity before a session expires.
+SESSION_TTL = 3600
+
+HTTP_REQUESTS = Counter(
+    'temboard_http_requests_total', "HTTP requests handled.",
+    labels=('handler', 'method', 'status'))
+HTTP_DURATION = Histogram(
+    'temboard_http_request_duration_seconds',
+    "Time to process HTTP request until response headers are sent.",
+    labels=('handler',))
+HTTP_BYTES = Counter(
+    'temboard_http_response_bytes_total', "Bytes of HTTP response bodies.",
+    labels=('handler',))
+HTTP_QUEUE_DEPTH = Gauge(
+    'temboard_http_queue_depth',
+    "Connections with a pending request waiting for an HTTP worker.")
+HTTP_QUEUE_WAIT = Histogram(
+    'temboard_http_queue_wait_seconds',
+    "Time spent by a connection with a pending request waiting for an HTTP "
+    "worker.")
+HTTP_IDLE_CONNECTIONS = Gauge(
+    'temboard_http_idle_connections',
+    "Idle persistent HTTP connections, waiting for next request.")
+
+
+class ThreadPoolMixIn:
+    # Serve connections from a fixed set of worker threads, fed by a bounded
+    # queue of connections with a pending request. Connections are rejected
+    # when the queue is full rather than spawning an unbounded number of
+    # threads.
+    #
+    # Idle connections don't hold a worker: new connections, and persistent
+    # connections once a request is served, are parked in a selector watched
+    # by a single thread, until a request arrives or idle_timeout expires.
+
+    def start_workers(self, workers, queue_size, idle_timeout=30):
+        self.requests = queue.Queue(queue_size)
+        # Seconds to wait for the first request of a new connection.
+        self.idle_timeout = idle_timeout
+        # Per worker thread state, like time spent by connection in queue.
+        self.local = threading.local()
+        # Lazily created semaphores for routes with concurrency limit.
+        self.semaphores = dict()
+        self.semaphores_lock = threading.Lock()
+        # Connections to park, registered by the selector thread itself.
+        self.parking = queue.SimpleQueue()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        thread = threading.Thread(target=self.watch_idle, name='http-idle')
+        thread.daemon = True
+        thread.start()
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self.process_queue, name='http-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        # Wait for client to send something before using a worker.
+        self.park(request, client_address, None)
+
+    def dispatch(self, request, client_address, handler=None):
+        # Queue connection with a pending request. handler is the request
+        # handler of a parked connection.
+        try:
+            self.requests.put_nowait(
+                (request, client_address, time.time(), handler))
+        except queue.Full:
+            logger.warning(
+                "HTTP queue is full. Rejecting connection from %s.",
+                client_address[0])
+            self.drop_request(request, handler)
+        HTTP_QUEUE_DEPTH.set(self.queue_depth())
+
+    def process_queue(self):
+        while True:
+            request, client_address, queued_at, handler = self.requests.get()
+            HTTP_QUEUE_DEPTH.set(self.queue_depth())
+            wait = time.time() - queued_at
+            HTTP_QUEUE_WAIT.observe(wait)
+            # Reported by the first request only.
+            self.local.queue_wait = 1000. * wait
+            try:
+                if handler is None:
+                    handler = self.RequestHandlerClass(
+                        request, client_address, self)
+                else:
+                    handler.resume()
+            except Exception:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+                continue
+
+            if handler.parked:
+                self.park(request, client_address, handler)
+            elif not handler.detached:
+                self.shutdown_request(request)
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def park(self, request, client_address, handler):
+        # handler is None for new connections.
+        timeout = handler.timeout if handler else self.idle_timeout
+        self.parking.put(
+            (request, client_address, handler, time.time() + timeout))
+        self.wakeup_w.send(b'\0')
+
+    def drop_request(self, request, handler=None):
+        if handler is not None:
+            handler.parked = False
+            try:
+                handler.finish()
+            except Exception as e:
+                logger.debug("Failed to close connection: %s.", e)
+        self.shutdown_request(request)
+
+    def watch_idle(self):
+        # Wait for next request on parked connections, and close those idle
+        # for more than their timeout.
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup_r, selectors.EVENT_READ)
+        while True:
+            try:
+                self.watch_idle1(selector)
+            except Exception:
+                logger.exception("Failed to watch idle HTTP connections.")
+                time.sleep(1)
+
+    def watch_idle1(self, selector):
+        for key, _ in selector.select(timeout=1):
+            if key.fileobj is self.wakeup_r:
+                try:
+                    self.wakeup_r.recv(4096)
+                except BlockingIOError:
+                    pass
+                continue
+            selector.unregister(key.fileobj)
+            client_address, handler, _ = key.data
+            self.dispatch(key.fileobj, client_address, handler)
+
+        while True:
+            try:
+                request, client_address, handler, deadline = (
+                    self.parking.get_nowait())
+            except queue.Empty:
+                break
+            try:
+                selector.register(
+                    request, selectors.EVENT_READ,
+                    (client_address, handler, deadline))
+            except (OSError, ValueError):
+                # Connection closed meanwhile.
+                self.drop_request(request, handler)
+
+        now = time.time()
+        for key in list(selector.get_map().values()):
+            if key.fileobj is self.wakeup_r:
+                continue
+            _, handler, deadline = key.data
+            if now > deadline:
+                selector.unregister(key.fileobj)
+                self.drop_request(key.fileobj, handler)
+        HTTP_IDLE_CONNECTIONS.set(len(selector.get_map()) - 1)
+
+    def route_semaphore(self, route, limit):
+        key = route['module'], route['function'], limit
+        with self.semaphores_lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(limit)
+            return self.semaphores[key]
+
+
+class DetachedConnection:
+    # Connection of a response continued by another thread, after request
+    # handler is done. Writes never block: data the client can't receive yet
+    # is buffered and sent by next write or flush. A TLS record partially
+    # sent is completed the same way.
+
+    def __init__(self, sock, client_address, max_buffer=1024 * 1024):
+        self.sock = sock
+        self.client_address = client_address
+        self.sock.setblocking(False)
+        # Bytes not sent yet, bounded to max_buffer.
+        self.buffer = b''
+        self.max_buffer = max_buffer
+
+    def write(self, data):
+        # Raises OSError if client is gone or lags too far behind.
+        self.buffer += data
+        self.flush()
+        if len(self.buffer) > self.max_buffer:
+            raise OSError("Client is too slow to receive data.")
+
+    def flush(self):
+        while self.buffer:
+            try:
+                sent = self.sock.send(self.buffer)
+            except (BlockingIOError, ssl.SSLWantReadError,
+                    ssl.SSLWantWriteError):
+                return
+            self.buffer = self.buffer[sent:]
 
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ThreadedHTTPServer(ThreadPoolMixIn, HTTPServer):
+    """ Handle requests in a pool of threads. """
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """ Handle requests in a separate thread. """
+    def handle_error(self, request, client_address):
+        # TLS handshake failures and client disconnections end up here.
+        logger.debug(
+            "Connection with %s aborted.", client_address[0], exc_info=True)
+
+
+def create_ssl_context(certfile, keyfile):
+    # Build the server TLS context once for all connections. Sharing the
+    # context shares OpenSSL session cache, and session tickets, enabled by
+    # default, let clients resume sessions with an abbreviated handshake
+    # when reconnecting.
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    return context
+
+
+# Supported content codings, with zlib window bits producing their format.
+ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def negotiate_encoding(accept_encoding):
+    # Returns the preferred supported content coding accepted by the client
+    # according to Accept-Encoding header value, or None for identity.
+    accepted = dict()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        accepted[coding] = quality
+
+    best, best_quality = None, 0.
+    for coding in ENCODINGS:
+        quality = accepted.get(coding, accepted.get('*', 0.))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress_chunks(chunks, encoding, level):
+    # Compress an iterable of bytes chunks, yielding compressed chunks.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def match_etag(if_none_match, etag):
+    # Weak comparison of etag with If-None-Match header value, ignoring
+    # content coding suffix. Returns the matching tag, or None.
+    if not if_none_match or not etag:
+        return None
+    for raw in if_none_match.split(','):
+        raw = raw.strip()
+        if raw == '*':
+            return '"%s"' % etag
+        tag = raw[2:] if raw.startswith('W/') else raw
+        tag = tag.strip('"')
+        for coding in ENCODINGS:
+            if tag.endswith('-' + coding):
+                tag = tag[:-len(coding) - 1]
+                break
+        if tag == etag:
+            return raw
+    return None
+
+
+def route_name(route):
+    # Short name of route handler, like activity.get_activity.
+    return '%s.%s' % (route['module'].rpartition('.')[2], route['function'])
+
+
+def iter_body_chunks(message):
+    # Yields bytes chunks of response body.
+    if not isinstance(message, Response):
+        yield from iter_json_chunks(message)
+        return
+
+    body = message.body
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if isinstance(body, bytes):
+        yield body
+    else:
+        yield from body
+
+
+def iter_json_chunks(message, chunk_size=16384):
+    # Serialize message to JSON, yielding UTF-8 chunks of about chunk_size
+    # bytes.
+    buf = []
+    size = 0
+    for fragment in iterencode_json(message):
+        buf.append(fragment)
+        size += len(fragment)
+        if size >= chunk_size:
+            yield ''.join(buf).encode('utf-8')
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf).encode('utf-8')
 
 
 class RequestHandler(BaseHTTPRequestHandler):
     """
     HTTP request handler.
     """
+    # Enable persistent connections. Every response must be framed with a
+    # Content-Length header or chunked transfer encoding.
+    protocol_version = 'HTTP/1.1'
+    # Seconds allowed to complete TLS handshake, deferred from accept.
+    handshake_timeout = 5
+
     def __init__(self, app, sessions, *args, **kwargs):
         """
         Constructor.
@@ -46,6 +384,14 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.query = None
         # HTTP POST content in json format.
         self.post_json = None
+        # Idle timeout of persistent connections, applied on socket.
+        self.timeout = app.config.temboard.keepalive_timeout
+        # Number of requests handled on this connection.
+        self.requests_count = 0
+        # Whether connection is idle, waiting in server selector.
+        self.parked = False
+        # Whether connection is handed over to a response detach callback.
+        self.detached = False
         # Call HTTP request handler constructor.
         BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
 
@@ -68,8 +414,8 @@ class RequestHandler(BaseHTTPRequestHandler):
         Handle HTTP PUT requests.
         """
         self.http_method = 'PUT'
-        # Nothing to do for now.
-        pass
+        # Nothing to do for now. Close connection as no response is sent.
+        self.close_connection = True
 
     def do_DELETE(self,):
         """
@@ -86,8 +432,9 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Headers',
                          "X-Requested-With, X-Session, Content-Type")
         self.send_header('Access-Control-Max-Age', '1728000')
+        self.send_header('Content-Length', '0')
         self.end_headers()
-        logger.info(self.headers.dict['origin'])
+        logger.info(self.headers.get('Origin'))
 
     def log_message(self, format, *args):
         """
@@ -96,14 +443,83 @@ class RequestHandler(BaseHTTPRequestHandler):
         logger.info("client: %s request: %s"
                     % (self.address_string(), format % args))
 
+    def setup(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.settimeout(self.handshake_timeout)
+            self.request.do_handshake()
+        BaseHTTPRequestHandler.setup(self)
+
+    def handle(self):
+        # Serve requests already received on this connection. Then park
+        # idle persistent connection instead of blocking the worker until
+        # next request.
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.pending():
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def resume(self):
+        # Serve next request of a parked connection.
+        self.parked = False
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def finish(self):
+        if self.parked:
+            # Keep buffered streams of parked connection.
+            return
+        BaseHTTPRequestHandler.finish(self)
+
+    def pending(self):
+        # Whether next request is already buffered or received, without
+        # blocking.
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
     def handle_one_request(self, *a, **kw):
         self.log_data = dict(
             url='unknown',
             handler='unknown',
         )
         self.start_time = time.time()
+        self.requests_count += 1
+        # Reset request state, the handler lives as long as the connection.
+        self.http_method = None
+        self.query = None
+        self.post_json = None
+        self.body_consumed = False
+        # Concurrency semaphore of the route, held until response is sent.
+        self.semaphore = None
+        # Entity tag of the response, if route computes one.
+        self.etag = None
+        # Whether response body may be compressed.
+        self.compress = True
+        # Callback continuing response body out of worker.
+        self.detach = None
+        # Time spent in server queue, in milliseconds. Reset for next
+        # requests served by the same worker without queuing.
+        self.queue_wait = getattr(self.server.local, 'queue_wait', 0.)
+        self.server.local.queue_wait = 0.
         return BaseHTTPRequestHandler.handle_one_request(self, *a, **kw)
 
+    def end_headers(self):
+        # Recycle connection after too many requests.
+        max_requests = self.app.config.temboard.keepalive_max_requests
+        recycle = self.requests_count >= max_requests
+        if recycle and not self.close_connection:
+            self.send_header('Connection', 'close')
+        BaseHTTPRequestHandler.end_headers(self)
+
     def request_time(self):
         return 1000. * (time.time() - self.start_time)
 
@@ -116,15 +532,19 @@ class RequestHandler(BaseHTTPRequestHandler):
         response_time = self.request_time()
         if hasattr(code, 'value'):
             code = code.value
+        HTTP_REQUESTS.inc(
+            self.log_data['handler'], self.http_method, str(code))
+        HTTP_DURATION.observe(response_time / 1000., self.log_data['handler'])
         self.log_message(
             '"%s" %s %s %.2fms',
             self.requestline, str(code), str(size), response_time,
         )
         logger.debug(
             "method=%s url=%s status=%s handler=%s"
-            " response_time=%s service=web",
+            " response_time=%s queue_wait=%.2f queue_depth=%s service=web",
             self.http_method, self.log_data['url'], code,
             self.log_data['handler'], response_time,
+            self.queue_wait, self.server.queue_depth(),
         )
 
     def response(self):
@@ -132,81 +552,226 @@ class RequestHandler(BaseHTTPRequestHandler):
         In charge to call the main routing function and to return its results
         as a valid HTTP response.
         """
+        headers = dict()
         try:
             (code, message) = self.route_request()
+            # Serialize the first chunks before sending headers, so that
+            # errors raised by lazy results are still reported with a proper
+            # HTTP status.
+            self.content_type = getattr(
+                message, 'content_type', 'application/json')
+            headers = dict(getattr(message, 'headers', {}))
+            self.compress = getattr(message, 'compress', True)
+            self.detach = getattr(message, 'detach', None)
+            chunks = iter_body_chunks(message)
+            head = list(itertools.islice(chunks, 2))
         except HTTPError as e:
             logger.exception(e.message)
             logger.error(e.message)
             code = e.code
             message = e.message
+            headers = e.headers
+            chunks = None
         except UserError as e:
             msg = str(e)
             logger.exception(msg)
             logger.error(msg)
             code = 500
             message = {'error': msg}
+            chunks = None
         except Exception as e:
             logger.exception(str(e))
             logger.error("Internal error")
             # This is an unknown error. Just inform there is an internal error.
             code = 500
             message = {'error': "Internal error."}
+            chunks = None
+
+        if code == 304:
+            self.send_not_modified(etag=message)
+            return
+
+        if chunks is None:
+            self.content_type = 'application/json'
+            self.compress = True
+            self.detach = None
+            chunks = iter_json_chunks(message)
+            head = list(itertools.islice(chunks, 2))
+
+        try:
+            if self.detach:
+                self.send_detached(int(code), headers, head, chunks)
+            else:
+                self.send_body(int(code), headers, head, chunks)
+        finally:
+            self.release_route()
+
+    def send_not_modified(self, etag):
+        try:
+            self.send_response(304)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Vary', 'Accept-Encoding')
+            # Echo the tag of the variant client has.
+            self.send_header('ETag', etag)
+            self.end_headers()
+        except Exception as e:
+            logger.exception(str(e))
+            logger.error("Could not send response")
+            self.close_connection = True
+
+    def send_body(self, code, headers, head, chunks):
+        # Send response with body from head, a list of at most two chunks, and
+        # remaining chunks. A body of a single chunk is sent with a
+        # Content-Length. Longer body is streamed with chunked transfer
+        # encoding.
+        config = self.app.config.temboard
+        streamed = len(head) > 1
+        encoding = None
+        large = streamed or len(b''.join(head)) >= config.compression_min_size
+        if self.compress and large:
+            encoding = negotiate_encoding(
+                self.headers.get('Accept-Encoding', ''))
+        body = itertools.chain(head, chunks)
+        if encoding:
+            body = compress_chunks(body, encoding, config.compression_level)
+        if not streamed:
+            body = [b''.join(body)]
 
         try:
             # Try to send the response
-            self.send_response(int(code))
+            self.send_response(code)
             self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-type', self.content_type)
+            self.send_header('Vary', 'Accept-Encoding')
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            if self.etag and code == 200:
+                # Each encoding is a distinct representation.
+                suffix = '-' + encoding if encoding else ''
+                self.send_header('ETag', '"%s%s"' % (self.etag, suffix))
+            chunked = streamed and self.request_version != 'HTTP/1.0'
+            if chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+            elif streamed:
+                # HTTP/1.0 client does not support chunks. End body by
+                # closing connection.
+                self.close_connection = True
+            else:
+                self.send_header('Content-Length', str(len(body[0])))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            has_body = (
+                self.headers.get('Content-Length', '0') != '0' or
+                'Transfer-Encoding' in self.headers
+            )
+            if has_body and not self.body_consumed:
+                # Unread request body would be parsed as the next request.
+                self.send_header('Connection', 'close')
             self.end_headers()
-            self.wfile.write(json.dumps(message, cls=JSONEncoder)
-                             .encode('utf-8'))
+            size = 0
+            for data in body:
+                if not data:
+                    continue
+                size += len(data)
+                if chunked:
+                    data = b'%x\r\n%s\r\n' % (len(data), data)
+                self.wfile.write(data)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+            HTTP_BYTES.inc(self.log_data['handler'], amount=size)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client closed the connection, e.g. leaving an event stream.
+            logger.debug("Client disconnected while sending response.")
+            self.close_connection = True
         except Exception as e:
             logger.exception(str(e))
             logger.error("Could not send response")
+            # Client can't tell an aborted stream from a complete one unless
+            # the connection is closed without last chunk.
+            self.close_connection = True
+        finally:
+            chunks.close()
+
+    def send_detached(self, code, headers, head, chunks):
+        # Send response headers and body, then hand the connection over to
+        # detach callback. Body is delimited by closing the connection.
+        try:
+            self.send_response(code)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Content-type', self.content_type)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            size = 0
+            for data in itertools.chain(head, chunks):
+                size += len(data)
+                self.wfile.write(data)
+            HTTP_BYTES.inc(self.log_data['handler'], amount=size)
+            self.detach(DetachedConnection(
+                self.connection, self.client_address))
+            self.detached = True
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug("Client disconnected while sending response.")
+        except Exception as e:
+            logger.exception(str(e))
+            logger.error("Could not send response")
+        finally:
+            chunks.close()
 
-    def get_route(self, method, path):
-        # Returns the right route according to method/path
-        s_path = path.split(b'/')[1:]
-        root = s_path[0]
-        for route in get_routes():
-            # Check that HTTP method and url root are matching.
-            if not (route['http_method'] == self.http_method and
-                    route['root'] == root):
-                continue
+    def release_route(self):
+        if self.semaphore:
+            self.semaphore.release()
+            self.semaphore = None
 
-            p = 0
-            # Check each element in the path.
-            for elt in s_path:
-                try:
-                    if type(route['splitpath'][p]) not in (str, bytes):
-                        # Then this is a regular expression.
-                        res = route['splitpath'][p].match(elt.decode('utf-8'))
-                        if not res:
-                            break
-                    else:
-                        if route['splitpath'][p] != elt:
-                            break
-                except IndexError:
-                    break
-                p += 1
-            if p == len(s_path) == len(route['splitpath']):
-                return route
-        raise HTTPError(404, 'URL not found.')
-
-    def parse_path(self, path, route):
-        # Parse an URL path when route's path contains regepx
-        p = 0
-        urlvars = list()
-        for elt in path.split(b'/')[1:]:
-            if type(route['splitpath'][p]) not in (str, bytes):
-                # Then this is a regular expression.
-                res = route['splitpath'][p].match(elt.decode('utf-8'))
-                if res is not None:
-                    # If the regexp matches, we want to get the
-                    # value and append it in urlvars.
-                    urlvars.append(unquote_plus(res.group(1)))
-            p += 1
-        return urlvars
+    def get_route(self, method, path):
+        # Returns the right route and URL variables according to method/path
+        route, urlvars = resolve_route(method, path)
+        if route is None:
+            raise HTTPError(404, 'URL not found.')
+        return route, urlvars
+
+    def read_body(self):
+        # Read request body in chunks, bounded in size and time.
+        config = self.app.config.temboard
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            raise HTTPError(411, "Chunked request body not supported.")
+        if 'Content-Length' not in self.headers:
+            raise HTTPError(411, "Missing Content-Length.")
+        try:
+            length = int(self.headers['Content-Length'])
+            if length < 0:
+                raise ValueError()
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length.")
+        if length > config.http_max_body_size:
+            # Don't read the body, connection will be closed.
+            raise HTTPError(413, "Request body too large.")
+
+        deadline = time.time() + config.http_body_timeout
+        chunks = []
+        try:
+            while length > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SocketTimeout()
+                self.connection.settimeout(remaining)
+                chunk = self.rfile.read1(min(length, 65536))
+                if not chunk:
+                    raise HTTPError(400, 'Unable to read post data')
+                chunks.append(chunk)
+                length -= len(chunk)
+        except SocketTimeout:
+            logger.error("Timeout reading post data.")
+            raise HTTPError(408, "Timeout reading post data.")
+        except OSError as e:
+            logger.exception(str(e))
+            logger.error('Unable to read post data')
+            raise HTTPError(400, 'Unable to read post data')
+        finally:
+            self.connection.settimeout(self.timeout)
+        self.body_consumed = True
+        return b''.join(chunks)
 
     def route_request(self,):
         """
@@ -221,22 +786,8 @@ class RequestHandler(BaseHTTPRequestHandler):
             raise HTTPError(404, 'Not found.')
         self.query = parse_qs(up.query)
 
-        # Get the route
-        route = self.get_route(self.http_method, path.encode('utf-8'))
-        # Parse URL path
-        urlvars = self.parse_path(path.encode('utf-8'), route)
-        post_raw = None
-        # Load POST content if any
-        if self.http_method == 'POST':
-            # TODO: raise an HTTP error if the content-length is
-            # too large.
-            try:
-                post_raw = self.rfile.read(int(self.headers['Content-Length']))
-            except Exception as e:
-                logger.exception(str(e))
-                logger.debug(self.headers)
-                logger.error('Unable to read post data')
-                raise HTTPError(400, 'Unable to read post data')
+        # Get the route and parse URL path
+        route, urlvars = self.get_route(self.http_method, path.encode('utf-8'))
 
         username = None
         checked = False
@@ -272,9 +823,12 @@ class RequestHandler(BaseHTTPRequestHandler):
             raise HTTPError(401, "Missing key")
 
         try:
-            # Load POST content expecting it is in JSON format.
+            # Load POST content expecting it is in JSON format. Body is read
+            # only once request is authenticated.
             if self.http_method == 'POST':
-                self.post_json = json.loads(post_raw.decode('utf-8'))
+                self.post_json = json.loads(self.read_body())
+        except HTTPError:
+            raise
         except Exception as e:
             logger.exception(str(e))
             logger.error('Invalid json format')
@@ -291,6 +845,21 @@ class RequestHandler(BaseHTTPRequestHandler):
         # Handle the request
         func = getattr(sys.modules[route['module']], route['function'])
         self.log_data['handler'] = route['module'] + '.' + route['function']
+        if route['etag'] and self.http_method == 'GET':
+            self.etag = route['etag'](http_context, self.app)
+            matched = match_etag(self.headers.get('If-None-Match'), self.etag)
+            if matched:
+                return (304, matched)
+        limit = self.app.config.temboard.http_route_concurrency.get(
+            route_name(route), route['concurrency'])
+        if limit:
+            semaphore = self.server.route_semaphore(route, limit)
+            if not semaphore.acquire(blocking=False):
+                raise HTTPError(
+                    503, "Too many concurrent requests.",
+                    headers={'Retry-After': '1'})
+            # Released once response is sent, as results may be lazy.
+            self.semaphore = semaphore
         if route['module'] == 'temboardagent.api':
             # some core APIs need to deal with sessions
             return (200, func(http_context, self.app, self.sessions))
@@ -301,7 +870,19 @@ class RequestHandler(BaseHTTPRequestHandler):
 
 class HTTPDService(Service):
     def setup(self):
+        # Reuse Postgres connections across requests of HTTP process.
+        config = self.app.config.postgresql
+        self.app.postgres_pool = self.app.postgres.pool = Pool(
+            max_size=config.pool_size,
+            max_total=config.pool_max_total,
+            max_idle=config.pool_max_idle,
+            max_lifetime=config.pool_max_lifetime,
+        )
         self.sessions = Sessions(size=100)
+        thread = threading.Thread(
+            target=self.expire_sessions, name='session-expiry')
+        thread.daemon = True
+        thread.start()
         try:
             self.httpd = ThreadedHTTPServer(
                 (self.app.config.temboard.address,
@@ -309,17 +890,26 @@ class HTTPDService(Service):
                 self.handle_request)
         except SocketError as e:
             raise UserError("Failed to start HTTPS server: {}.".format(e))
+        self.httpd.start_workers(
+            workers=self.app.config.temboard.http_workers,
+            queue_size=self.app.config.temboard.http_queue_size,
+            idle_timeout=self.app.config.temboard.keepalive_timeout,
+        )
         try:
             logger.debug(
                 "Using SSL key %s.", self.app.config.temboard.ssl_key_file)
             logger.debug(
                 "Using SSL certificate %s.",
                 self.app.config.temboard.ssl_cert_file)
-            self.httpd.socket = ssl.wrap_socket(
-                self.httpd.socket,
-                keyfile=self.app.config.temboard.ssl_key_file,
+            self.ssl_context = create_ssl_context(
                 certfile=self.app.config.temboard.ssl_cert_file,
+                keyfile=self.app.config.temboard.ssl_key_file,
+            )
+            # Defer TLS handshake to request thread, out of the accept loop.
+            self.httpd.socket = self.ssl_context.wrap_socket(
+                self.httpd.socket,
                 server_side=True,
+                do_handshake_on_connect=False,
             )
         except Exception as e:
             raise UserError("Failed to setup SSL: {}.".format(e))
@@ -327,7 +917,38 @@ class HTTPDService(Service):
 
     def serve1(self):
         self.httpd.handle_request()
-        self.sessions.purge_expired(3600, logger, self.app.config)
+        self.app.postgres_pool.reap()
+
+    def expire_sessions(self):
+        # Remove expired sessions in background, sleeping until next possible
+        # expiry.
+        while True:
+            self.sessions.added.clear()
+            try:
+                expired, next_expiry = self.sessions.pop_expired(SESSION_TTL)
+                self.notify_expired(expired)
+            except Exception:
+                logger.exception("Failed to expire sessions.")
+                next_expiry = time.time() + 60
+            if next_expiry is None:
+                timeout = None
+            else:
+                timeout = max(0, next_expiry - time.time())
+            self.sessions.added.wait(timeout)
+
+    def notify_expired(self, sessions):
+        if not sessions:
+            return
+        notifications = []
+        for session in sessions:
+            logger.info(
+                "Session with sessionid=%s expired.", session.sessionid)
+            notifications.append(Notification(
+                username=session.username, message="Session expired"))
+        try:
+            NotificationMgmt.push_many(self.app.config, notifications)
+        except NotificationError as e:
+            logger.error(e.message)
 
     def handle_request(self, *args):
         return RequestHandler(self.app, self.sessions, *args)
@@ -0,0 +1,225 @@
+# Self-instrumentation of the agent.
+#
+# Metrics values live in a table of slots in shared memory, allocated at import
+# time before any process is forked. Thus the HTTP process can expose values
+# updated by worker processes. Each series, a metric name and label values,
+# owns one slot, or one slot per bucket plus sum for histograms.
+#
+# Processes cache the slot of each series. Updating a value costs a dict
+# lookup, a lock acquisition and a float addition.
+
+import logging
+from bisect import bisect_left
+from ctypes import c_char, c_double, c_int
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+
+logger = logging.getLogger(__name__)
+
+# Maximum length of series key, e.g. name{label="value"}.
+KEY_SIZE = 192
+# Default buckets of duration histograms, in seconds.
+DURATION_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.,
+)
+
+
+class Registry:
+    def __init__(self, size=2048):
+        self.lock = Lock()
+        self.size = size
+        self.values = RawArray(c_double, size)
+        # Series key of first slot of each series.
+        self.keys = RawArray(c_char * KEY_SIZE, size)
+        # Number of slots of each series.
+        self.widths = RawArray(c_int, size)
+        self.used = RawValue(c_int, 0)
+        # Metrics defined in this process, by name.
+        self.metrics = dict()
+        # Local cache of slot by series key.
+        self.slots = dict()
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric %s already registered." % metric.name)
+        self.metrics[metric.name] = metric
+
+    def slot(self, key, width=1):
+        # Returns the first slot of series key, allocating it if needed.
+        # Returns None if registry is full.
+        try:
+            return self.slots[key]
+        except KeyError:
+            pass
+
+        bkey = key.encode('utf-8')[:KEY_SIZE]
+        with self.lock:
+            # Search for a series allocated by another process.
+            i = 0
+            while i < self.used.value:
+                if self.keys[i].value == bkey:
+                    break
+                i += max(1, self.widths[i])
+            else:
+                if self.used.value + width > self.size:
+                    logger.warning(
+                        "Metrics registry full. Dropping %s.", key)
+                    i = None
+                else:
+                    self.keys[i].value = bkey
+                    self.widths[i] = width
+                    self.used.value += width
+        return self.slots.setdefault(key, i)
+
+    def add(self, slot, amount):
+        with self.lock:
+            self.values[slot] += amount
+
+    def set(self, slot, value):
+        self.values[slot] = value
+
+    def iter_series(self):
+        # Returns (key, values) of all allocated series.
+        series = []
+        with self.lock:
+            i = 0
+            while i < self.used.value:
+                width = max(1, self.widths[i])
+                series.append((
+                    self.keys[i].value.decode('utf-8'),
+                    self.values[i:i + width],
+                ))
+                i += width
+        return series
+
+    def exposition(self):
+        # Format all series in Prometheus text exposition format.
+        series = dict()
+        for key, values in self.iter_series():
+            name, _, labels = key.partition('{')
+            series.setdefault(name, []).append((labels.rstrip('}'), values))
+
+        lines = []
+        for name in sorted(series):
+            metric = self.metrics.get(name)
+            if metric is None:
+                # Defined in a module not loaded by this process.
+                continue
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for labels, values in series[name]:
+                lines.extend(metric.format(labels, values))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+def format_labels(*labels):
+    labels = ','.join(label for label in labels if label)
+    return '{%s}' % labels if labels else ''
+
+
+def format_value(value):
+    if value.is_integer():
+        return '%d' % value
+    return repr(value)
+
+
+class Metric:
+    type = 'untyped'
+    width = 1
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.registry = registry
+        self.registry.register(self)
+        # Cache of slot by label values.
+        self.slots = dict()
+
+    def slot(self, labelvalues):
+        try:
+            return self.slots[labelvalues]
+        except KeyError:
+            pass
+        if len(labelvalues) != len(self.labels):
+            raise ValueError("Expected labels %s." % ', '.join(self.labels))
+        key = self.name + format_labels(*(
+            '%s="%s"' % (name, escape_label(value))
+            for name, value in zip(self.labels, labelvalues)
+        ))
+        slot = self.registry.slot(key, self.width)
+        return self.slots.setdefault(labelvalues, slot)
+
+    def format(self, labels, values):
+        yield '%s%s %s' % (
+            self.name, format_labels(labels), format_value(values[0]))
+
+
+def escape_label(value):
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        slot = self.slot(labelvalues)
+        if slot is not None:
+            self.registry.add(slot, amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labelvalues):
+        slot = self.slot(labelvalues)
+        if slot is not None:
+            self.registry.set(slot, value)
+
+    def inc(self, *labelvalues, amount=1):
+        slot = self.slot(labelvalues)
+        if slot is not None:
+            self.registry.add(slot, amount)
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS,
+                 registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        # One slot per bucket plus +Inf, then sum.
+        self.width = len(self.buckets) + 2
+        super().__init__(name, help, labels, registry=registry)
+
+    def observe(self, value, *labelvalues):
+        slot = self.slot(labelvalues)
+        if slot is None:
+            return
+        bucket = bisect_left(self.buckets, value)
+        with self.registry.lock:
+            self.registry.values[slot + bucket] += 1
+            self.registry.values[slot + self.width - 1] += value
+
+    def format(self, labels, values):
+        count = 0
+        for le, value in zip(self.buckets + ('+Inf',), values):
+            count += value
+            yield '%s_bucket%s %d' % (
+                self.name, format_labels(labels, 'le="%s"' % le), count)
+        yield '%s_sum%s %s' % (
+            self.name, format_labels(labels), format_value(values[-1]))
+        yield '%s_count%s %d' % (self.name, format_labels(labels), count)
@@ -63,6 +63,12 @@ class SysInfo(Inventory):
         else:
             raise Exception("Unsupported OS.")
 
+    def proc_stat(self):
+        if self.os == 'Linux':
+            return self._proc_stat_linux()
+        else:
+            raise Exception("Unsupported OS.")
+
     def ip_addresses(self):
         if self.os == 'Linux':
             return self._ip_addresses_linux()
@@ -157,6 +163,29 @@ class SysInfo(Inventory):
                 mem_values[key] = size
         return mem_values
 
+    def _proc_stat_linux(self):
+        """
+        Returns cumulative CPU times in clock ticks and process counters from
+        /proc/stat.
+        """
+        stat = {}
+        with open('/proc/stat') as f:
+            for line in f:
+                cols = line.split()
+                if not cols:
+                    continue
+                if cols[0] == 'cpu':
+                    stat['time_user'] = int(cols[1]) + int(cols[2])
+                    stat['time_system'] = \
+                        int(cols[3]) + int(cols[6]) + int(cols[7])
+                    stat['time_idle'] = int(cols[4])
+                    stat['time_iowait'] = int(cols[5])
+                    stat['time_steal'] = int(cols[8])
+                elif cols[0] in ('ctxt', 'processes', 'procs_running',
+                                 'procs_blocked'):
+                    stat[cols[0]] = int(cols[1])
+        return stat
+
     def _ip_addresses_linux(self):
         """Find the host's IP addresses."""
         addrs = []
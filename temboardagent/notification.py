@@ -5,6 +5,7 @@ import sqlite3
 from textwrap import dedent
 import time
 
+from . import storage
 from .errors import NotificationError
 
 logger = logging.getLogger(__name__)
@@ -42,7 +43,7 @@ class NotificationMgmt():
     @classmethod
     def bootstrap(self, config):
         db_path = os.path.join(config.temboard.home, 'core.db')
-        with sqlite3.connect(db_path) as conn:
+        with storage.transaction(db_path) as conn:
             c = conn.cursor()
             c.execute(
                 dedent("""
@@ -62,15 +63,19 @@ class NotificationMgmt():
 
     @classmethod
     def push(self, config, notification):
+        self.push_many(config, [notification])
+
+    @classmethod
+    def push_many(self, config, notifications):
+        # Store notifications in a single transaction.
         try:
 
             db_path = os.path.join(config.temboard.home, 'core.db')
-            with sqlite3.connect(db_path) as conn:
+            with storage.transaction(db_path) as conn:
                 c = conn.cursor()
-                c.execute(
+                c.executemany(
                     "INSERT INTO action_logs VALUES (?, ?, ?)",
-                    (notification.time, notification.username,
-                     notification.message)
+                    [(n.time, n.username, n.message) for n in notifications]
                 )
                 # Purge action_logs, we want to keep only the last 100 messages
                 c.execute(
@@ -87,7 +92,21 @@ class NotificationMgmt():
 
         except sqlite3.Error as e:
             logger.exception(str(e))
-            raise NotificationError('Can not push new notification')
+            raise NotificationError('Can not push new notifications')
+
+    @classmethod
+    def get_last_change(self, config):
+        # Returns rowid of last notification. rowid increases on each insert,
+        # even once the table is purged to its cap or when two notifications
+        # share the same time.
+        try:
+            db_path = os.path.join(config.temboard.home, 'core.db')
+            c = storage.connect(db_path).cursor()
+            c.execute("SELECT MAX(rowid) FROM action_logs")
+            return c.fetchone()[0]
+        except sqlite3.Error as e:
+            logger.exception(str(e))
+            raise NotificationError('Can not get last notification')
 
     @classmethod
     def get_last_n(self, config, n):
@@ -97,18 +116,17 @@ class NotificationMgmt():
         try:
 
             db_path = os.path.join(config.temboard.home, 'core.db')
-            with sqlite3.connect(db_path) as conn:
-                c = conn.cursor()
-                c.execute("SELECT time, username, message FROM action_logs "
-                          "ORDER BY time DESC " + limit)
-                for timestamp, username, message in c.fetchall():
-                    yield dict(
-                        date=datetime.utcfromtimestamp(
-                            int(timestamp)
-                        ).isoformat(),
-                        username=username,
-                        message=message
-                    )
+            c = storage.connect(db_path).cursor()
+            c.execute("SELECT time, username, message FROM action_logs "
+                      "ORDER BY time DESC " + limit)
+            for timestamp, username, message in c.fetchall():
+                yield dict(
+                    date=datetime.utcfromtimestamp(
+                        int(timestamp)
+                    ).isoformat(),
+                    username=username,
+                    message=message
+                )
 
         except sqlite3.Error as e:
             logger.exception(str(e))
@@ -1,24 +1,40 @@
+import json
 import logging
 import time
 
 from ...toolkit import taskmanager
 from ...toolkit.configuration import OptionSpec
+from ... import dbsize
+from ...errors import HTTPError, SharedItem_bad_type_size
 from ...routing import RouteSet
+from ...sharedmemory import CPUSampler, RingBuffer
+from ...tools import JSONEncoder, Response, hash_etag
 
 from . import db
 from . import metrics
+from .stream import Broadcaster
 
 logger = logging.getLogger(__name__)
 routes = RouteSet(prefix=b'/dashboard')
 workers = taskmanager.WorkerSet()
+# RingBuffer of last samples, allocated on first load, before services fork.
+history = None
+# CPUSampler shared by HTTP and collector processes.
+cpu_sampler = None
+# Broadcaster of new samples to /dashboard/stream subscribers.
+broadcaster = None
 
 
 @routes.get(b'', check_key=True)
 def dashboard(http_context, app):
-    return metrics.get_metrics_queue(app.config)
+    return metrics.get_metrics_queue(app.config, history)
 
 
-@routes.get(b'/config', check_key=True)
+def config_etag(http_context, app):
+    return hash_etag(sorted(app.config.dashboard.items()))
+
+
+@routes.get(b'/config', check_key=True, etag=config_etag)
 def dashboard_config(http_context, app):
     return dict(
         scheduler_interval=app.config.dashboard.scheduler_interval,
@@ -28,12 +44,26 @@ def dashboard_config(http_context, app):
 
 @routes.get(b'/live', check_key=True)
 def dashboard_live(http_context, app):
-    return metrics.get_metrics(app)
+    return metrics.get_metrics(app, cpu_sampler)
 
 
 @routes.get(b'/history', check_key=True)
 def dashboard_history(http_context, app):
-    return metrics.get_history_metrics_queue(app.config)
+    return metrics.get_history_metrics_queue(history)
+
+
+@routes.get(b'/stream', check_key=True)
+def dashboard_stream(http_context, app):
+    if broadcaster.full():
+        raise HTTPError(
+            503, "Too many dashboard streams.", headers={'Retry-After': '10'})
+    return Response(
+        broadcaster.greeting(),
+        content_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache'},
+        compress=False,
+        detach=broadcaster.subscribe,
+    )
 
 
 @routes.get(b'/buffers', check_key=True)
@@ -56,7 +86,7 @@ def dashboard_active_backends(http_context, app):
 
 @routes.get(b'/cpu', check_key=True)
 def dashboard_cpu(http_context, app):
-    return metrics.get_cpu_usage()
+    return metrics.get_cpu_usage(cpu_sampler)
 
 
 @routes.get(b'/loadaverage', check_key=True)
@@ -93,7 +123,7 @@ def dashboard_n_cpu(http_context, app):
 @routes.get(b'/databases', check_key=True)
 def dashboard_databases(http_context, app):
     with app.postgres.connect() as conn:
-        return metrics.get_databases(conn)
+        return metrics.get_databases(conn, app)
 
 
 @routes.get(b'/info', check_key=True)
@@ -112,29 +142,48 @@ def dashboard_max_connections(http_context, app):
 def dashboard_collector_worker(app):
     logger.debug("Starting dashboard collector")
 
-    data = metrics.get_metrics(app)
+    data = metrics.get_metrics(app, cpu_sampler)
 
     # We don't want to store notifications in the history.
     data.pop('notifications', None)
     logger.debug(data)
 
-    db.add_metric(
-        app.config.temboard.home,
-        'dashboard.db',
-        time.time(),
-        data,
-        app.config.dashboard.history_length
-    )
+    now = time.time()
+    try:
+        history.append(now, json.dumps(data, cls=JSONEncoder).encode('utf-8'))
+    except SharedItem_bad_type_size:
+        logger.error("Dashboard sample is too big, skipping.")
+        return
+
+    if app.config.dashboard.persist_interval:
+        persist_history(app.config, now)
 
     logger.debug("Done")
 
 
+def persist_history(config, now):
+    # Write samples collected since last write to dashboard.db, at most once
+    # per persist_interval.
+    home = config.temboard.home
+    last = db.get_last_time(home, 'dashboard.db')
+    if last is not None and now - last < config.dashboard.persist_interval:
+        return
+    rows = [(t, data.decode('utf-8')) for t, data in history.read(since=last)]
+    db.add_metrics(home, 'dashboard.db', rows, config.dashboard.history_length)
+
+
 class DashboardPlugin:
     PG_MIN_VERSION = (90400, 9.4)
     s = 'dashboard'
     option_specs = [
         OptionSpec(s, 'scheduler_interval', default=2, validator=int),
         OptionSpec(s, 'history_length', default=150, validator=int),
+        OptionSpec(s, 'persist_interval', default=0, validator=int),
+        OptionSpec(s, 'stream_max_clients', default=64, validator=int),
+        OptionSpec(s, 'db_size_max_age', default=300, validator=int),
+        OptionSpec(s, 'db_size_budget', default=1., validator=float),
+        OptionSpec(
+            s, 'db_size_method', default='exact', validator=dbsize.method),
     ]
     del s
 
@@ -144,8 +193,21 @@ class DashboardPlugin:
 
     def bootstrap(self):
         db.bootstrap(self.app.config.temboard.home, 'dashboard.db')
+        dbsize.bootstrap(self.app.config.temboard.home)
 
     def load(self):
+        global broadcaster, cpu_sampler, history
+        if cpu_sampler is None:
+            cpu_sampler = CPUSampler()
+        length = self.app.config.dashboard.history_length
+        if history is None:
+            history = RingBuffer(length)
+        elif history.length != length:
+            logger.warning(
+                "Restart agent to resize dashboard history to %s samples.",
+                length)
+        if broadcaster is None:
+            broadcaster = Broadcaster(history, self.app)
         self.app.router.add(routes)
         self.app.worker_pool.add(workers)
         workers.schedule(
@@ -1,9 +1,7 @@
-import json
 import os
-import sqlite3
 from textwrap import dedent
 
-from ...tools import JSONEncoder
+from ... import storage
 
 
 def bootstrap(path, dbname):
@@ -18,7 +16,7 @@ def bootstrap(path, dbname):
     default) and want it to act as a FIFO queue.
     """
 
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
+    with storage.transaction(os.path.join(path, dbname)) as conn:
         c = conn.cursor()
         c.execute("DROP TABLE IF EXISTS metrics")
         c.execute(
@@ -31,39 +29,25 @@ def bootstrap(path, dbname):
         )
 
 
-def add_metric(path, dbname, time, data, keep_limit):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
+def add_metrics(path, dbname, rows, keep_limit):
+    # Insert a batch of (time, data) rows in a single transaction and purge
+    # rows beyond keep_limit.
+    with storage.transaction(os.path.join(path, dbname)) as conn:
         c = conn.cursor()
-        c.execute(
-            "INSERT INTO metrics VALUES(?, ?)",
-            (time, json.dumps(data, cls=JSONEncoder))
-        )
+        c.executemany("INSERT OR REPLACE INTO metrics VALUES(?, ?)", rows)
         # Purge
         c.execute(
             dedent("""
                 DELETE FROM metrics
-                WHERE time NOT IN (
+                WHERE time <= (
                     SELECT time FROM metrics ORDER BY time DESC
-                    LIMIT ?
+                    LIMIT 1 OFFSET ?
                 )
             """),
             (keep_limit,)
         )
 
 
-def get_last_metric(path, dbname):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
-        c = conn.cursor()
-        c.execute(
-            "SELECT data FROM metrics ORDER BY time DESC LIMIT 1"
-        )
-        return c.fetchone()
-
-
-def get_all_metrics(path, dbname):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
-        c = conn.cursor()
-        c.execute(
-            "SELECT data FROM metrics ORDER BY time ASC"
-        )
-        return c.fetchall()
+def get_last_time(path, dbname):
+    conn = storage.connect(os.path.join(path, dbname))
+    return conn.execute("SELECT MAX(time) FROM metrics").fetchone()[0]
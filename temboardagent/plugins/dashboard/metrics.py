@@ -3,35 +3,72 @@ import time
 import os
 import re
 
-from . import db
+from ...dbsize import SizeCache
 from ...notification import NotificationMgmt
 from ...inventory import SysInfo, PgInfo
 from ...errors import UserError
-
-
-def get_metrics(app):
+from ...tools import RawJSON, size_pretty
+
+
+# Queries of dashboard metrics, run alone by single metric endpoints or as
+# subqueries of SNAPSHOT_SQL.
+BUFFERS_SQL = "SELECT buffers_alloc FROM pg_stat_bgwriter"
+HITRATIO_SQL = """\
+SELECT CASE sum(blks_hit+blks_read)
+  WHEN 0 THEN NULL
+  ELSE trunc(sum(blks_hit)/sum(blks_hit+blks_read)*100)::float
+END AS hitratio
+FROM pg_stat_database"""
+ACTIVE_BACKENDS_SQL = \
+    "SELECT COUNT(*) AS nb FROM pg_stat_activity WHERE state != 'idle'"
+MAX_CONNECTIONS_SQL = "SELECT current_setting('max_connections')::int"
+STAT_DB_SQL = """\
+SELECT
+    count(datid) as databases,
+    array_agg(datname) AS datnames,
+    to_char(now(),'HH24:MI') as time,
+    sum(xact_commit)::BIGINT as total_commit,
+    sum(xact_rollback)::BIGINT as total_rollback
+FROM pg_database
+JOIN pg_stat_database ON (pg_database.oid = pg_stat_database.datid)
+WHERE datistemplate = 'f'"""
+UPTIME_SQL = """\
+SELECT EXTRACT(epoch FROM NOW() - pg_postmaster_start_time())::integer
+    AS uptime"""
+# All Postgres metrics of a dashboard sample, in a single round-trip.
+SNAPSHOT_SQL = """\
+SELECT
+    (%s) AS buffers,
+    (%s) AS hitratio,
+    (%s) AS active_backends,
+    (%s) AS max_connections,
+    db.databases,
+    db.datnames,
+    db.time,
+    db.total_commit,
+    db.total_rollback,
+    (%s) AS pg_uptime,
+    version() AS pg_version,
+    current_setting('data_directory') AS pg_data,
+    current_setting('port') AS pg_port
+FROM (%s) AS db""" % (
+    BUFFERS_SQL, HITRATIO_SQL, ACTIVE_BACKENDS_SQL, MAX_CONNECTIONS_SQL,
+    UPTIME_SQL, STAT_DB_SQL,
+)
+
+
+def get_metrics(app, cpu_sampler):
     res = dict()
     try:
         with app.postgres.connect() as conn:
-            dm = DashboardMetrics(conn)
-            pginfo = PgInfo(conn)
-            res.update(dict(
-                buffers=dm.get_buffers(),
-                hitratio=dm.get_hitratio(),
-                active_backends=dm.get_active_backends(),
-                max_connections=dm.get_max_connections(),
-                databases=dm.get_stat_db(),
-                pg_uptime=dm.get_pg_uptime(),
-                pg_version=pginfo.version()['full'],
-                pg_data=pginfo.setting('data_directory'),
-                pg_port=pginfo.setting('port'),
-            ))
+            res.update(DashboardMetrics(conn).get_snapshot(
+                get_size_cache(app.config), app.postgres))
     except UserError:
         pass
 
     dm = DashboardMetrics()
     res.update(dict(
-        cpu=dm.get_cpu_usage(),
+        cpu=dm.get_cpu_usage(cpu_sampler),
         loadaverage=dm.get_load_average(),
         memory=dm.get_memory_usage(),
         notifications=dm.get_notifications(app.config),
@@ -55,29 +92,30 @@ def get_metrics(app):
     return res
 
 
-def get_metrics_queue(config):
+def get_size_cache(config):
+    return SizeCache(
+        config.temboard.home,
+        max_age=config.dashboard.db_size_max_age,
+        budget=config.dashboard.db_size_budget,
+        method=config.dashboard.db_size_method,
+    )
+
+
+def get_metrics_queue(config, history):
     dm = DashboardMetrics()
     msg = dict()
 
-    row = db.get_last_metric(
-        config.temboard.home,
-        'dashboard.db'
-    )
-    if row:
-        msg = json.loads(row[0])
+    sample = history.last()
+    if sample:
+        msg = json.loads(sample[1])
 
     msg['notifications'] = dm.get_notifications(config)
     return msg
 
 
-def get_history_metrics_queue(config):
-    return [
-        json.loads(d)
-        for d, in db.get_all_metrics(
-            config.temboard.home,
-            'dashboard.db'
-        )
-    ]
+def get_history_metrics_queue(history):
+    # Samples are already JSON, send them as is.
+    return [RawJSON(data.decode('utf-8')) for _, data in history.read()]
 
 
 def get_info(conn, config):
@@ -114,9 +152,9 @@ def get_max_connections(conn):
     return dict(max_connections=dm.get_max_connections())
 
 
-def get_cpu_usage():
+def get_cpu_usage(cpu_sampler):
     dm = DashboardMetrics()
-    return dict(cpu=dm.get_cpu_usage())
+    return dict(cpu=dm.get_cpu_usage(cpu_sampler))
 
 
 def get_loadaverage():
@@ -139,9 +177,10 @@ def get_os_version():
     return dict(os_version=' '.join((sysinfo.os, sysinfo.os_release)))
 
 
-def get_databases(conn):
+def get_databases(conn, app):
     dm = DashboardMetrics(conn)
-    return dict(databases=dm.get_stat_db())
+    return dict(databases=dm.get_stat_db(
+        get_size_cache(app.config), app.postgres))
 
 
 def get_n_cpu():
@@ -162,6 +201,30 @@ class DashboardMetrics:
     def __init__(self, conn=None):
         self.conn = conn
 
+    def get_snapshot(self, size_cache, postgres):
+        # All Postgres metrics of a dashboard sample, in a single round-trip.
+        row = self.conn.queryone(SNAPSHOT_SQL)
+        now = time.time()
+        return dict(
+            buffers={'nb': row['buffers'], 'time': now},
+            hitratio=row['hitratio'],
+            active_backends={'nb': row['active_backends'], 'time': now},
+            max_connections=row['max_connections'],
+            databases={
+                'databases': row['databases'],
+                'total_size': self.get_total_size(
+                    size_cache, postgres, row['datnames']),
+                'time': row['time'],
+                'total_commit': row['total_commit'],
+                'total_rollback': row['total_rollback'],
+                'timestamp': now,
+            },
+            pg_uptime=row['pg_uptime'],
+            pg_version=row['pg_version'],
+            pg_data=row['pg_data'],
+            pg_port=row['pg_port'],
+        )
+
     def get_buffers(self,):
         current_time = time.time()
         current_buffers = self._get_current_buffers()
@@ -169,13 +232,7 @@ class DashboardMetrics:
                 'time': current_time}
 
     def get_hitratio(self,):
-        return self.conn.query_scalar("""\
-        SELECT CASE sum(blks_hit+blks_read)
-          WHEN 0 THEN NULL
-          ELSE trunc(sum(blks_hit)/sum(blks_hit+blks_read)*100)::float
-        END AS hitratio
-        FROM pg_stat_database
-        """)
+        return self.conn.query_scalar(HITRATIO_SQL)
 
     def get_active_backends(self,):
         current_time = time.time()
@@ -184,14 +241,12 @@ class DashboardMetrics:
                 'time': current_time}
 
     def get_max_connections(self):
-        return int(self.conn.query_scalar("""\
-        SELECT setting FROM pg_settings WHERE name = 'max_connections'
-        """))
+        return self.conn.query_scalar(MAX_CONNECTIONS_SQL)
 
-    def get_cpu_usage(self,):
+    def get_cpu_usage(self, sampler):
         sysinfo = SysInfo()
         if sysinfo.os == 'Linux':
-            return self._get_cpu_usage_linux()
+            return sampler.usage(time.time(), sysinfo.proc_stat())
 
     def get_load_average(self,):
         return os.getloadavg()[0]
@@ -201,30 +256,26 @@ class DashboardMetrics:
         if sysinfo.os == 'Linux':
             return self._get_memory_usage_linux()
 
-    def get_stat_db(self,):
-        row = self.conn.queryone("""\
-        SELECT
-            count(datid) as databases,
-            pg_size_pretty(sum(pg_database_size(
-                pg_database.datname))::bigint) as total_size,
-            to_char(now(),'HH24:MI') as time,
-            sum(xact_commit)::BIGINT as total_commit,
-            sum(xact_rollback)::BIGINT as total_rollback
-        FROM pg_database
-        JOIN pg_stat_database ON (pg_database.oid = pg_stat_database.datid)
-        WHERE datistemplate = 'f'
-        """)
+    def get_stat_db(self, size_cache, postgres):
+        row = self.conn.queryone(STAT_DB_SQL)
         return {'databases': row['databases'],
-                'total_size': row['total_size'],
+                'total_size': self.get_total_size(
+                    size_cache, postgres, row['datnames']),
                 'time': row['time'],
                 'total_commit': row['total_commit'],
                 'total_rollback': row['total_rollback'],
                 'timestamp': time.time()}
 
+    def get_total_size(self, size_cache, postgres, dbnames):
+        # Pretty total size of databases, from size cache. None until every
+        # database has a size, rather than an undercounted total.
+        sizes = size_cache.sizes(self.conn, postgres, dbnames or [])
+        if not sizes or None in sizes.values():
+            return None
+        return size_pretty(sum(sizes.values()))
+
     def get_pg_uptime(self,):
-        return self.conn.query_scalar("""\
-        SELECT EXTRACT(epoch FROM NOW() - pg_postmaster_start_time())::integer AS uptime
-        """)  # noqa
+        return self.conn.query_scalar(UPTIME_SQL)
 
     def _get_memory_usage_linux(self,):
         mem_total = 0
@@ -252,54 +303,12 @@ class DashboardMetrics:
                 'active': round(float(mem_active) / float(mem_total) * 100, 1),
                 'cached': round(float(mem_cached) / float(mem_total) * 100, 1)}
 
-    def _get_cpu_usage_linux(self,):
-        cpu_time_snap_0 = self._get_current_cpu_usage_linux()
-        time.sleep(0.1)
-        cpu_time_snap_1 = self._get_current_cpu_usage_linux()
-        delta_time_total = 0
-        delta = {}
-        for k in ['time_user', 'time_system', 'time_idle', 'time_iowait',
-                  'time_steal']:
-            delta_time_total += cpu_time_snap_1[k] - cpu_time_snap_0[k]
-            delta[k] = cpu_time_snap_1[k] - cpu_time_snap_0[k]
-        return {
-            'user': 0 if not delta_time_total else
-            round(delta['time_user'] / delta_time_total * 100, 1),
-            'system': 0 if not delta_time_total else
-            round(delta['time_system'] / delta_time_total * 100, 1),
-            'idle': 0 if not delta_time_total else
-            round(delta['time_idle'] / delta_time_total * 100, 1),
-            'iowait': 0 if not delta_time_total else
-            round(delta['time_iowait'] / delta_time_total * 100, 1),
-            'steal': 0 if not delta_time_total else
-            round(delta['time_steal'] / delta_time_total * 100, 1)
-        }
-
-    def _get_current_cpu_usage_linux(self,):
-        ret = {}
-        with open('/proc/stat') as fd:
-            for line in fd.readlines():
-                cols = line.split()
-                if len(cols) > 0 and cols[0] == 'cpu':
-                    ret['time_user'] = float(cols[1]) + float(cols[2])
-                    ret['time_system'] = float(cols[3]) + float(cols[6]) + \
-                        float(cols[7])
-                    ret['time_idle'] = float(cols[4])
-                    ret['time_iowait'] = float(cols[5])
-                    ret['time_steal'] = float(cols[8])
-                    break
-        return ret
-
     def _get_current_buffers(self,):
-        return self.conn.query_scalar(
-            "SELECT buffers_alloc FROM pg_stat_bgwriter"
-        )
+        return self.conn.query_scalar(BUFFERS_SQL)
 
     def _get_current_active_backends(self,):
         if self.conn.server_version >= 90200:
-            query = """
-SELECT COUNT(*) AS nb FROM pg_stat_activity WHERE state != 'idle'
-            """
+            query = ACTIVE_BACKENDS_SQL
         else:
             query = """
 SELECT COUNT(*) AS nb FROM pg_stat_activity WHERE current_query != '<IDLE>'
@@ -0,0 +1,131 @@
+# Fan-out of dashboard samples to Server-Sent Events subscribers.
+#
+# A single thread of HTTP process watches history ring buffer filled by
+# collector process. Each new sample is formatted once as an SSE event, with
+# last notifications, and written by this thread to the connection of each
+# subscriber. Subscribers don't hold HTTP workers. Writes don't block: a slow
+# subscriber gets events buffered by its connection and doesn't delay
+# others.
+
+import json
+import logging
+import os
+import threading
+import time
+
+from .metrics import DashboardMetrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(data):
+    # data is a JSON document, without newlines.
+    return b'data: ' + data + b'\n\n'
+
+
+class Broadcaster:
+    # Seconds between checks of history for new samples.
+    poll_interval = .2
+    # Seconds between comments keeping idle connections open.
+    keepalive = 15
+
+    def __init__(self, history, app):
+        self.history = history
+        self.app = app
+        self.lock = threading.Lock()
+        # Detached connections of subscribers.
+        self.subscribers = []
+        self.pid = None
+
+    def start(self):
+        # Must be called with lock held.
+        if self.pid == os.getpid():
+            return
+        # Don't rely on thread of parent process.
+        self.pid = os.getpid()
+        thread = threading.Thread(
+            target=self.run, name='dashboard-stream', daemon=True)
+        thread.start()
+
+    def run(self):
+        # Subscribers get samples already in history on subscribe.
+        count = self.history.count.value
+        last_event = time.time()
+        while True:
+            time.sleep(self.poll_interval)
+            self.flush()
+            if self.history.count.value != count:
+                count = self.history.count.value
+                sample = self.history.last()
+                if sample is None or not self.subscribers:
+                    continue
+                try:
+                    event = self.build_event(sample)
+                except Exception:
+                    logger.exception("Failed to build dashboard event.")
+                    continue
+            elif time.time() - last_event >= self.keepalive:
+                event = b': keepalive\n\n'
+            else:
+                continue
+            last_event = time.time()
+            self.send(event)
+
+    def send(self, event):
+        # Write event to each subscriber.
+        self.each('write', event)
+
+    def flush(self):
+        # Continue sending events buffered for slow subscribers.
+        self.each('flush')
+
+    def each(self, method, *args):
+        # Call method of each subscriber connection. Drop subscribers gone or
+        # lagging too far behind.
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for conn in subscribers:
+            try:
+                getattr(conn, method)(*args)
+            except OSError as e:
+                logger.debug(
+                    "Dropping dashboard stream of %s: %s.",
+                    conn.client_address[0], e)
+                self.unsubscribe(conn)
+
+    def build_event(self, sample):
+        _, data = sample
+        msg = json.loads(data)
+        msg['notifications'] = DashboardMetrics().get_notifications(
+            self.app.config)
+        return format_event(json.dumps(msg).encode('utf-8'))
+
+    def full(self):
+        return (
+            len(self.subscribers) >=
+            self.app.config.dashboard.stream_max_clients)
+
+    def greeting(self):
+        # Start of SSE stream: reconnection delay, in milliseconds, and last
+        # sample.
+        interval = self.app.config.dashboard.scheduler_interval
+        data = b'retry: %d\n\n' % (interval * 1000)
+        sample = self.history.last()
+        if sample:
+            data += self.build_event(sample)
+        return data
+
+    def subscribe(self, conn):
+        # Receive next events on detached connection, until client
+        # disconnects.
+        with self.lock:
+            self.start()
+            self.subscribers.append(conn)
+
+    def unsubscribe(self, conn):
+        with self.lock:
+            if conn not in self.subscribers:
+                return
+            self.subscribers.remove(conn)
+        conn.close()
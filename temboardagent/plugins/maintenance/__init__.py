@@ -5,14 +5,23 @@ from temboardagent.toolkit import taskmanager
 from temboardagent.tools import validate_parameters
 from temboardagent.types import T_OBJECTNAME
 
-from . import functions
+from . import bloat, functions
 
 
 routes = RouteSet(prefix=b'/maintenance')
 workers = taskmanager.WorkerSet()
 
 
-@routes.get(b'', check_key=True)
+def get_bloat_cache(app, dbname, conn):
+    # Returns bloat estimation cache of dbname, requesting a refresh in
+    # background if stale. Never wait for estimation.
+    cache = bloat.BloatCache(app.config.temboard.home, dbname)
+    if cache.is_stale(conn):
+        bloat.REFRESHER.request(cache, functions.get_postgres(app, dbname))
+    return cache
+
+
+@routes.get(b'', check_key=True, concurrency=2)
 def get_instance(http_context, app):
     with app.postgres.connect() as conn:
         instance = next(functions.get_instance(conn))
@@ -25,8 +34,9 @@ def get_instance(http_context, app):
         database = dict(database)
         # we need to connect with a different database
         dbname = database['datname']
-        with functions.get_postgres(app.config, dbname).connect() as conn:
-            database.update(**functions.get_database(conn))
+        with functions.get_postgres(app, dbname).connect() as conn:
+            cache = get_bloat_cache(app, dbname, conn)
+            database.update(**functions.get_database(conn, cache))
         databases.append(database)
 
     return {'instance': instance, 'databases': databases}
@@ -41,40 +51,43 @@ T_TIMESTAMP_UTC = b'(^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}Z$)'
 T_OPERATION_ID = b'(^[0-9a-f]{8}$)'
 
 
-@routes.get(b'/%s' % (T_DATABASE_NAME), check_key=True)
+@routes.get(b'/%s' % (T_DATABASE_NAME), check_key=True, concurrency=2)
 def get_database(http_context, app):
     dbname = http_context['urlvars'][0]
-    with functions.get_postgres(app.config, dbname).connect() as conn:
+    with functions.get_postgres(app, dbname).connect() as conn:
         database = functions.get_database_size(conn)
-        schemas = functions.get_schemas(conn)
+        cache = get_bloat_cache(app, dbname, conn)
+        schemas = functions.get_schemas(conn, cache)
     return dict(database, **{'schemas': schemas})
 
 
 @routes.get(b'/%s/schema/%s' % (T_DATABASE_NAME, T_SCHEMA_NAME),
-            check_key=True)
+            check_key=True, concurrency=2)
 def get_schema(http_context, app):
     dbname = http_context['urlvars'][0]
     schema = http_context['urlvars'][1]
-    with functions.get_postgres(app.config, dbname).connect() \
+    with functions.get_postgres(app, dbname).connect() \
             as conn:
-        tables = functions.get_tables(conn, schema)
-        indexes = functions.get_schema_indexes(conn, schema)
+        cache = get_bloat_cache(app, dbname, conn)
+        tables = functions.get_tables(conn, schema, cache)
+        indexes = functions.get_schema_indexes(conn, schema, cache)
         schema = functions.get_schema(conn, schema)
     return dict(dict(tables, **indexes), **schema)
 
 
 @routes.get(b'/%s/schema/%s/table/%s' % (T_DATABASE_NAME, T_SCHEMA_NAME,
                                          T_TABLE_NAME),
-            check_key=True)
+            check_key=True, concurrency=2)
 def get_table(http_context, app):
     dbname = http_context['urlvars'][0]
     schema = http_context['urlvars'][1]
     table = http_context['urlvars'][2]
 
-    with functions.get_postgres(app.config, dbname).connect() \
+    with functions.get_postgres(app, dbname).connect() \
             as conn:
-        ret = functions.get_table(conn, schema, table)
-        ret.update(**functions.get_table_indexes(conn, schema, table))
+        cache = get_bloat_cache(app, dbname, conn)
+        ret = functions.get_table(conn, schema, table, cache)
+        ret.update(**functions.get_table_indexes(conn, schema, table, cache))
         return ret
 
 
@@ -107,7 +120,7 @@ def post_vacuum(app, post, dbname, schema=None, table=None):
         ])
     mode = post.get('mode', '')
 
-    with functions.get_postgres(app.config, dbname).connect() as conn:
+    with functions.get_postgres(app, dbname).connect() as conn:
         return functions.schedule_vacuum(conn, dbname, mode, dt, app,
                                          schema=schema, table=table)
 
@@ -143,7 +156,7 @@ def scheduled_vacuum(http_context, app):
 
 @workers.register(pool_size=10)
 def vacuum_worker(app, dbname, mode, schema=None, table=None):
-    with functions.get_postgres(app.config, dbname).connect() \
+    with functions.get_postgres(app, dbname).connect() \
             as conn:
         return functions.vacuum(conn, dbname, mode, schema, table)
 
@@ -172,7 +185,7 @@ def post_analyze(app, post, dbname, schema=None, table=None):
         ])
     dt = post.get('datetime', datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"))
 
-    with functions.get_postgres(app.config, dbname).connect() as conn:
+    with functions.get_postgres(app, dbname).connect() as conn:
         return functions.schedule_analyze(conn, dbname, dt, app,
                                           schema=schema, table=table)
 
@@ -208,7 +221,7 @@ def scheduled_analyze(http_context, app):
 
 @workers.register(pool_size=10)
 def analyze_worker(app, dbname, schema=None, table=None):
-    with functions.get_postgres(app.config, dbname).connect() \
+    with functions.get_postgres(app, dbname).connect() \
             as conn:
         return functions.analyze(conn, dbname, schema, table)
 
@@ -249,7 +262,7 @@ def post_reindex(app, post, dbname, schema=None, table=None, index=None):
         ])
     dt = post.get('datetime', datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"))
 
-    with functions.get_postgres(app.config, dbname).connect() as conn:
+    with functions.get_postgres(app, dbname).connect() as conn:
         return functions.schedule_reindex(
             conn, dbname, dt, app, schema=schema, table=table, index=index)
 
@@ -291,7 +304,7 @@ def scheduled_reindex(http_context, app):
 
 @workers.register(pool_size=10)
 def reindex_worker(app, dbname, schema=None, table=None, index=None):
-    with functions.get_postgres(app.config, dbname).connect() as conn:
+    with functions.get_postgres(app, dbname).connect() as conn:
         return functions.reindex(conn, dbname, schema, table, index)
 
 
@@ -301,6 +314,9 @@ class MaintenancePlugin:
     def __init__(self, app, **kw):
         self.app = app
 
+    def bootstrap(self):
+        bloat.bootstrap(self.app.config.temboard.home)
+
     def load(self):
         self.app.router.add(routes)
         self.app.worker_pool.add(workers)
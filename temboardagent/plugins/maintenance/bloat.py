@@ -0,0 +1,220 @@
+# Cache of bloat estimation of tables and btree indexes.
+#
+# Bloat estimation queries scan the whole catalog of a database. Estimations
+# are stored per database in bloat.db SQLite database, and refreshed when
+# older than MAX_AGE or when enough rows have been modified since last
+# refresh. Readers never run estimation queries: they get the cached
+# estimation and request a refresh in background if the cache is stale.
+
+import logging
+import os
+import threading
+import time
+from queue import Queue
+from textwrap import dedent
+
+from ... import storage
+from ...postgres import statement_timeout
+from .functions import INDEX_BTREE_BLOAT_SQL, TABLE_BLOAT_SQL
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds before refreshing estimation of a database.
+MAX_AGE = 3600
+# Seconds before canceling estimation queries of a database.
+TIMEOUT = 300
+# Ratio of live rows modified since last estimation triggering a refresh.
+CHANGES_RATIO = .1
+# Minimum number of modified rows triggering a refresh.
+MIN_CHANGES = 1000
+
+MODIFICATIONS_SQL = """\
+SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0) AS n_mod,
+       coalesce(sum(n_live_tup), 0) AS n_live
+FROM pg_stat_all_tables
+"""
+
+
+def bootstrap(home):
+    with storage.transaction(os.path.join(home, 'bloat.db')) as conn:
+        conn.execute(dedent("""
+            CREATE TABLE IF NOT EXISTS refreshes (
+                dbname TEXT PRIMARY KEY,
+                time REAL,
+                n_mod INTEGER
+            )
+        """))
+        conn.execute(dedent("""
+            CREATE TABLE IF NOT EXISTS tables (
+                dbname TEXT,
+                schemaname TEXT,
+                tblname TEXT,
+                real_size REAL,
+                bloat_size REAL,
+                PRIMARY KEY (dbname, schemaname, tblname)
+            )
+        """))
+        conn.execute(dedent("""
+            CREATE TABLE IF NOT EXISTS indexes (
+                dbname TEXT,
+                schemaname TEXT,
+                tblname TEXT,
+                idxname TEXT,
+                real_size REAL,
+                bloat_size REAL,
+                PRIMARY KEY (dbname, schemaname, tblname, idxname)
+            )
+        """))
+
+
+class BloatCache:
+    """Bloat estimation of relations of a database."""
+
+    def __init__(self, home, dbname):
+        self.path = os.path.join(home, 'bloat.db')
+        self.dbname = dbname
+
+    def is_stale(self, conn, max_age=MAX_AGE):
+        """Whether estimation is missing, older than max_age seconds or
+        outdated by modifications.
+
+        conn must be connected to the database of the cache.
+        """
+        row = storage.connect(self.path).execute(
+            "SELECT time, n_mod FROM refreshes WHERE dbname = ?",
+            (self.dbname,)
+        ).fetchone()
+        if row is None:
+            return True
+        last_time, last_n_mod = row
+        if time.time() - last_time > max_age:
+            return True
+        mods = conn.queryone(MODIFICATIONS_SQL)
+        changes = mods['n_mod'] - last_n_mod
+        if changes < 0:
+            # Statistics have been reset.
+            return True
+        return changes > max(MIN_CHANGES, CHANGES_RATIO * mods['n_live'])
+
+    def refresh(self, conn, timeout=TIMEOUT):
+        """Run estimation queries on conn and store their result.
+
+        Queries are canceled after timeout seconds.
+        """
+        logger.debug("Estimating bloat of database %s.", self.dbname)
+        with statement_timeout(conn, timeout):
+            mods = conn.queryone(MODIFICATIONS_SQL)
+            tables = [
+                (self.dbname, r['schemaname'], r['tblname'],
+                 r['real_size'], r['bloat_size'])
+                for r in conn.query(
+                    "SELECT schemaname, tblname, real_size, bloat_size "
+                    "FROM (\n%s\n) AS b" % TABLE_BLOAT_SQL)
+            ]
+            indexes = [
+                (self.dbname, r['schemaname'], r['tblname'], r['idxname'],
+                 r['real_size'], r['bloat_size'])
+                for r in conn.query(
+                    "SELECT schemaname, tblname, idxname, real_size, "
+                    "bloat_size FROM (\n%s\n) AS b" % INDEX_BTREE_BLOAT_SQL)
+            ]
+
+        with storage.transaction(self.path) as sqlite:
+            sqlite.execute(
+                "DELETE FROM tables WHERE dbname = ?", (self.dbname,))
+            sqlite.executemany(
+                "INSERT INTO tables VALUES (?, ?, ?, ?, ?)", tables)
+            sqlite.execute(
+                "DELETE FROM indexes WHERE dbname = ?", (self.dbname,))
+            sqlite.executemany(
+                "INSERT INTO indexes VALUES (?, ?, ?, ?, ?, ?)", indexes)
+            sqlite.execute(
+                "INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?)",
+                (self.dbname, time.time(), mods['n_mod']))
+
+    def refresh_if_stale(self, conn, max_age=MAX_AGE):
+        if self.is_stale(conn, max_age):
+            self.refresh(conn)
+
+    def tables(self, schema=None, table=None):
+        """Returns bloat size of tables by schema and table name."""
+        return self._query(
+            "SELECT schemaname, tblname, bloat_size FROM tables",
+            schema, table)
+
+    def indexes(self, schema=None, table=None):
+        """Returns bloat size of btree indexes by schema, table and index
+        name."""
+        return self._query(
+            "SELECT schemaname, tblname, idxname, bloat_size FROM indexes",
+            schema, table)
+
+    def _query(self, sql, schema, table):
+        sql += " WHERE dbname = ?"
+        args = (self.dbname,)
+        if schema is not None:
+            sql += " AND schemaname = ?"
+            args += (schema,)
+        if table is not None:
+            sql += " AND tblname = ?"
+            args += (table,)
+        return dict(
+            (row[:-1], row[-1])
+            for row in storage.connect(self.path).execute(sql, args)
+        )
+
+    def ratio(self, relations):
+        """Returns bloat ratio in percent of tables or indexes, as a whole."""
+        assert relations in ('tables', 'indexes')
+        size, bloat = storage.connect(self.path).execute(
+            "SELECT SUM(real_size), SUM(bloat_size) FROM %s "
+            "WHERE dbname = ?" % relations,
+            (self.dbname,)
+        ).fetchone()
+        if not size:
+            return None
+        return bloat / size * 100
+
+
+class Refresher:
+    # Thread refreshing stale caches one database at a time, in the
+    # background of HTTP requests.
+
+    def __init__(self):
+        self.queue = Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def request(self, cache, postgres):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Don't rely on thread of parent process.
+                self.pid = os.getpid()
+                self.queue = Queue()
+                self.pending = set()
+                self.thread = threading.Thread(
+                    target=self.run, name='bloat-refresher', daemon=True)
+                self.thread.start()
+            if cache.dbname in self.pending:
+                return
+            self.pending.add(cache.dbname)
+        self.queue.put((cache, postgres))
+
+    def run(self):
+        while True:
+            cache, postgres = self.queue.get()
+            try:
+                with postgres.connect() as conn:
+                    cache.refresh(conn)
+            except Exception as e:
+                logger.error(
+                    "Failed to estimate bloat of %s: %s", cache.dbname, e)
+            finally:
+                with self.lock:
+                    self.pending.discard(cache.dbname)
+
+
+REFRESHER = Refresher()
@@ -4,7 +4,7 @@ import logging
 import os
 
 from temboardagent.errors import UserError, HTTPError
-from temboardagent.postgres import Postgres
+from temboardagent.tools import size_pretty
 from temboardagent.toolkit import taskmanager
 
 logger = logging.getLogger(__name__)
@@ -174,10 +174,6 @@ SELECT n.nspname AS "name",
        COALESCE(n_indexes, 0) AS n_indexes,
        COALESCE(indexes_bytes, 0) AS indexes_bytes,
        pg_size_pretty(indexes_bytes) AS indexes_size,
-       tbloat.bloat_size AS tables_bloat_bytes,
-       pg_size_pretty(tbloat.bloat_size::bigint) AS tables_bloat_size,
-       ibloat.bloat_size AS indexes_bloat_bytes,
-       pg_size_pretty(ibloat.bloat_size::bigint) AS indexes_bloat_size,
        COALESCE(toast.toast_bytes, 0) AS toast_bytes,
        pg_size_pretty(toast.toast_bytes) AS toast_size
 FROM pg_catalog.pg_namespace n
@@ -210,27 +206,9 @@ LEFT JOIN (
   GROUP BY schemaname
 ) AS indexes
 ON indexes.schemaname = n.nspname
-LEFT JOIN (
-  SELECT SUM(bloat_size) AS bloat_size,
-         schemaname
-  FROM (
-    %s
-  ) AS a
-  GROUP BY schemaname
-) AS tbloat
-ON tbloat.schemaname = n.nspname
-LEFT JOIN (
-  SELECT SUM(bloat_size) AS bloat_size,
-         schemaname
-  FROM (
-    %s
-  ) AS a
-  GROUP BY schemaname
-) AS ibloat
-ON ibloat.schemaname = n.nspname
 WHERE n.nspname !~ '^pg_temp'
 AND n.nspname !~ '^pg_toast'
-""" % (TABLE_BLOAT_SQL, INDEX_BTREE_BLOAT_SQL)  # noqa
+"""  # noqa
 
 
 INDEXES_SQL = """
@@ -246,9 +224,7 @@ SELECT i.tablename AS tablename,
        i.indexdef AS def,
        total_bytes,
        pg_size_pretty(total_bytes) AS total_size,
-       am.amname AS type,
-       ibloat.bloat_size AS bloat_bytes,
-       pg_size_pretty(ibloat.bloat_size::bigint) AS bloat_size
+       am.amname AS type
 FROM pg_index x
 JOIN (
     select oid, relname, relam, pg_total_relation_size(c.oid) AS total_bytes
@@ -261,25 +237,17 @@ JOIN pg_stat_all_indexes psai
 ON x.indexrelid = psai.indexrelid
 JOIN pg_am am
 ON am.oid = c.relam
-JOIN (
-    WITH qq AS (
-    """ + INDEX_BTREE_BLOAT_SQL + """
-    ) SELECT * FROM qq
-) AS ibloat
-ON ibloat.schemaname = i.schemaname AND ibloat.tblname = i.tablename AND ibloat.idxname = i.indexname
 WHERE i.schemaname = '{schema}'
 {table_filter}
 ORDER BY 1,2
 """  # noqa
 
 
-def get_postgres(app_config, database):
+def get_postgres(app, database):
     '''
     Same as `app.postgres` but with specific database not the default one.
     '''
-    config = dict(**app_config.postgresql)
-    config.update(dbname=database)
-    return Postgres(**config)
+    return app.postgres.copy(dbname=database, app=None)
 
 
 def get_instance(conn):
@@ -308,25 +276,45 @@ def get_database_size(conn):
     """)
 
 
-def get_database(conn):
-    return conn.queryone("""
+def bloat_columns(prefix, sizes):
+    # Sum bloat sizes from BloatCache into _bytes and _size columns, null if
+    # relations are not estimated.
+    sizes = [s for s in sizes if s is not None]
+    total = sum(sizes) if sizes else None
+    return {
+        prefix + '_bytes': total,
+        prefix + '_size': size_pretty(total),
+    }
+
+
+def get_database(conn, cache):
+    row = dict(conn.queryone("""
     SELECT SUM(n_tables) AS n_tables,
         SUM(tables_bytes) as tables_bytes,
         pg_size_pretty(SUM(tables_bytes)) AS tables_size,
         SUM(n_indexes) AS n_indexes,
         SUM(indexes_bytes) AS indexes_bytes,
         pg_size_pretty(SUM(indexes_bytes)) AS indexes_size,
-        SUM(tables_bloat_bytes) AS tables_bloat_bytes,
-        pg_size_pretty(SUM(tables_bloat_bytes)::bigint) AS tables_bloat_size,
-        SUM(indexes_bloat_bytes) AS indexes_bloat_bytes,
-        pg_size_pretty(SUM(indexes_bloat_bytes)::bigint) AS indexes_bloat_size,
         SUM(toast_bytes) AS toast_bytes,
         pg_size_pretty(SUM(toast_bytes)::bigint) AS toast_size
-    FROM (%s) a""" % SCHEMAS_SQL)
-
-
-def get_schemas(conn):
-    return list(conn.query(SCHEMAS_SQL))
+    FROM (%s) a""" % SCHEMAS_SQL))
+    row.update(bloat_columns('tables_bloat', cache.tables().values()))
+    row.update(bloat_columns('indexes_bloat', cache.indexes().values()))
+    return row
+
+
+def get_schemas(conn, cache):
+    tables = cache.tables()
+    indexes = cache.indexes()
+    schemas = []
+    for row in conn.query(SCHEMAS_SQL):
+        row = dict(row)
+        row.update(bloat_columns('tables_bloat', [
+            v for k, v in tables.items() if k[0] == row['name']]))
+        row.update(bloat_columns('indexes_bloat', [
+            v for k, v in indexes.items() if k[0] == row['name']]))
+        schemas.append(row)
+    return schemas
 
 
 def get_schema(conn, schema):
@@ -346,7 +334,15 @@ def get_schema(conn, schema):
         return {}
 
 
-def get_tables(conn, schema):
+def add_table_bloat(row, tables, indexes):
+    # Add bloat columns of table row from BloatCache estimation.
+    row.update(bloat_columns('bloat', [tables.get(row['name'])]))
+    row.update(bloat_columns('index_bloat', [
+        v for k, v in indexes.items() if k[0] == row['name']]))
+    return row
+
+
+def get_tables(conn, schema, cache):
     # taken from https://wiki.postgresql.org/wiki/Disk_Usage
     query = """
 SELECT table_name AS name,
@@ -359,10 +355,6 @@ SELECT table_name AS name,
        pg_size_pretty(index_bytes) AS index_size,
        pg_size_pretty(toast_bytes) AS toast_size,
        pg_size_pretty(table_bytes) AS table_size,
-       tbloat.bloat_size AS bloat_bytes,
-       pg_size_pretty(tbloat.bloat_size::bigint) AS bloat_size,
-       ibloat.bloat_size AS index_bloat_bytes,
-       pg_size_pretty(ibloat.bloat_size::bigint) AS index_bloat_size,
        row_estimate
 FROM (
   SELECT *, total_bytes - index_bytes - toast_bytes AS table_bytes
@@ -384,43 +376,45 @@ LEFT JOIN (
   GROUP BY tablename
 ) AS indexes
 ON indexes.tablename = table_name
-JOIN (
-  """ + TABLE_BLOAT_SQL + """
-) AS tbloat
-ON tbloat.schemaname = table_schema AND tbloat.tblname = table_name
-LEFT JOIN (
-  SELECT SUM(bloat_size) AS bloat_size,
-         schemaname,
-         tblname
-  FROM (
-    """ + INDEX_BTREE_BLOAT_SQL + """
-  ) AS a
-  GROUP BY schemaname, tblname
-) AS ibloat
-ON ibloat.schemaname = table_schema AND ibloat.tblname = table_name
 WHERE table_schema = '{schema}';
     """ # noqa
+    tables = {k[1]: v for k, v in cache.tables(schema).items()}
+    indexes = {k[1:]: v for k, v in cache.indexes(schema).items()}
     return {
-        'tables': list(conn.query(query.format(schema=schema)))
+        'tables': [
+            add_table_bloat(dict(row), tables, indexes)
+            for row in conn.query(query.format(schema=schema))
+        ]
     }
 
 
-def get_schema_indexes(conn, schema):
-    return {'indexes': list(conn.query(
+def add_index_bloat(rows, indexes):
+    # Add bloat columns of index rows from BloatCache estimation.
+    for row in rows:
+        row = dict(row)
+        row.update(bloat_columns('bloat', [
+            indexes.get((row['tablename'], row['name']))]))
+        yield row
+
+
+def get_schema_indexes(conn, schema, cache):
+    indexes = {k[1:]: v for k, v in cache.indexes(schema).items()}
+    return {'indexes': list(add_index_bloat(conn.query(
         INDEXES_SQL.format(schema=schema, table_filter='')
-    ))}
+    ), indexes))}
 
 
-def get_table_indexes(conn, schema, table):
-    return {'indexes': list(conn.query(
+def get_table_indexes(conn, schema, table, cache):
+    indexes = {k[1:]: v for k, v in cache.indexes(schema, table).items()}
+    return {'indexes': list(add_index_bloat(conn.query(
         INDEXES_SQL.format(
             schema=schema,
             table_filter="AND i.tablename = '%s'" % table
         )
-    ))}
+    ), indexes))}
 
 
-def get_table(conn, schema, table):
+def get_table(conn, schema, table, cache):
     query = """
 SELECT table_name AS name,
        total_bytes,
@@ -432,10 +426,6 @@ SELECT table_name AS name,
        pg_size_pretty(toast_bytes) AS toast_size,
        pg_size_pretty(table_bytes) AS table_size,
        pg_stat_all_tables.*,
-       tbloat.bloat_size AS bloat_bytes,
-       pg_size_pretty(tbloat.bloat_size::bigint) AS bloat_size,
-       ibloat.bloat_size AS index_bloat_bytes,
-       pg_size_pretty(ibloat.bloat_size::bigint) AS index_bloat_size,
        row_estimate,
        fillfactor
 FROM (
@@ -452,26 +442,15 @@ FROM (
     WHERE relkind = 'r'
   ) a
 ) a
-JOIN (
-  """ + TABLE_BLOAT_SQL + """
-) AS tbloat
-ON tbloat.schemaname = table_schema AND tbloat.tblname = table_name
-LEFT JOIN (
-  SELECT SUM(bloat_size) AS bloat_size,
-         schemaname,
-         tblname
-  FROM (
-    """ + INDEX_BTREE_BLOAT_SQL + """
-  ) AS a
-  GROUP BY schemaname, tblname
-) AS ibloat
-ON ibloat.schemaname = table_schema AND ibloat.tblname = table_name
 JOIN pg_stat_all_tables
 ON relname = table_name
 WHERE table_schema = '{schema}'
 AND table_name = '{table}';
     """
-    return dict(conn.queryone(query.format(schema=schema, table=table)))
+    row = conn.queryone(query.format(schema=schema, table=table))
+    tables = {k[1]: v for k, v in cache.tables(schema, table).items()}
+    indexes = {k[1:]: v for k, v in cache.indexes(schema, table).items()}
+    return add_table_bloat(dict(row), tables, indexes)
 
 
 def check_table_exists(conn, schema, table):
@@ -1,21 +1,25 @@
 from datetime import datetime
+import os
 import time
 import logging
-import json
 
-from ...toolkit import taskmanager
 from ...routing import RouteSet
 from ...toolkit.configuration import OptionSpec
+from ...toolkit.services import Service
 from ...toolkit.validators import commalist
-from ...tools import now, validate_parameters
+from ...tools import RawJSON, hash_etag, now, validate_parameters
 from ...inventory import SysInfo
 from ... import __version__ as __VERSION__
 from ...errors import HTTPError as TemboardHTTPError
 from ...postgres import ConnectionPool
+from ... import dbsize, storage
+from ..maintenance import bloat
 
 from . import db
 from .inventory import host_info, instance_info
 from .probes import (
+    DeltaStore,
+    due_probes,
     load_probes,
     probe_bgwriter,
     probe_blocks,
@@ -40,11 +44,11 @@ from .probes import (
 from .output import remove_passwords
 
 logger = logging.getLogger(__name__)
-workers = taskmanager.WorkerSet()
 routes = RouteSet(prefix=b'/monitoring')
 
 T_TIMESTAMP_UTC = b'(^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}Z$)'
 T_LIMIT = b'(^[0-9]+$)'
+T_CURSOR = b'(^[0-9]+$)'
 
 
 @routes.get(b'/probe/sessions', check_key=True)
@@ -158,12 +162,15 @@ def api_run_probe(probe_instance, config):
     )
     sysinfo = SysInfo()
     hostname = sysinfo.hostname(config.temboard.hostname)
+    store = DeltaStore(config.temboard.home)
     with ConnectionPool(**conninfo) as pool:
         instance = instance_info(pool, conninfo, hostname)
-        # Set home path
-        probe_instance.set_home(config.temboard.home)
+        probe_instance.set_store(store)
         # Gather the data from probes
-        return run_probes([probe_instance], pool, [instance], delta=False)
+        output, _ = run_probes(
+            [probe_instance], pool, [instance], delta=False)
+    store.flush()
+    return output
 
 
 @routes.get(b'/history', check_key=True)
@@ -176,6 +183,11 @@ def get_monitoring(http_context, app):
     returned records to N, the query parameter 'limit' can be used and set to
     N. 'limit' default value is 50, meaning that the maximum number of record
     set this API returns by default is 50.
+
+    With the query parameter 'since', records are returned in an object with
+    their cursor: {"cursor": N, "metrics": [...]}. Only records following
+    'since' cursor are returned. Pass the returned cursor as 'since' on next
+    call, and to POST /monitoring/history/ack once records are stored.
     """
 
     # Default values
@@ -204,17 +216,60 @@ def get_monitoring(http_context, app):
         ])
         limit = int(http_context['query']['limit'][0])
 
-    return [
-        json.loads(metric[1]) for metric in db.get_metrics(
+    if 'since' in http_context['query']:
+        validate_parameters(http_context['query'], [
+            ('since', T_CURSOR, True),
+        ])
+        since = int(http_context['query']['since'][0])
+        return get_monitoring_since(app, since, limit)
+
+    # Stored metrics are already JSON, send them as is.
+    return (
+        RawJSON(metric[1]) for metric in db.get_metrics(
             app.config.temboard.home,
             'monitoring.db',
             start_timestamp=start_timestamp,
             limit=limit
         )
-    ]
+    )
+
+
+def get_monitoring_since(app, since, limit):
+    home = app.config.temboard.home
+    if since > db.get_last_cursor(home, 'monitoring.db'):
+        # Cursor from a previous history, e.g. agent has been reinstalled.
+        logger.warning("Unknown history cursor %s. Sending all.", since)
+        since = 0
+    cursor = db.get_cursor(home, 'monitoring.db', since, limit)
+    if cursor is None:
+        # No new metrics.
+        cursor = since
 
+    return dict(
+        cursor=cursor,
+        metrics=(
+            RawJSON(data) for data, in db.get_metrics_between(
+                home, 'monitoring.db', since, cursor)
+        ),
+    )
 
-@routes.get(b'/config', check_key=True)
+
+@routes.post(b'/history/ack', check_key=True)
+def post_monitoring_ack(http_context, app):
+    """Delete metrics delivered up to 'cursor' of POST body."""
+    post = http_context['post']
+    validate_parameters(post, [('cursor', T_CURSOR, False)])
+    cursor = int(post['cursor'])
+    deleted = db.ack_metrics(app.config.temboard.home, 'monitoring.db', cursor)
+    logger.debug("Deleted %s metrics up to cursor %s.", deleted, cursor)
+    return dict(cursor=cursor, deleted=deleted)
+
+
+def config_etag(http_context, app):
+    return hash_etag(sorted(app.config.monitoring.items()))
+
+
+@routes.get(b'/config', check_key=True, etag=config_etag)
 def get_config(http_context, app):
     """Returns monitoring plugin configuration.
     """
@@ -224,14 +279,23 @@ def get_config(http_context, app):
     )
 
 
-@workers.register(pool_size=1)
-def monitoring_collector_worker(app):
-    """
-    Run probes and push collected metrics in a queue.
-    """
-    logger.info("Starting monitoring collector.")
-    config = app.config
-    conninfo = dict(
+def probe_intervals(raw):
+    # Parse comma separated list of probe:seconds.
+    if isinstance(raw, dict):
+        return raw
+    intervals = {}
+    for item in raw.split(','):
+        if not item.strip():
+            continue
+        name, sep, seconds = item.partition(':')
+        if not sep:
+            raise ValueError("Missing interval of probe %s." % name.strip())
+        intervals[name.strip()] = int(seconds)
+    return intervals
+
+
+def collector_conninfo(config):
+    return dict(
         host=config.postgresql.host,
         port=config.postgresql.port,
         user=config.postgresql.user,
@@ -241,17 +305,39 @@ def monitoring_collector_worker(app):
         instance=config.postgresql.instance,
     )
 
+
+def collect(app, pool, conninfo, store, history):
+    # history maps probe names to time and output of their last complete
+    # run. Output of probes not due is carried forward from history.
+    logger.info("Starting monitoring collector.")
+    config = app.config
+
     logger.info("Gathering host information.")
     system_info = host_info(config.temboard.hostname)
     logger.info("Load the probes to run.")
-    probes = load_probes(
-        config.monitoring,
-        config.temboard.home
+    probes = load_probes(config.monitoring, store)
+    start = time.time()
+    due = due_probes(
+        probes, config.monitoring,
+        dict((name, last[0]) for name, last in history.items()),
+        start,
     )
 
-    with ConnectionPool(**conninfo) as pool:
-        instance = instance_info(pool, conninfo, system_info['hostname'])
-        data = run_probes(probes, pool, [instance])
+    instance = instance_info(pool, conninfo, system_info['hostname'])
+    data, completed = run_probes(
+        due, pool, [instance],
+        parallelism=config.monitoring.parallelism,
+        timeout=(
+            config.monitoring.collect_timeout or
+            config.monitoring.scheduler_interval),
+    )
+    # Probes skipped or canceled on some database run again on next collect.
+    for name in completed:
+        history[name] = (start, data[name])
+    for p in probes:
+        name = p.get_name()
+        if name not in data and name in history:
+            data[name] = history[name][1]
 
     # Prepare and send output
     output = dict(
@@ -262,12 +348,16 @@ def monitoring_collector_worker(app):
         version=__VERSION__,
     )
     logger.info("Add data to metrics table.")
-    db.add_metric(
-        config.temboard.home,
-        'monitoring.db',
-        time.time(),
-        output
-    )
+    # Store last measures and metrics in a single commit.
+    with storage.transaction(
+            os.path.join(config.temboard.home, 'monitoring.db')):
+        store.flush()
+        db.add_metric(
+            config.temboard.home,
+            'monitoring.db',
+            time.time(),
+            output
+        )
 
     logger.info("Collect done.")
 
@@ -284,6 +374,59 @@ def monitoring_collector_worker(app):
         logger.exception("Failed to log metrics.")
 
 
+class CollectorService(Service):
+    # Long-lived process running probes every scheduler_interval seconds.
+    # Unlike a scheduled worker, the service keeps connections to databases
+    # between runs, up to monitoring.max_connections, last measures of
+    # delta probes and last output of probes in memory.
+
+    def setup(self):
+        self.store = DeltaStore(self.app.config.temboard.home)
+        self.history = {}
+        self.pool = None
+        self.conninfo = None
+        self.next_run = time.time()
+
+    def serve1(self):
+        config = self.app.config.monitoring
+        delay = self.next_run - time.time()
+        if delay > 0:
+            # Sleep by small steps to handle signals.
+            time.sleep(min(delay, 1))
+            return
+
+        conninfo = collector_conninfo(self.app.config)
+        if conninfo != self.conninfo:
+            # First run or configuration reloaded.
+            self.close_pool()
+            self.conninfo = conninfo
+            # 0 keeps one connection per monitored database.
+            self.pool = ConnectionPool(
+                max_connections=config.max_connections or None, **conninfo)
+
+        self.next_run += config.scheduler_interval
+        if self.next_run < time.time():
+            # Late, don't try to catch up.
+            self.next_run = time.time() + config.scheduler_interval
+
+        try:
+            collect(
+                self.app, self.pool, conninfo, self.store, self.history)
+        except Exception:
+            logger.exception("Failed to collect monitoring data.")
+            # Connections may be broken, e.g. on Postgres restart.
+            self.close_pool()
+        else:
+            # Forget databases not probed for a while.
+            self.pool.evict_idle(3 * config.scheduler_interval)
+
+    def close_pool(self):
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+            self.conninfo = None
+
+
 def iter_metrics_for_logfmt(data):
     # Generates a flat sequence of record dict containing key value for logfmt
     # printing. See perfui/ in temboard project to analyze such data.
@@ -313,6 +456,15 @@ class MonitoringPlugin:
         OptionSpec(s, 'dbnames', default='*', validator=commalist),
         OptionSpec(s, 'scheduler_interval', default=60, validator=int),
         OptionSpec(s, 'probes', default='*', validator=commalist),
+        OptionSpec(s, 'max_connections', default=0, validator=int),
+        OptionSpec(s, 'parallelism', default=4, validator=int),
+        OptionSpec(s, 'collect_timeout', default=0, validator=int),
+        OptionSpec(
+            s, 'probe_intervals', default={}, validator=probe_intervals),
+        OptionSpec(s, 'db_size_max_age', default=300, validator=int),
+        OptionSpec(s, 'db_size_budget', default=10., validator=float),
+        OptionSpec(
+            s, 'db_size_method', default='exact', validator=dbsize.method),
     ]
     del s
 
@@ -322,22 +474,21 @@ class MonitoringPlugin:
 
     def bootstrap(self):
         db.bootstrap(self.app.config.temboard.home, 'monitoring.db')
+        bloat.bootstrap(self.app.config.temboard.home)
+        dbsize.bootstrap(self.app.config.temboard.home)
 
     def load(self):
         self.app.router.add(routes)
-        self.app.worker_pool.add(workers)
+
+    def services(self, setproctitle):
         logger.debug(
-            "Schedule metric collect every %s seconds.",
+            "Collect metrics every %s seconds.",
             self.app.config.monitoring.scheduler_interval,
         )
-        workers.schedule(
-            id='monitoring_collector',
-            redo_interval=self.app.config.monitoring.scheduler_interval,
-        )(monitoring_collector_worker)
-        self.app.scheduler.add(workers)
+        yield CollectorService(
+            app=self.app, name='monitoring collector',
+            setproctitle=setproctitle)
 
     def unload(self):
-        self.app.scheduler.remove(workers)
-        self.app.worker_pool.remove(workers)
         self.app.router.remove(routes)
         self.app.config.remove_specs(self.option_specs)
@@ -1,9 +1,9 @@
 import json
 import os
-import sqlite3
 from textwrap import dedent
 from time import time as current_time
 
+from ... import storage
 from ...tools import JSONEncoder
 
 
@@ -16,10 +16,11 @@ def bootstrap(path, dbname):
     delta values with potentially old data resulting with outliers.
 
     metrics table is used to queued collected data before they are pushed to
-    temboard server.
+    temboard server. seq is a cursor for temboard server to pull new metrics
+    and acknowledge delivered ones.
     """
 
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
+    with storage.transaction(os.path.join(path, dbname)) as conn:
         c = conn.cursor()
         c.execute("DROP TABLE IF EXISTS last_measures")
         c.execute(
@@ -31,25 +32,37 @@ def bootstrap(path, dbname):
                 )
             """)
         )
+        columns = [
+            row[1] for row in c.execute("PRAGMA table_info(metrics)")]
+        upgrade = columns and 'seq' not in columns
+        if upgrade:
+            c.execute("ALTER TABLE metrics RENAME TO metrics_old")
         c.execute(
             dedent("""
                 CREATE TABLE IF NOT EXISTS metrics (
-                    time REAL PRIMARY KEY,
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    time REAL UNIQUE,
                     data TEXT
                 )
             """)
         )
+        if upgrade:
+            c.execute(
+                "INSERT INTO metrics (time, data) "
+                "SELECT time, data FROM metrics_old ORDER BY time"
+            )
+            c.execute("DROP TABLE metrics_old")
 
 
 def add_metric(path, dbname, time, data):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
+    with storage.transaction(os.path.join(path, dbname)) as conn:
         c = conn.cursor()
         c.execute(
-            "INSERT INTO metrics VALUES(?, ?)",
+            "INSERT INTO metrics (time, data) VALUES(?, ?)",
             (time, json.dumps(data, cls=JSONEncoder))
         )
-        # When data are pulled from temboard server, we need to keep 6 hours of
-        # data history for recovery.
+        # When data are pulled from temboard server without acknowledgement,
+        # we need to keep 6 hours of data history for recovery.
         time_limit = current_time() - (60 * 60 * 6)
         c.execute(
             "DELETE FROM metrics WHERE time < ?",
@@ -58,7 +71,7 @@ def add_metric(path, dbname, time, data):
 
 
 def delete_metric(path, dbname, time):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
+    with storage.transaction(os.path.join(path, dbname)) as conn:
         c = conn.cursor()
         c.execute(
             "DELETE FROM metrics WHERE time = ?",
@@ -84,33 +97,62 @@ def get_metrics(path, dbname, limit=50, start_timestamp=None):
         query += " LIMIT ?"
         args += (limit,)
 
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
-        c = conn.cursor()
-        c.execute(query, args)
-        return c.fetchall()
-
-
-def get_last_measure(path, dbname, key):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
-        c = conn.cursor()
-        c.execute(
-            "SELECT time, data FROM last_measures WHERE key = ?",
-            (key,)
-        )
-        return c.fetchone()
-
-
-def upsert_last_measure(path, dbname, time, key, data):
-    with sqlite3.connect(os.path.join(path, dbname)) as conn:
-        c = conn.cursor()
-        try:
-            c.execute(
-                "INSERT INTO last_measures VALUES(?, ?, ?)",
+    # Yield rows as they are read, to stream large history.
+    conn = storage.connect(os.path.join(path, dbname))
+    yield from conn.execute(query, args)
+
+
+def get_cursor(path, dbname, since, limit=50):
+    # Returns the cursor of the last of limit metrics following since cursor,
+    # or None if there is no new metrics.
+    conn = storage.connect(os.path.join(path, dbname))
+    row = conn.execute(
+        "SELECT MAX(seq) FROM ("
+        "SELECT seq FROM metrics WHERE seq > ? ORDER BY seq LIMIT ?)",
+        (since, limit or -1)
+    ).fetchone()
+    return row[0]
+
+
+def get_last_cursor(path, dbname):
+    # Returns the last cursor ever assigned, even if metric is deleted.
+    conn = storage.connect(os.path.join(path, dbname))
+    row = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'metrics'"
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def get_metrics_between(path, dbname, since, until):
+    # Yield data of metrics with cursor in ]since, until], in order.
+    conn = storage.connect(os.path.join(path, dbname))
+    yield from conn.execute(
+        "SELECT data FROM metrics WHERE seq > ? AND seq <= ? ORDER BY seq",
+        (since, until)
+    )
+
+
+def ack_metrics(path, dbname, cursor):
+    # Delete metrics delivered up to cursor. Returns the number of deleted
+    # metrics.
+    with storage.transaction(os.path.join(path, dbname)) as conn:
+        return conn.execute(
+            "DELETE FROM metrics WHERE seq <= ?", (cursor,)).rowcount
+
+
+def get_last_measures(path, dbname):
+    conn = storage.connect(os.path.join(path, dbname))
+    return conn.execute(
+        "SELECT time, key, data FROM last_measures").fetchall()
+
+
+def upsert_last_measures(path, dbname, measures):
+    # measures is a list of (time, key, data) tuples.
+    with storage.transaction(os.path.join(path, dbname)) as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO last_measures VALUES(?, ?, ?)",
+            [
                 (time, key, json.dumps(data, cls=JSONEncoder))
-            )
-        except sqlite3.IntegrityError:
-            c.execute(
-                "UPDATE last_measures SET time = ?, data = ? "
-                "WHERE key = ?",
-                (time, json.dumps(data, cls=JSONEncoder), key)
-            )
+                for time, key, data in measures
+            ]
+        )
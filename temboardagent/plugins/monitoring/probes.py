@@ -1,24 +1,34 @@
 import logging
 import re
 import os
+import threading
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor, wait
 from contextlib import closing
 
 import psycopg2
 from psycopg2.extensions import parse_dsn
 from psycopg2.extras import PhysicalReplicationConnection
 
+from ...dbsize import SizeCache
+from ...instrumentation import Histogram
 from ...inventory import SysInfo
-from ...plugins.maintenance.functions import INDEX_BTREE_BLOAT_SQL
+from ...plugins.maintenance.bloat import BloatCache
+from ...postgres import Postgres, statement_timeout
 
 from . import db
 
 
 logger = logging.getLogger(__name__)
 
+PROBE_DURATION = Histogram(
+    'temboard_monitoring_probe_duration_seconds',
+    "Time to run a monitoring probe.",
+    labels=('probe',))
 
-def load_probes(options, home):
+
+def load_probes(options, store):
     """Give a list of probe objects, ready to run."""
 
     # All probes classes names start with "probe_", search for
@@ -31,24 +41,56 @@ def load_probes(options, home):
            and issubclass(globals()[c], Probe) \
            and (m.group(1) in options['probes'] or '*' in options['probes']):
             o = eval(c + "(options)")
-            o.set_home(home)
+            o.set_store(store)
             probes.append(o)
             logger.debug("Loaded probe: %s.", o.get_name())
 
     return probes
 
 
-def run_probes(probes, pool, instances, delta=True):
-    """Execute the probes."""
+def due_probes(probes, options, history, now):
+    """Select probes to run now.
+
+    history maps probe names to time of their last run. Probes are due
+    half a scheduler interval in advance, to absorb scheduling jitter.
+    """
+    slack = options['scheduler_interval'] / 2
+    due = []
+    for p in probes:
+        interval = options['probe_intervals'].get(
+            p.get_name(), p.interval or options['scheduler_interval'])
+        last = history.get(p.get_name())
+        if last is None or now - last + slack >= interval:
+            due.append(p)
+    return due
+
+
+def run_probes(probes, pool, instances, delta=True, parallelism=1,
+               timeout=None):
+    """Execute the probes.
+
+    Databases are probed concurrently by parallelism threads. After timeout
+    seconds, running queries are canceled and remaining databases are
+    skipped.
 
+    Returns output by probe name and the set of names of probes completed
+    on all their databases.
+    """
+
+    deadline = time.time() + timeout if timeout else None
     now = pool.get().query_scalar("SELECT NOW()")
     logger.info("Running probes at %s.", now.isoformat())
     # Output is a mapping of probe names with lists. Each probe returns
     # a list of dicts(metric -> value).
     output = {}
+    completed = set()
 
+    # First, select probes to run, and on which databases. Plain SQL probes
+    # sharing a connection and a timeout are batched in a single query.
+    selected = []
+    batches = {}
+    databases = {}
     for p in probes:
-        out = []
         if delta is False:
             p.delta_key = None
             p.delta_columns = None
@@ -57,47 +99,208 @@ def run_probes(probes, pool, instances, delta=True):
         if p.level == 'host':
             if not p.check():
                 continue
-            logger.info("Running host probe %s.", p.get_name())
-            try:
-                out = p.run()
-            except Exception as e:
-                logger.error("Probe failure: %s", e)
-                continue
+            selected.append((p, None))
+            continue
 
-        else:
-            if p.level not in ('instance', 'database'):
-                raise Exception("Unknown probe level: %s", p.level)
+        if p.level not in ('instance', 'database'):
+            raise Exception("Unknown probe level: %s", p.level)
 
-            i, = instances  # We are now mono-instance
-            if not i['available']:
-                continue
-
-            if not p.check(i['version_num']):
-                logger.warning(
-                    "Unsupported PostgreSQL version for probe %s.",
-                    p.get_name())
-                continue
+        i, = instances  # We are now mono-instance
+        if not i['available']:
+            continue
 
-            logger.info("Running %s probe %s.", p.level, p.get_name())
-            if p.level == 'instance':
-                dbnames = [i['database']]
-            else:
-                dbnames = [db['dbname'] for db in i['dbnames']]
+        if not p.check(i['version_num']):
+            logger.warning(
+                "Unsupported PostgreSQL version for probe %s.",
+                p.get_name())
+            continue
 
+        if p.level == 'instance':
+            dbnames = [i['database']]
+        else:
+            dbnames = [db['dbname'] for db in i['dbnames']]
+        selected.append((p, dbnames))
+
+        for dbname in dbnames:
+            databases.setdefault(dbname, []).append(p)
+            if p.can_batch(i):
+                batches.setdefault((dbname, p.timeout), []).append(p)
+
+    if pool.max_connections:
+        # Ensure a connection is always available for each thread.
+        parallelism = min(parallelism, pool.max_connections)
+    executor = ThreadPoolExecutor(
+        max_workers=parallelism, thread_name_prefix='probes')
+    expired = threading.Event()
+    # Connections of databases being probed.
+    running = {}
+    futures = []
+    for dbname, db_probes in databases.items():
+        db_batches = [
+            batch for (batch_dbname, _), batch in batches.items()
+            if batch_dbname == dbname and len(batch) > 1
+        ]
+        futures.append(executor.submit(
+            run_database_probes, pool, dict(i, dbname=dbname),
+            db_batches, db_probes, expired, running,
+        ))
+
+    # Run host probes while databases are probed.
+    rows = {}
+    durations = {}
+    for p, dbnames in selected:
+        if dbnames is not None:
+            continue
+        start = time.time()
+        logger.info("Running host probe %s.", p.get_name())
+        try:
+            rows[p, None] = p.run()
+        except Exception as e:
+            logger.error("Probe failure: %s", e)
+            continue
+        durations[p] = time.time() - start
+
+    remaining = deadline - time.time() if deadline else None
+    _, not_done = wait(futures, timeout=remaining)
+    if not_done:
+        logger.warning(
+            "Probes timed out, skipping %d database(s).", len(not_done))
+        expired.set()
+        for future in not_done:
+            future.cancel()
+        # Cancel running queries, until all threads see expired event.
+        while not all(future.done() for future in futures):
+            for conn in list(running.values()):
+                conn.cancel()
+            wait(futures, timeout=1)
+    executor.shutdown(wait=True)
+
+    for future in futures:
+        if future.cancelled():
+            continue
+        try:
+            db_rows, db_durations = future.result()
+        except Exception as e:
+            # Keep rows of other databases.
+            logger.error("Failed to probe database: %s", e)
+            continue
+        rows.update(db_rows)
+        for p, duration in db_durations.items():
+            durations[p] = durations.get(p, 0) + duration
+
+    for p, dbnames in selected:
+        if dbnames is None:
+            if (p, None) not in rows:
+                continue
+            out = rows[p, None]
+            completed.add(p.get_name())
+        else:
+            out = []
             for dbname in dbnames:
-                conninfo = dict(i, dbname=dbname)
-                try:
-                    out += p.run(pool.get(dbname=dbname), conninfo)
-                except Exception as e:
-                    logger.error("Probe failure: %s", e)
-                    raise
-                    continue
+                out += rows.get((p, dbname), [])
+            if all((p, dbname) in rows for dbname in dbnames):
+                completed.add(p.get_name())
 
         for record in out:
             record['datetime'] = now
         output[p.get_name()] = out
+        PROBE_DURATION.observe(durations.get(p, 0), p.get_name())
 
     logger.info("Finished probes run.")
+    return output, completed
+
+
+def run_database_probes(pool, conninfo, batches, probes, expired, running):
+    # Run probes on a single database, in a thread. Returns rows and
+    # durations by probe. Stops as soon as expired event is set, discarding
+    # rows of the query running at expiration: probes may swallow its
+    # cancellation and return partial rows. The connection is registered in
+    # running mapping while probes run, to allow canceling the running
+    # query.
+    dbname = conninfo['dbname']
+    rows = {}
+    durations = {}
+    with pool.borrow(dbname) as conn:
+        running[dbname] = conn
+        try:
+            for batch in batches:
+                if expired.is_set():
+                    break
+                start = time.time()
+                logger.info(
+                    "Running probes %s on %s.",
+                    ', '.join(p.get_name() for p in batch), dbname)
+                batch_rows = run_sql_batch(batch, conn, conninfo)
+                if expired.is_set():
+                    break
+                rows.update(batch_rows)
+                for p in batch:
+                    # Batched probes share the duration of the batch.
+                    durations[p] = time.time() - start
+
+            for p in probes:
+                if expired.is_set():
+                    break
+                if (p, dbname) in rows:
+                    continue
+                start = time.time()
+                logger.info(
+                    "Running %s probe %s on %s.", p.level, p.get_name(),
+                    dbname)
+                try:
+                    out = p.run(conn, conninfo)
+                except Exception as e:
+                    # Including query canceled on deadline. Skip the probe
+                    # and keep rows of previous probes.
+                    logger.error(
+                        "Probe %s failed on %s: %s", p.get_name(), dbname, e)
+                    continue
+                if expired.is_set():
+                    break
+                rows[p, dbname] = out
+                durations[p] = time.time() - start
+        finally:
+            del running[dbname]
+    return rows, durations
+
+
+def run_sql_batch(probes, conn, conninfo):
+    # Run SQL probes in a single round-trip. Rows of each probe are
+    # aggregated as a JSON array in a column of a single row result.
+    #
+    # Returns rows by probe and database. Returns nothing if the batch fails,
+    # to let probes run one by one and isolate the failing one.
+    database = conninfo['dbname']
+    columns = [
+        "(SELECT coalesce(json_agg(q), '[]') FROM (\n%s\n) AS q) AS p%d" % (
+            p.sql.strip().rstrip(';'), n)
+        for n, p in enumerate(probes)
+    ]
+    sql = "-- probes %s\nSELECT\n%s" % (
+        ', '.join(p.get_name() for p in probes),
+        ',\n'.join(columns),
+    )
+    try:
+        with statement_timeout(conn, probes[0].timeout or None):
+            row = conn.queryone(sql)
+    except Exception as e:
+        logger.error(
+            "Unable to run batch of probes on \"%s\" on database \"%s\": "
+            "%s", conninfo['instance'], database, e,
+        )
+        return {}
+
+    output = {}
+    for n, p in enumerate(probes):
+        try:
+            output[p, database] = p.process_rows(conninfo, row['p%d' % n])
+        except Exception as e:
+            logger.error(
+                "Unable to run probe \"%s\" on \"%s\" on database \"%s\": "
+                "%s", p.get_name(), conninfo['instance'], database, e,
+                exc_info=True,
+            )
+            output[p, database] = []
     return output
 
 
@@ -184,16 +387,51 @@ def get_primary_conninfo(conn):
     return parse_primary_conninfo(pci)
 
 
+class DeltaStore:
+    """Last measures of probes computing delta, by key.
+
+    Measures are loaded from SQLite once, kept in memory, and written back in
+    a single transaction by flush(). Each key is accessed by a single thread
+    at a time.
+    """
+
+    def __init__(self, home, dbname='monitoring.db'):
+        self.home = home
+        self.dbname = dbname
+        self.measures = dict(
+            (key, dict(time=time, data=json.loads(data)))
+            for time, key, data in db.get_last_measures(home, dbname)
+        )
+        # Measures updated since last flush.
+        self.dirty = {}
+
+    def get(self, key):
+        return self.measures.get(key)
+
+    def set(self, key, time, data):
+        self.measures[key] = self.dirty[key] = dict(time=time, data=data)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        db.upsert_last_measures(self.home, self.dbname, [
+            (measure['time'], key, measure['data'])
+            for key, measure in dirty.items()
+        ])
+
+
 class Probe:
     """Base class for all plugins."""
     # At which level the information is gathered: host, instance or db
     level = None
     # Optionnal name of the probe
     name = None
-    # Previous measures used for compute delta
-    last_measure = {}
-    last_measure_time = {}
-    home = None
+    # Seconds between two runs of the probe. None means each collect.
+    # Overridden by monitoring.probe_intervals.
+    interval = None
+    # DeltaStore of previous measures used to compute delta
+    store = None
 
     def __init__(self, options):
         pass
@@ -206,8 +444,8 @@ class Probe:
         """Returns the result."""
         pass
 
-    def set_home(self, home):
-        self.home = home
+    def set_store(self, store):
+        self.store = store
 
     def get_name(self):
         """Computes the name of the probe."""
@@ -224,22 +462,10 @@ class Probe:
         return None
 
     def get_last_measure(self, key):
-        row = db.get_last_measure(
-            self.home,
-            'monitoring.db',
-            key
-        )
-        if row:
-            return dict(time=row[0], data=json.loads(row[1]))
+        return self.store.get(key)
 
     def upsert_last_measure(self, time, key, data):
-        db.upsert_last_measure(
-            self.home,
-            'monitoring.db',
-            time,
-            key,
-            data
-        )
+        self.store.set(key, time, data)
 
     def delta(self, key, current_values):
         """
@@ -350,59 +576,66 @@ class SqlProbe(Probe):
 
         return True
 
+    def can_batch(self, conninfo):
+        """Whether the probe is a plain query, runnable with other probes."""
+        if self.sql is None:
+            return False
+        return not (self.no_standby and conninfo['standby'])
+
     def run_sql(self, conn, conninfo, sql):
         """Get the result of the SQL query"""
         if sql is None:
             return []
 
-        database = conninfo['dbname']
-
-        output = []
         try:
-            if self.timeout:
-                conn.execute(
-                    "SET statement_timeout = '%ss';", (self.timeout,))
-
-            cluster_name = conninfo['instance'].replace('/', '')
             sql = "-- probe %s\n%s" % (self, sql)
-            for r in conn.query(sql):
-                # Add the info of the instance (port) to the
-                # result to output one big list for all instances and
-                # all databases
-                r['port'] = conninfo['port']
-
-                # Compute delta if the probe needs that
-                if self.delta_columns is not None:
-                    to_delta = {}
-
-                    for k in self.delta_columns:
-                        if k in r.keys():
-                            to_delta[k] = r[k]
-
-                    # Create the store key for the delta
-                    if self.delta_key is not None:
-                        key = cluster_name + database + r[self.delta_key]
-                    else:
-                        key = cluster_name + database
-
-                    # Calculate delta
-                    (interval, deltas) = self.delta(key, to_delta)
-
-                    # The first time, no delta is returned
-                    if interval is None:
-                        continue
-
-                    # Merge result and add the interval column
-                    r.update(deltas)
-                    r[self.delta_interval_column] = interval
-
-                output.append(r)
+            with statement_timeout(conn, self.timeout or None):
+                return self.process_rows(conninfo, conn.query(sql))
         except Exception as e:
             logger.error(
                 "Unable to run probe \"%s\" on \"%s\" on database \"%s\": %s",
-                self.get_name(), conninfo['instance'], database, e,
+                self.get_name(), conninfo['instance'], conninfo['dbname'], e,
                 exc_info=True,
             )
+            return []
+
+    def process_rows(self, conninfo, rows):
+        """Compute deltas and add instance info to rows of the query."""
+        database = conninfo['dbname']
+        cluster_name = conninfo['instance'].replace('/', '')
+        output = []
+        for r in rows:
+            # Add the info of the instance (port) to the
+            # result to output one big list for all instances and
+            # all databases
+            r['port'] = conninfo['port']
+
+            # Compute delta if the probe needs that
+            if self.delta_columns is not None:
+                to_delta = {}
+
+                for k in self.delta_columns:
+                    if k in r.keys():
+                        to_delta[k] = r[k]
+
+                # Create the store key for the delta
+                if self.delta_key is not None:
+                    key = cluster_name + database + r[self.delta_key]
+                else:
+                    key = cluster_name + database
+
+                # Calculate delta
+                (interval, deltas) = self.delta(key, to_delta)
+
+                # The first time, no delta is returned
+                if interval is None:
+                    continue
+
+                # Merge result and add the interval column
+                r.update(deltas)
+                r[self.delta_interval_column] = interval
+
+            output.append(r)
         return output
 
     def run(self, conn, conninfo):
@@ -540,12 +773,34 @@ class probe_bgwriter(SqlProbe):
 
 
 class probe_db_size(SqlProbe):
+    # Sizes come from cache shared with dashboard, computed within
+    # db_size_budget seconds per run.
     level = 'instance'
-    sql = """select
-  datname as dbname,
-  pg_database_size(oid) as size
-from pg_database
-where datallowconn"""
+
+    def __init__(self, options):
+        self.options = options
+
+    def run(self, conn, conninfo):
+        cache = SizeCache(
+            self.store.home,
+            max_age=self.options['db_size_max_age'],
+            budget=self.options['db_size_budget'],
+            method=self.options['db_size_method'],
+        )
+        dbnames = [
+            row['datname'] for row in
+            conn.query("SELECT datname FROM pg_database WHERE datallowconn")
+        ]
+        sizes = cache.sizes(conn, Postgres(**conninfo), dbnames)
+        unknown = [dbname for dbname, size in sizes.items() if size is None]
+        if unknown:
+            logger.warning(
+                "Size of database(s) %s not known yet.", ', '.join(unknown))
+        return self.process_rows(conninfo, [
+            dict(dbname=dbname, size=size)
+            for dbname, size in sorted(sizes.items())
+            if size is not None
+        ])
 
 
 class probe_tblspc_size(SqlProbe):
@@ -568,24 +823,13 @@ class probe_cpu(HostProbe):
     hz = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
 
     def run(self):
-        to_delta = {}
-        stat = open('/proc/stat')
-        for line in stat:
-            cols = line.split()
-            if len(cols) == 0:
-                continue
-            if cols[0] == 'cpu':
-                # Convert values to int then in milliseconds,
-                to_delta = {
-                    'time_user': ((int(cols[1]) + int(cols[2])) * 1000 /
-                                  self.hz),
-                    'time_system': (int(cols[3]) + int(cols[6]) +
-                                    int(cols[7])) * 1000 / self.hz,
-                    'time_idle': int(cols[4]) * 1000 / self.hz,
-                    'time_iowait': int(cols[5]) * 1000 / self.hz,
-                    'time_steal': int(cols[8]) * 1000 / self.hz
-                }
-        stat.close()
+        stat = SysInfo().proc_stat()
+        # Convert clock ticks in milliseconds.
+        to_delta = dict(
+            (k, stat[k] * 1000 / self.hz)
+            for k in ('time_user', 'time_system', 'time_idle', 'time_iowait',
+                      'time_steal')
+        )
 
         # Compute deltas for values of /proc/stat since boot time
         (interval, metrics) = self.delta('global', to_delta)
@@ -608,21 +852,13 @@ class probe_process(HostProbe):
         # Process information is partly stored in /proc/stat, ctxt and
         # processes are ever incresing counters, compute deltas on
         # them.
-        to_delta = {}
-        stat = open('/proc/stat')
-        for line in stat:
-            cols = line.split()
-            if len(cols) == 0:
-                continue
-            if cols[0] == 'ctxt':
-                to_delta['context_switches'] = int(cols[1])
-            if cols[0] == 'processes':
-                to_delta['forks'] = int(cols[1])
-            if cols[0] == 'procs_running':
-                metrics['procs_running'] = int(cols[1])
-            if cols[0] == 'procs_blocked':
-                metrics['procs_blocked'] = int(cols[1])
-        stat.close()
+        stat = SysInfo().proc_stat()
+        to_delta = {
+            'context_switches': stat['ctxt'],
+            'forks': stat['processes'],
+        }
+        metrics['procs_running'] = stat['procs_running']
+        metrics['procs_blocked'] = stat['procs_blocked']
 
         # Total number of process is stored in /proc/loadavg
         load = open('/proc/loadavg')
@@ -679,53 +915,46 @@ class probe_loadavg(HostProbe):
 class probe_wal_files(SqlProbe):
     level = 'instance'
     min_version = 80200
+    no_standby = True
 
-    def run(self, conn, conninfo):
-        version = conn.server_version
-
-        if conninfo['standby']:
-            return []
+    def check(self, version):
+        if not super().check(version):
+            return False
 
-        metric = {
-            'port': conninfo['port']
-        }
         if version < 100000:
-            sql = """
+            self.sql = r"""
             SELECT count(s.f) AS total,
                    sum((pg_stat_file('pg_xlog/'||s.f)).size) AS total_size,
-                   pg_current_xlog_location() as current_location
+                   pg_current_xlog_location() as current_location,
+                   (SELECT count(a.f)
+                    FROM pg_ls_dir('pg_xlog/archive_status') AS a(f)
+                    WHERE f ~ E'\.ready$') AS archive_ready
             FROM pg_ls_dir('pg_xlog') AS s(f)
             WHERE f ~ E'^[0-9A-F]{24}$'
-            """
+            """  # noqa W605
         else:
-            sql = """
+            self.sql = r"""
             SELECT count(s.f) AS total,
                    sum((pg_stat_file('pg_wal/'||s.f)).size) AS total_size,
-                   pg_current_wal_lsn() as current_location
+                   pg_current_wal_lsn() as current_location,
+                   (SELECT count(a.f)
+                    FROM pg_ls_dir('pg_wal/archive_status') AS a(f)
+                    WHERE f ~ E'\.ready$') AS archive_ready
             FROM pg_ls_dir('pg_wal') AS s(f)
             WHERE f ~ E'^[0-9A-F]{24}$'
-            """
-        rows = self.run_sql(conn, conninfo, sql)
-
-        metric['total'] = rows[0]['total']
-        metric['total_size'] = rows[0]['total_size']
-        metric['current_location'] = rows[0]['current_location']
-
-        if version < 100000:
-            sql = r"""
-            SELECT count(s.f) AS archive_ready
-            FROM pg_ls_dir('pg_xlog/archive_status') AS s(f)
-            WHERE f ~ E'\.ready$'
-            """  # noqa W605
-        else:
-            sql = r"""
-            SELECT count(s.f) AS archive_ready
-            FROM pg_ls_dir('pg_wal/archive_status') AS s(f)
-            WHERE f ~ E'\.ready$'
             """  # noqa W605
-        rows = self.run_sql(conn, conninfo, sql)
 
-        metric['archive_ready'] = rows[0]['archive_ready']
+        return True
+
+    def process_rows(self, conninfo, rows):
+        row, = rows
+        metric = {
+            'port': conninfo['port'],
+            'total': row['total'],
+            'total_size': row['total_size'],
+            'current_location': row['current_location'],
+            'archive_ready': row['archive_ready'],
+        }
 
         # Calcutate the written size by using the delta between the
         # position between to runs. The current xlog location must be
@@ -862,82 +1091,45 @@ class probe_replication_connection(SqlProbe):
             return []
 
 
-class probe_heap_bloat(SqlProbe):
-    # Heap bloat estimation probe
-    # Query coming from https://github.com/ioguix/pgsql-bloat-estimation/
+class BloatProbe(SqlProbe):
+    # Bloat ratio of a database, from the estimation cache shared with
+    # maintenance plugin. Estimation queries come from
+    # https://github.com/ioguix/pgsql-bloat-estimation/ and run only when
+    # the cache is stale.
     level = 'database'
-    sql = """
-SELECT current_database() AS dbname,
-  SUM(bloat_size)::FLOAT/SUM(bs*tblpages)::FLOAT*100 AS ratio
-FROM (
-  SELECT
-  CASE WHEN tblpages - est_tblpages_ff > 0 THEN (tblpages-est_tblpages_ff)*bs ELSE 0 END AS bloat_size,
-  bs, tblpages
-  FROM (
-    SELECT
-      ceil( reltuples / ( (bs-page_hdr)*fillfactor/(tpl_size*100) ) ) + ceil( toasttuples / 4 ) AS est_tblpages_ff,
-      tblpages, bs
-    FROM (
-      SELECT
-        ( 4 + tpl_hdr_size + tpl_data_size + (2*ma)
-          - CASE WHEN tpl_hdr_size%ma = 0 THEN ma ELSE tpl_hdr_size%ma END
-          - CASE WHEN ceil(tpl_data_size)::int%ma = 0 THEN ma ELSE ceil(tpl_data_size)::int%ma END
-        ) AS tpl_size, bs - page_hdr AS size_per_block, (heappages + toastpages) AS tblpages, heappages,
-        toastpages, reltuples, toasttuples, bs, page_hdr, tblid, schemaname, tblname, fillfactor
-      FROM (
-        SELECT
-          tbl.oid AS tblid, ns.nspname AS schemaname, tbl.relname AS tblname,
-          tbl.reltuples, tbl.relpages AS heappages, coalesce(toast.relpages, 0) AS toastpages,
-          coalesce(toast.reltuples, 0) AS toasttuples,
-          coalesce(substring(
-            array_to_string(tbl.reloptions, ' ')
-            FROM 'fillfactor=([0-9]+)')::smallint, 100) AS fillfactor,
-          current_setting('block_size')::numeric AS bs,
-          CASE WHEN version()~'mingw32' OR version()~'64-bit|x86_64|ppc64|ia64|amd64' THEN 8 ELSE 4 END AS ma,
-          24 AS page_hdr,
-          23 + CASE WHEN MAX(coalesce(s.null_frac,0)) > 0 THEN ( 7 + count(s.attname) ) / 8 ELSE 0::int END
-           + CASE WHEN bool_or(att.attname = 'oid' and att.attnum < 0) THEN 4 ELSE 0 END AS tpl_hdr_size,
-          sum( (1-coalesce(s.null_frac, 0)) * coalesce(s.avg_width, 0) ) AS tpl_data_size
-        FROM pg_attribute AS att
-          JOIN pg_class AS tbl ON att.attrelid = tbl.oid
-          JOIN pg_namespace AS ns ON ns.oid = tbl.relnamespace
-          LEFT JOIN pg_stats AS s ON s.schemaname=ns.nspname
-            AND s.tablename = tbl.relname AND s.inherited=false AND s.attname=att.attname
-          LEFT JOIN pg_class AS toast ON tbl.reltoastrelid = toast.oid
-        WHERE NOT att.attisdropped
-          AND tbl.relkind = 'r'
-        GROUP BY 1,2,3,4,5,6,7,8,9,10
-        ORDER BY 2,3
-      ) AS s
-    ) AS s2
-  ) AS s3
-) AS s4;
-    """  # noqa
-
-
-class probe_btree_bloat(SqlProbe):
+    interval = 3600
+    # 'tables' or 'indexes'
+    relations = None
+
+    def __init__(self, options):
+        self.options = options
+
+    def run(self, conn, conninfo):
+        cache = BloatCache(self.store.home, conninfo['dbname'])
+        # Probe is due up to half a scheduler interval in advance. Refresh
+        # estimation a scheduler interval before the next run, otherwise a
+        # fresh estimation would skip a whole probe interval.
+        interval = self.options['probe_intervals'].get(
+            self.get_name(), self.interval)
+        max_age = interval - self.options['scheduler_interval']
+        try:
+            cache.refresh_if_stale(conn, max_age)
+        except Exception as e:
+            logger.error(
+                "Unable to estimate bloat of database \"%s\": %s",
+                conninfo['dbname'], e)
+            return []
+        return self.process_rows(conninfo, [dict(
+            dbname=conninfo['dbname'],
+            ratio=cache.ratio(self.relations),
+        )])
+
+
+class probe_heap_bloat(BloatProbe):
+    # Heap bloat estimation probe
+    relations = 'tables'
+
+
+class probe_btree_bloat(BloatProbe):
     # Btree index bloat estimation probe
-    timeout = 30
-    level = 'database'
-    sql = """
-SELECT
-  current_database() AS dbname,
-  SUM(bloat_size) / SUM(indexes_size) * 100 AS ratio
-FROM (
-  SELECT
-    SUM(pg_relation_size(quote_ident(schemaname) || '.' || quote_ident(indexname)))::BIGINT AS indexes_size
-  FROM pg_catalog.pg_indexes
-  GROUP BY schemaname
-) AS indexes,
-(
-  SELECT
-    SUM(bloat_size) AS bloat_size,
-    schemaname
-  FROM (
-    %s
-  ) AS a
-  GROUP BY schemaname
-) AS ibloat
-WHERE schemaname !~ '^pg_temp'
-AND schemaname !~ '^pg_toast';
-"""  % (INDEX_BTREE_BLOAT_SQL) # noqa
+    relations = 'indexes'
@@ -9,14 +9,20 @@ from .types import (
 routes = RouteSet(prefix=b'/pgconf')
 
 
-@routes.get(b'/configuration')
-@routes.get(b'/configuration/category/' + T_PGSETTINGS_CATEGORY)
+def settings_etag(http_context, app):
+    with app.postgres.connect() as conn:
+        return pgconf_functions.get_settings_etag(conn)
+
+
+@routes.get(b'/configuration', etag=settings_etag)
+@routes.get(b'/configuration/category/' + T_PGSETTINGS_CATEGORY,
+            etag=settings_etag)
 def get_pg_conf(http_context, app):
     with app.postgres.connect() as conn:
         return pgconf_functions.get_settings(conn, http_context)
 
 
-@routes.get(b'/configuration/categories')
+@routes.get(b'/configuration/categories', etag=settings_etag)
 def get_pg_conf_categories(http_context, app):
     with app.postgres.connect() as conn:
         return pgconf_functions.get_settings_categories(conn)
@@ -28,7 +34,7 @@ def post_pg_conf(http_context, app):
         return pgconf_functions.post_settings(conn, app.config, http_context)
 
 
-@routes.get(b'/configuration/status')
+@routes.get(b'/configuration/status', etag=settings_etag)
 def get_pg_conf_status(http_context, app):
     with app.postgres.connect() as conn:
         return pgconf_functions.get_settings_status(conn)
@@ -25,6 +25,17 @@ def get_settings_categories(conn):
     """)]}
 
 
+def get_settings_etag(conn):
+    # pg_settings changes on reload, restart or with per database or role
+    # settings.
+    return conn.query_scalar("""\
+    SELECT md5(pg_conf_load_time()::text || coalesce((
+        SELECT string_agg(setconfig::text, ',' ORDER BY setdatabase, setrole)
+        FROM pg_db_role_setting
+    ), ''))
+    """)
+
+
 def get_setting(conn, name):
     return conn.query_scalar(
         "SELECT setting FROM pg_settings WHERE name = %s", (name,))
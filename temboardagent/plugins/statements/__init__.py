@@ -1,8 +1,8 @@
 import logging
+from itertools import chain, islice
 
 from ...errors import HTTPError
 from ...routing import RouteSet
-from ...postgres import Postgres
 from ...tools import now
 from ...toolkit.configuration import OptionSpec
 
@@ -29,10 +29,10 @@ def get_statements(http_context, app):
     config = app.config
     dbname = config.statements.dbname
     snapshot_datetime = now()
-    conninfo = dict(config.postgresql, dbname=dbname)
+    rows = iter_statements(app.postgres.copy(dbname=dbname, app=None))
     try:
-        with Postgres(**conninfo).connect() as conn:
-            data = list(conn.query(query))
+        # Execute query now to report errors before streaming rows.
+        head = list(islice(rows, 1))
     except Exception as e:
         pg_version = app.postgres.fetch_version()
         if (
@@ -49,7 +49,13 @@ def get_statements(http_context, app):
         )
         raise HTTPError(500, e)
     else:
-        return {"snapshot_datetime": snapshot_datetime, "data": data}
+        return {"snapshot_datetime": snapshot_datetime,
+                "data": chain(head, rows)}
+
+
+def iter_statements(postgres):
+    with postgres.connect() as conn:
+        yield from conn.query(query)
 
 
 class StatementsPlugin:
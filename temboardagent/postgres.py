@@ -1,17 +1,30 @@
 import logging
+import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from textwrap import dedent
 
 import psycopg2.extensions
-from psycopg2 import connect
+from psycopg2 import InterfaceError, OperationalError, connect
 from psycopg2.extensions import connection
 from psycopg2.extras import RealDictCursor
 
 from .errors import UserError
+from .instrumentation import Counter, Histogram
 
 
 logger = logging.getLogger(__name__)
 
+CONNECT_DURATION = Histogram(
+    'temboard_postgres_connect_duration_seconds',
+    "Time to open a Postgres connection.")
+CONNECT_FAILURES = Counter(
+    'temboard_postgres_connect_failures_total',
+    "Failed Postgres connection attempts.")
+
 
 # See https://www.psycopg.org/docs/faq.html#faq-float
 DEC2FLOAT = psycopg2.extensions.new_type(
@@ -29,6 +42,23 @@ def pg_escape(in_string, escapee_char=r"'"):
     return out_string
 
 
+@contextmanager
+def statement_timeout(conn, seconds):
+    # Set statement_timeout of conn for the block, in milliseconds, at least
+    # one as 0 would disable timeout, then restore previous value, like one
+    # set by DBA on role or database. None leaves timeout untouched.
+    if seconds is None:
+        yield conn
+        return
+    previous = conn.query_scalar("SHOW statement_timeout")
+    conn.execute(
+        "SET statement_timeout = %s", (max(1, int(seconds * 1000)),))
+    try:
+        yield conn
+    finally:
+        conn.execute("SET statement_timeout = %s", (previous,))
+
+
 class ConnectionHelper(connection):
     def execute(self, query, vars=None):
         with self.cursor() as cur:
@@ -57,11 +87,14 @@ class ConnectionManager:
         self.postgres = postgres
         self.app = app
         self.conn = None
+        # Whether conn is borrowed from postgres pool.
+        self.pooled = False
 
     def open(self):
         logger.debug(
             "Opening Postgres connexion to database %s.",
             self.postgres.dbname)
+        start = time.time()
         try:
             self.conn = connect(
                 host=self.postgres.host,
@@ -77,7 +110,9 @@ class ConnectionManager:
             if self.app is not None:
                 self.app.check_compatibility(self.conn.server_version)
         except Exception as e:
+            CONNECT_FAILURES.inc()
             raise UserError("Failed to connect to Postgres: %s" % e)
+        CONNECT_DURATION.observe(time.time() - start)
         return self.conn
 
     def close(self):
@@ -87,17 +122,214 @@ class ConnectionManager:
 
     def __enter__(self):
         if self.conn is None:
-            self.open()
+            if self.postgres.pool:
+                self.conn = self.postgres.pool.getconn(self)
+                self.pooled = True
+            else:
+                self.open()
         return self.conn
 
-    def __exit__(self, *a):
-        self.close()
+    def __exit__(self, exc_type, exc, tb):
+        if self.pooled:
+            # Connection errors mean the connection is likely broken.
+            broken = isinstance(exc, (InterfaceError, OperationalError))
+            self.postgres.pool.putconn(self, discard=broken)
+            self.conn = None
+            self.pooled = False
+        else:
+            self.close()
+
+
+class Pool:
+    # Thread-safe pool of Postgres connections, keyed by connection
+    # parameters. Connections are borrowed by ConnectionManager when
+    # Postgres object has a pool.
+    #
+    # At most max_size connections are opened per key, and max_total for all
+    # keys. When max_total is reached, the least recently used idle
+    # connection of another key is closed to make room. Idle connections are
+    # checked with a query before reuse if idle for more than
+    # health_check_interval seconds, closed when idle for more than max_idle
+    # seconds, and not reused after max_lifetime seconds. Session state is
+    # reset on checkin.
+    #
+    # A process forked with a pool does not reuse nor close inherited
+    # connections, which belong to the parent process.
+
+    def __init__(self, max_size=4, max_total=10, max_idle=60,
+                 max_lifetime=3600, health_check_interval=10, timeout=5):
+        self.max_size = max_size
+        self.max_total = max_total
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        # Seconds to wait for a connection when max_size or max_total is
+        # reached.
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.init_state()
+
+    def init_state(self):
+        self.pid = os.getpid()
+        # Idle connections by key, last used last.
+        self.idle = dict()
+        # Number of opened connections by key, borrowed or idle.
+        self.opened = dict()
+        self.last_reap = time.time()
+
+    def check_pid(self):
+        if self.pid != os.getpid():
+            # Keep a reference on parent connections so that they are never
+            # deallocated, which would close them.
+            self.inherited = self.idle
+            self.init_state()
+
+    def key(self, postgres):
+        return (
+            postgres.host, postgres.port, postgres.user, postgres.password,
+            postgres.dbname,
+        )
+
+    def getconn(self, manager):
+        key = self.key(manager.postgres)
+        deadline = time.time() + self.timeout
+        while True:
+            with self.lock:
+                self.check_pid()
+                idle = self.idle.get(key)
+                if idle:
+                    conn = idle.pop()
+                elif (self.opened.get(key, 0) < self.max_size and
+                      self.make_room()):
+                    self.opened[key] = self.opened.get(key, 0) + 1
+                    break
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise UserError(
+                            "Timeout waiting for a Postgres connection.")
+                    self.available.wait(remaining)
+                    continue
+
+            # Check idle connection out of lock.
+            if self.check(conn):
+                return conn
+            with self.lock:
+                self.discard(key, conn)
+                self.available.notify_all()
+
+        # Open connection out of lock.
+        try:
+            conn = manager.open()
+        except Exception:
+            with self.lock:
+                self.opened[key] -= 1
+                self.available.notify_all()
+            raise
+        conn.created_at = conn.last_used = time.time()
+        return conn
+
+    def make_room(self):
+        # Must be called with lock held. Returns whether a new connection can
+        # be opened, closing the least recently used idle connection if
+        # max_total is reached.
+        if sum(self.opened.values()) < self.max_total:
+            return True
+        lru = None
+        for key, idle in self.idle.items():
+            for conn in idle:
+                if lru is None or conn.last_used < lru[1].last_used:
+                    lru = key, conn
+        if lru is None:
+            return False
+        key, conn = lru
+        logger.debug("Closing least recently used connection to make room.")
+        self.idle[key].remove(conn)
+        self.discard(key, conn)
+        return True
+
+    def check(self, conn):
+        # Returns whether idle conn is still usable.
+        now = time.time()
+        if conn.closed:
+            return False
+        if now - conn.last_used > self.max_idle:
+            return False
+        if now - conn.last_used > self.health_check_interval:
+            try:
+                conn.execute("SELECT 1")
+            except Exception as e:
+                logger.debug("Discarding broken connection: %s.", e)
+                return False
+        return True
+
+    def putconn(self, manager, discard=False):
+        conn = manager.conn
+        key = self.key(manager.postgres)
+        now = time.time()
+        if not discard and not conn.closed:
+            discard = now - conn.created_at > self.max_lifetime
+        if not discard and not conn.closed:
+            try:
+                self.reset(conn)
+            except Exception as e:
+                logger.debug("Failed to reset connection: %s.", e)
+                discard = True
+
+        with self.lock:
+            if self.pid != os.getpid():
+                # Borrowed before fork, belongs to parent.
+                return
+            if discard or conn.closed:
+                self.discard(key, conn)
+            else:
+                conn.last_used = now
+                self.idle.setdefault(key, []).append(conn)
+            # Waiters of other keys may close this connection.
+            self.available.notify_all()
+
+    def reset(self, conn):
+        if conn.status != psycopg2.extensions.STATUS_READY:
+            conn.rollback()
+        if not conn.autocommit:
+            conn.autocommit = True
+        conn.execute("DISCARD ALL")
+
+    def discard(self, key, conn):
+        # Must be called with lock held.
+        self.opened[key] -= 1
+        if not conn.closed:
+            conn.close()
+
+    def reap(self, interval=5):
+        # Close connections idle for too long. Cheap when called often.
+        now = time.time()
+        if now - self.last_reap < interval:
+            return
+        with self.lock:
+            self.check_pid()
+            self.last_reap = now
+            for key, idle in self.idle.items():
+                expired = [
+                    c for c in idle if now - c.last_used > self.max_idle]
+                for conn in expired:
+                    idle.remove(conn)
+                    self.discard(key, conn)
+
+    def close(self):
+        with self.lock:
+            self.check_pid()
+            for key, idle in self.idle.items():
+                for conn in idle:
+                    self.discard(key, conn)
+            self.idle = dict()
 
 
 class Postgres:
     def __init__(
             self, host=None, port=5432, user=None, password=None, dbname=None,
-            app=None,
+            app=None, pool=None,
             **kw):
         self.host = host
         self.port = port
@@ -108,6 +340,8 @@ class Postgres:
             dbname = kw['database']
         self.dbname = dbname
         self.app = app
+        # Optional Pool to borrow connections from.
+        self.pool = pool
         self._server_version = None
 
     def __repr__(self):
@@ -116,6 +350,10 @@ class Postgres:
             self.user, self.host, self.port, self.dbname,
         )
 
+    def __getstate__(self):
+        # Pool is local to process.
+        return dict(self.__dict__, pool=None)
+
     def connect(self):
         return ConnectionManager(self, self.app)
 
@@ -133,33 +371,91 @@ class Postgres:
             password=self.password,
             dbname=self.dbname,
             app=self.app,
+            pool=self.pool,
         )
         kw = dict(defaults, **kw)
         return self.__class__(**kw)
 
 
 class ConnectionPool:
-    def __init__(self, **kw):
+    # Connections by database.
+    #
+    # With max_connections, least recently used connection is closed before
+    # opening a new one beyond this limit. Threads sharing the pool must
+    # borrow() connections to protect them from eviction while in use.
+
+    def __init__(self, max_connections=None, **kw):
         if 'database' in kw:
             kw['dbname'] = kw.pop('database')
         self.conn_kw = kw
-        self.pool = dict()
+        self.max_connections = max_connections
+        # Least recently used first.
+        self.pool = OrderedDict()
+        self.lock = threading.Lock()
+        # Databases whose connection is borrowed by a thread.
+        self.busy = set()
 
     def get(self, dbname=None):
-        conn_kw = self.conn_kw.copy()
-        if dbname:
-            conn_kw['dbname'] = dbname
-        dbname = conn_kw['dbname']
+        dbname = dbname or self.conn_kw['dbname']
+        with self.lock:
+            conn = self.pool.get(dbname)
+            if conn is not None and conn.closed:
+                del self.pool[dbname]
+                conn = None
+            if conn is None and self.max_connections:
+                self.evict(self.max_connections - 1)
+
+        if conn is None:
+            # Connect outside the lock, other threads may use the pool.
+            conn_kw = dict(self.conn_kw, dbname=dbname)
+            conn = Postgres(**conn_kw).connect().open()
+
+        with self.lock:
+            self.pool[dbname] = conn
+            self.pool.move_to_end(dbname)
+        conn.last_used = time.time()
+        return conn
+
+    @contextmanager
+    def borrow(self, dbname=None):
+        dbname = dbname or self.conn_kw['dbname']
+        with self.lock:
+            self.busy.add(dbname)
         try:
-            return self.pool[dbname]
-        except KeyError:
-            conn = Postgres(**conn_kw).connect()
-            return self.pool.setdefault(dbname, conn.open())
+            yield self.get(dbname)
+        finally:
+            with self.lock:
+                self.busy.discard(dbname)
+
+    def evict(self, size):
+        # Close least recently used connections, not borrowed, until pool
+        # has size connections.
+        for dbname in list(self.pool):
+            if len(self.pool) <= size:
+                break
+            if dbname in self.busy:
+                continue
+            self.pool.pop(dbname).close()
+
+    def evict_idle(self, max_idle):
+        # Close connections unused for more than max_idle seconds.
+        limit = time.time() - max_idle
+        with self.lock:
+            for dbname, conn in list(self.pool.items()):
+                if dbname in self.busy or conn.last_used >= limit:
+                    continue
+                logger.debug("Closing idle connection to %s.", dbname)
+                del self.pool[dbname]
+                conn.close()
+
+    def close(self):
+        with self.lock:
+            for conn in self.pool.values():
+                conn.close()
+            self.pool = OrderedDict()
 
     def __enter__(self):
         return self
 
     def __exit__(self, *_):
-        for conn in self.pool.values():
-            conn.close()
-        self.pool = dict()
+        self.close()
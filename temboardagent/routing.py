@@ -1,5 +1,6 @@
 import re
 import logging
+from urllib.parse import unquote_plus
 
 ROUTES = []
 WORKERS = []
@@ -7,7 +8,8 @@ WORKERS = []
 logger = logging.getLogger(__name__)
 
 
-def make_route(function, method, path, check_session, check_key):
+def make_route(function, method, path, check_session, check_key,
+               concurrency=None, etag=None):
     splitpath = []
     elts = path.split(b'/')
     pos = 0
@@ -44,17 +46,109 @@ def make_route(function, method, path, check_session, check_key):
         function=function.__name__,
         check_session=check_session,
         check_key=check_key,
+        # Maximum number of concurrent requests on this route.
+        concurrency=concurrency,
+        # Function computing entity tag of response, without running the
+        # handler.
+        etag=etag,
     )
 
 
-def add_route(method, path, check_session=True, check_key=False):
+class RouteNode:
+    # A node of the route trie. Children are split between literal segments,
+    # looked up by hash, and regexp segments, tried in turn.
+
+    def __init__(self):
+        self.literals = dict()
+        self.patterns = dict()
+        # Registration rank and route ending at this node, if any.
+        self.route = None
+
+    def child(self, elt):
+        if type(elt) in (str, bytes):
+            return self.literals.setdefault(elt, RouteNode())
+        if elt.pattern not in self.patterns:
+            self.patterns[elt.pattern] = (elt, RouteNode())
+        return self.patterns[elt.pattern][1]
+
+
+class RouteIndex:
+    # Precompiled lookup table for routes, keyed by HTTP method and URL root,
+    # then by a trie of path segments.
+    #
+    # Resolution walks the request path once, extracting URL variables on the
+    # way. When several routes match, the first registered wins, just like a
+    # linear scan of ROUTES would.
+
+    def __init__(self, routes=()):
+        self.roots = dict()
+        self.rank = 0
+        for route in routes:
+            self.add(route)
+
+    def add(self, route):
+        key = (route['http_method'], route['root'])
+        node = self.roots.setdefault(key, RouteNode())
+        # The root is the first element of splitpath.
+        for elt in route['splitpath'][1:]:
+            node = node.child(elt)
+        if node.route is None:
+            node.route = (self.rank, route)
+        self.rank += 1
+
+    def resolve(self, method, path):
+        # Returns the route and URL variables matching method and path, or
+        # (None, None).
+        s_path = path.split(b'/')[1:]
+        node = self.roots.get((method, s_path[0]))
+        if node is None:
+            return None, None
+        match = self._walk(node, s_path, 1, [])
+        if match is None:
+            return None, None
+        _, route, urlvars = match
+        return route, urlvars
+
+    def _walk(self, node, s_path, p, urlvars):
+        if p == len(s_path):
+            if node.route is None:
+                return None
+            return node.route + (urlvars,)
+
+        elt = s_path[p]
+        best = None
+        child = node.literals.get(elt)
+        if child is not None:
+            best = self._walk(child, s_path, p + 1, urlvars)
+
+        if node.patterns:
+            value = elt.decode('utf-8')
+            for regexp, child in node.patterns.values():
+                res = regexp.match(value)
+                if not res:
+                    continue
+                match = self._walk(
+                    child, s_path, p + 1,
+                    urlvars + [unquote_plus(res.group(1))])
+                if match and (best is None or match[0] < best[0]):
+                    best = match
+        return best
+
+
+INDEX = RouteIndex()
+
+
+def add_route(method, path, check_session=True, check_key=False,
+              concurrency=None, etag=None):
     """
     Function decorator for HTTP method/path -> API function mapping.
     """
     def func_wrapper(function):
         global ROUTES
-        ROUTES.append(make_route(function, method, path, check_session,
-                                 check_key))
+        route = make_route(function, method, path, check_session, check_key,
+                           concurrency, etag)
+        ROUTES.append(route)
+        INDEX.add(route)
         return function
     return func_wrapper
 
@@ -66,6 +160,15 @@ def get_routes():
     return ROUTES
 
 
+def resolve_route(method, path):
+    """
+    Returns the route and URL variables for method and bytes path.
+
+    Returns (None, None) if no route matches.
+    """
+    return INDEX.resolve(method, path)
+
+
 class Router:
     # Adapter to manage routes with an instance rather than a global.
 
@@ -74,38 +177,44 @@ class Router:
         for route in routes:
             if route not in ROUTES:
                 ROUTES.append(route)
+                INDEX.add(route)
 
     def remove(self, routes):
-        global ROUTES
+        global ROUTES, INDEX
         for route in routes:
             if route in ROUTES:
                 ROUTES.remove(route)
+        # Removal is rare, rebuilding is simpler than pruning the trie.
+        INDEX = RouteIndex(ROUTES)
 
 
 class RouteSet(list):
     def __init__(self, prefix=b''):
         self.prefix = prefix
 
-    def delete(self, path, check_session=True, check_key=False):
+    def delete(self, path, check_session=True, check_key=False,
+               concurrency=None, etag=None):
         def register_route(f):
             self.append(
                 make_route(f, 'DELETE', self.prefix + path, check_session,
-                           check_key))
+                           check_key, concurrency, etag))
             return f
         return register_route
 
-    def get(self, path, check_session=True, check_key=False):
+    def get(self, path, check_session=True, check_key=False,
+            concurrency=None, etag=None):
         def register_route(f):
             self.append(
                 make_route(f, 'GET', self.prefix + path, check_session,
-                           check_key))
+                           check_key, concurrency, etag))
             return f
         return register_route
 
-    def post(self, path, check_session=True, check_key=False):
+    def post(self, path, check_session=True, check_key=False,
+             concurrency=None, etag=None):
         def register_route(f):
             self.append(
                 make_route(f, 'POST', self.prefix + path, check_session,
-                           check_key))
+                           check_key, concurrency, etag))
             return f
         return register_route
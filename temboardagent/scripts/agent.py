@@ -80,6 +80,29 @@ def define_arguments(parser):
     )
 
 
+def compression_level(raw):
+    value = int(raw)
+    if not 0 <= value <= 9:
+        raise ValueError("Compression level must be between 0 and 9.")
+    return value
+
+
+def route_concurrency(raw):
+    # Parse comma separated list of route:limit, route being like
+    # activity.get_activity.
+    if isinstance(raw, dict):
+        return raw
+    limits = {}
+    for item in raw.split(','):
+        if not item.strip():
+            continue
+        name, sep, limit = item.partition(':')
+        if not sep:
+            raise ValueError("Missing limit of route %s." % name.strip())
+        limits[name.strip()] = int(limit)
+    return limits
+
+
 def list_options_specs():
     # Generate each option specs.
     section = 'temboard'
@@ -95,6 +118,22 @@ def list_options_specs():
         section, 'ssl_key_file',
         default=OptionSpec.REQUIRED, validator=v.file_)
     yield OptionSpec(section, 'ssl_ca_cert_file', validator=v.file_)
+    yield OptionSpec(section, 'keepalive_timeout', default=30, validator=int)
+    yield OptionSpec(
+        section, 'keepalive_max_requests', default=100, validator=int)
+    yield OptionSpec(section, 'http_workers', default=8, validator=int)
+    yield OptionSpec(section, 'http_queue_size', default=32, validator=int)
+    yield OptionSpec(
+        section, 'http_route_concurrency', default={},
+        validator=route_concurrency)
+    yield OptionSpec(
+        section, 'http_max_body_size', default=1024 * 1024, validator=int)
+    yield OptionSpec(section, 'http_body_timeout', default=10, validator=int)
+    yield OptionSpec(
+        section, 'compression_min_size', default=1024, validator=int)
+    yield OptionSpec(
+        section, 'compression_level', default=6,
+        validator=compression_level)
     yield OptionSpec(section, 'key')
     yield OptionSpec(
         section, 'users',
@@ -180,6 +219,14 @@ class AgentApplication(Application):
         services = ServicesManager()
         services.add(self.worker_pool)
         services.add(self.scheduler)
+        # Plugins may run their own long-lived services.
+        for plugin_name, plugin in self.plugins.items():
+            if hasattr(plugin, 'services'):
+                for service in plugin.services(setproctitle):
+                    logger.debug(
+                        "Adding service %s of plugin %s.",
+                        service.name, plugin_name)
+                    services.add(service)
 
         with services:
             httpd = HTTPDService(
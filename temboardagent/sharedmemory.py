@@ -1,16 +1,17 @@
+from contextlib import contextmanager
 from multiprocessing import Lock
-from multiprocessing.sharedctypes import Array
-from ctypes import (Structure, c_char, c_double)
+from multiprocessing.sharedctypes import RawArray, RawValue
+from ctypes import (Structure, c_char, c_double, c_int, c_ulonglong)
+from zlib import crc32
+import heapq
+import threading
 import time
 
 from .errors import (
     SharedItem_not_found, SharedItem_exists,
     SharedItem_bad_type_size,
-    SharedItem_no_free_slot_left,
-    NotificationError,
 )
 from .types import T_SESSIONID_SIZE, T_USERNAME_SIZE
-from .notification import NotificationMgmt, Notification
 
 
 class Session(Structure):
@@ -28,69 +29,221 @@ class Session(Structure):
     ]
 
 
-class Sessions:
+# Hash table markers.
+EMPTY = -1
+DELETED = -2
+
+
+class SeqLock:
     """
-    Sessions object.
+    Writers serialize on a lock and bump a sequence counter, readers don't
+    lock but retry if the sequence changed while reading.
     """
-    def __init__(self, size=100):
+    def __init__(self):
         # Lock handler.
         self.lock = Lock()
+        # Sequence counter, odd while a write is in progress.
+        self.seq = RawValue(c_ulonglong, 0)
+
+    def _read(self, func, *args):
+        # Seqlock read: retry until no write happened meanwhile.
+        while True:
+            seq = self.seq.value
+            if seq & 1:
+                time.sleep(0)
+                continue
+            try:
+                result = func(*args)
+            except IndexError:
+                # Arrays reallocated while reading.
+                result = None
+            if self.seq.value == seq:
+                return result
+
+    @contextmanager
+    def _write(self):
+        with self.lock:
+            self.seq.value += 1
+            try:
+                yield
+            finally:
+                self.seq.value += 1
+
+
+class Sessions(SeqLock):
+    """
+    Sessions object.
+
+    Sessions are packed at the beginning of an array, indexed by two open
+    addressing hash tables on sessionid and username. Writers serialize on a
+    lock and bump a sequence counter, readers don't lock but retry if the
+    sequence changed while reading. The array doubles when full. Growing
+    reallocates shared memory, so processes forked before don't see new
+    sessions.
+    """
+    def __init__(self, size=100):
+        super().__init__()
+        # Number of sessions, packed at the beginning of the array.
+        self.count = 0
+        self.allocate(size)
+        # Min-heap of (last update time, sessionid) ordering sessions by
+        # expiry. Session time is refreshed without touching the heap, entries
+        # are checked against the array when popped.
+        self.expiry_heap = []
+        self.expiry_lock = threading.Lock()
+        # Set when a session is added, to wake up expiry.
+        self.added = threading.Event()
+
+    def allocate(self, size):
+        # (Re)allocate array of Session and hash tables, keeping sessions.
+        sessions = RawArray(Session, size)
+        for i in range(self.count):
+            sessions[i] = self.sessions[i]
         # Array size.
         self.size = size
         # Array of Session.
-        self.sessions = Array(Session, self.size, lock=self.lock)
+        self.sessions = sessions
+        self.rehash()
+
+    def rehash(self):
+        # Build hash tables at most half full, dropping DELETED markers.
+        tsize = 1
+        while tsize < 2 * self.size:
+            tsize *= 2
+        self.by_sessionid = RawArray(c_int, [EMPTY] * tsize)
+        self.by_username = RawArray(c_int, [EMPTY] * tsize)
+        # Number of DELETED markers in hash tables.
+        self.deleted = 0
+        for i in range(self.count):
+            self._insert(self.by_sessionid, self.sessions[i].sessionid, i)
+            self._insert(self.by_username, self.sessions[i].username, i)
+
+    def _find(self, table, field, key):
+        # Returns the position of key in table, or None.
+        mask = len(table) - 1
+        pos = crc32(key) & mask
+        while True:
+            i = table[pos]
+            if i == EMPTY:
+                return None
+            if i >= 0 and getattr(self.sessions[i], field) == key:
+                return pos
+            pos = (pos + 1) & mask
+
+    def _insert(self, table, key, i):
+        mask = len(table) - 1
+        pos = crc32(key) & mask
+        while table[pos] >= 0:
+            pos = (pos + 1) & mask
+        table[pos] = i
+
+    def _get(self, field, key):
+        table = self.by_sessionid if field == 'sessionid' else self.by_username
+        pos = self._find(table, field, key)
+        if pos is None:
+            return None
+        return Session.from_buffer_copy(self.sessions[table[pos]])
+
+    def _remove(self, i):
+        # Remove session at i, moving last session in the hole to keep the
+        # array packed.
+        session = self.sessions[i]
+        pos = self._find(self.by_sessionid, 'sessionid', session.sessionid)
+        self.by_sessionid[pos] = DELETED
+        pos = self._find(self.by_username, 'username', session.username)
+        self.by_username[pos] = DELETED
+        self.deleted += 1
+
+        last = self.count - 1
+        if i != last:
+            moved = self.sessions[last]
+            pos = self._find(self.by_sessionid, 'sessionid', moved.sessionid)
+            self.by_sessionid[pos] = i
+            pos = self._find(self.by_username, 'username', moved.username)
+            self.by_username[pos] = i
+            self.sessions[i] = moved
+        self.sessions[last] = Session()
+        self.count = last
+
+        if 2 * (self.count + self.deleted) > len(self.by_sessionid):
+            self.rehash()
 
     def get_by_sessionid(self, sessionid):
         """
-        Returns a Session by a sessionid.
+        Returns a copy of a Session by a sessionid.
         """
-        for session in self.sessions:
-            if session.sessionid == sessionid:
-                return session
-        raise SharedItem_not_found()
+        session = self._read(self._get, 'sessionid', sessionid)
+        if session is None:
+            raise SharedItem_not_found()
+        return session
 
     def get_by_username(self, username):
         """
-        Returns a Session by a username.
+        Returns a copy of a Session by a username.
         """
-        for session in self.sessions:
-            if session.username == username:
-                return session
+        return self._read(self._get, 'username', username)
 
     def add(self, session):
         """
         Add a new Session.
         """
-        for i in range(0, self.size):
-            if self.sessions[i].sessionid == session.sessionid:
+        with self._write():
+            if self._find(self.by_sessionid, 'sessionid', session.sessionid) \
+               is not None:
                 raise SharedItem_exists()
-            if self.sessions[i].username == session.username:
-                self.sessions[i] = Session()
-        for i in range(0, self.size):
-            if self.sessions[i].sessionid == b'':
-                self.sessions[i] = session
-                return
-        raise SharedItem_no_free_slot_left()
+            pos = self._find(self.by_username, 'username', session.username)
+            if pos is not None:
+                self._remove(self.by_username[pos])
+            if self.count == self.size:
+                self.allocate(2 * self.size)
+            i = self.count
+            self.sessions[i] = session
+            self.count += 1
+            self._insert(self.by_sessionid, session.sessionid, i)
+            self._insert(self.by_username, session.username, i)
+        with self.expiry_lock:
+            heapq.heappush(
+                self.expiry_heap, (session.time, session.sessionid))
+        self.added.set()
 
     def update(self, session):
         """
         Modify a Session.
         """
-        for i in range(0, self.size):
-            if self.sessions[i].sessionid == session.sessionid:
-                self.sessions[i] = session
-                return
-        raise SharedItem_not_found()
+        with self._write():
+            pos = self._find(self.by_sessionid, 'sessionid', session.sessionid)
+            if pos is None:
+                raise SharedItem_not_found()
+            i = self.by_sessionid[pos]
+            if self.sessions[i].username != session.username:
+                pos = self._find(
+                    self.by_username, 'username', self.sessions[i].username)
+                self.by_username[pos] = DELETED
+                self.deleted += 1
+                self._insert(self.by_username, session.username, i)
+            self.sessions[i] = session
+
+    def touch(self, sessionid):
+        """
+        Refresh last update time of a Session and returns a copy of it.
+        """
+        with self._write():
+            pos = self._find(self.by_sessionid, 'sessionid', sessionid)
+            if pos is None:
+                raise SharedItem_not_found()
+            session = self.sessions[self.by_sessionid[pos]]
+            session.time = time.time()
+            return Session.from_buffer_copy(session)
 
     def delete(self, sessionid):
         """
         Remove a Session.
         """
-        for i in range(0, self.size):
-            if self.sessions[i].sessionid == sessionid:
-                self.sessions[i] = Session()
-                return
-        raise SharedItem_not_found()
+        with self._write():
+            pos = self._find(self.by_sessionid, 'sessionid', sessionid)
+            if pos is None:
+                raise SharedItem_not_found()
+            self._remove(self.by_sessionid[pos])
 
     def add_tuple(self, t_session):
         """
@@ -104,21 +257,141 @@ class Sessions:
         session.username = t_session[2][:T_USERNAME_SIZE]
         self.add(session)
 
-    def purge_expired(self, ttl, logger, config):
+    def pop_expired(self, ttl):
+        """
+        Remove Sessions whose last update time + TTL is prior to current
+        timestamp. Returns the list of removed Sessions and the timestamp of
+        the next possible expiry, or None if there is no Session left.
+        """
+        now = time.time()
+        expired = []
+        with self.expiry_lock:
+            while self.expiry_heap and self.expiry_heap[0][0] + ttl < now:
+                _, sessionid = heapq.heappop(self.expiry_heap)
+                with self._write():
+                    pos = self._find(self.by_sessionid, 'sessionid', sessionid)
+                    if pos is None:
+                        # Session deleted on logout.
+                        continue
+                    i = self.by_sessionid[pos]
+                    session = Session.from_buffer_copy(self.sessions[i])
+                    if session.time + ttl < now:
+                        expired.append(session)
+                        self._remove(i)
+                        continue
+                # Session refreshed since pushed, reschedule.
+                heapq.heappush(self.expiry_heap, (session.time, sessionid))
+            if self.expiry_heap:
+                next_expiry = self.expiry_heap[0][0] + ttl
+            else:
+                next_expiry = None
+        return expired, next_expiry
+
+
+class RingBuffer(SeqLock):
+    """
+    Last samples of a collector, shared by the process collecting samples
+    and the HTTP server process.
+
+    Samples are timestamped bytes, stored in fixed size slots of a circular
+    array. Once full, a new sample overwrites the oldest one. Shared memory
+    is allocated once, processes must be forked after.
+    """
+    def __init__(self, length, slot_size=8192):
+        super().__init__()
+        # Number of slots.
+        self.length = length
+        # Maximum size in bytes of a sample.
+        self.slot_size = slot_size
+        # Total number of samples appended.
+        self.count = RawValue(c_ulonglong, 0)
+        self.times = RawArray(c_double, length)
+        self.sizes = RawArray(c_int, length)
+        self.data = RawArray(c_char, length * slot_size)
+
+    def append(self, time, data):
         """
-        Remove old Session when the Session last update time + TTL is prior to
-         current timestamp.
+        Add a sample, overwriting the oldest one if full.
         """
-        for i in range(0, self.size):
-            if len(self.sessions[i].sessionid) == T_SESSIONID_SIZE and \
-               (self.sessions[i].time + ttl) < time.time():
-                logger.info("Session with sessionid=%s expired." %
-                            (self.sessions[i].sessionid))
-                try:
-                    NotificationMgmt.push(config, Notification(
-                        username=self.sessions[i].username,
-                        message="Session expired"))
-                except NotificationError as e:
-                    logger.error(e.message)
+        if len(data) > self.slot_size:
+            raise SharedItem_bad_type_size()
+        with self._write():
+            i = self.count.value % self.length
+            offset = i * self.slot_size
+            self.data[offset:offset + len(data)] = data
+            self.sizes[i] = len(data)
+            self.times[i] = time
+            self.count.value += 1
+
+    def _slice(self, start, since):
+        count = self.count.value
+        samples = []
+        for n in range(max(start, count - self.length, 0), count):
+            i = n % self.length
+            if since is not None and self.times[i] <= since:
+                continue
+            offset = i * self.slot_size
+            samples.append(
+                (self.times[i], self.data[offset:offset + self.sizes[i]]))
+        return samples
+
+    def read(self, since=None):
+        """
+        Returns samples as a list of (time, data), oldest first. With since,
+        returns only samples more recent than since timestamp.
+        """
+        return self._read(self._slice, 0, since)
 
-                self.sessions[i] = Session()
+    def last(self):
+        """
+        Returns the last sample as a (time, data) tuple, or None.
+        """
+        samples = self._read(
+            lambda: self._slice(self.count.value - 1, None))
+        return samples[0] if samples else None
+
+
+# Fields of SysInfo.proc_stat() used to compute CPU usage.
+CPU_TIMES = (
+    'time_user', 'time_system', 'time_idle', 'time_iowait', 'time_steal',
+)
+
+
+class CPUSampler(SeqLock):
+    """
+    CPU usage computed from consecutive samples of cumulative CPU times,
+    shared by processes.
+
+    Each sample is compared to the previous one, without sleeping. Samples
+    closer than min_interval seconds to the previous one return the last
+    usage, to compute usage over a meaningful period. The first sample
+    returns usage since boot.
+    """
+    def __init__(self, min_interval=1.):
+        super().__init__()
+        self.min_interval = min_interval
+        # Timestamp of previous sample.
+        self.time = RawValue(c_double, 0)
+        # CPU times of previous sample, in CPU_TIMES order.
+        self.times = RawArray(c_double, len(CPU_TIMES))
+        # Last usage in percent, in CPU_TIMES order.
+        self.usages = RawArray(c_double, len(CPU_TIMES))
+
+    def usage(self, now, stat):
+        """
+        Returns CPU usage in percent since previous sample, by kind of time.
+        """
+        with self._write():
+            if now - self.time.value >= self.min_interval:
+                deltas = [
+                    stat[k] - self.times[i] for i, k in enumerate(CPU_TIMES)]
+                total = sum(deltas)
+                if total > 0:
+                    self.usages[:] = [
+                        round(d / total * 100, 1) for d in deltas]
+                self.times[:] = [stat[k] for k in CPU_TIMES]
+                self.time.value = now
+            return dict(
+                (k[len('time_'):], self.usages[i])
+                for i, k in enumerate(CPU_TIMES)
+            )
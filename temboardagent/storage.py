@@ -0,0 +1,73 @@
+# Access to SQLite databases of the agent.
+#
+# Each process and thread keeps one connection per database file, opened on
+# first use. Thus SQLite reuses its page cache and prepared statements
+# between calls. Databases are in WAL journal mode: readers don't block
+# writer and commits don't fsync unless on checkpoint.
+#
+# Writes must happen in transaction(). Nested transactions join the outer
+# one, so that a batch of writes costs a single commit.
+
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    # Durable on checkpoint only. A crash may lose last transactions, not
+    # corrupt the database.
+    "PRAGMA synchronous = NORMAL",
+    # In KiB.
+    "PRAGMA cache_size = -8192",
+    "PRAGMA temp_store = MEMORY",
+]
+
+_local = threading.local()
+# SQLite connections must not be used across fork. Keep connections
+# inherited from parent process referenced, to never close them.
+_inherited = []
+
+
+def connect(path):
+    # Returns the connection to SQLite database at path, private to the
+    # current process and thread.
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _inherited.extend(getattr(_local, 'connections', {}).values())
+        _local.pid = pid
+        _local.connections = {}
+        # Transaction depth by path.
+        _local.depth = {}
+
+    conn = _local.connections.get(path)
+    if conn is None:
+        logger.debug("Opening SQLite database %s.", path)
+        conn = sqlite3.connect(path, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.connections[path] = conn
+    return conn
+
+
+@contextmanager
+def transaction(path):
+    # Yields the connection to SQLite database at path. Commits on exit of
+    # the outermost transaction, or rollback on error.
+    conn = connect(path)
+    depth = _local.depth.get(path, 0)
+    _local.depth[path] = depth + 1
+    try:
+        yield conn
+        if depth == 0:
+            conn.commit()
+    except BaseException:
+        if depth == 0:
+            conn.rollback()
+        raise
+    finally:
+        _local.depth[path] = depth
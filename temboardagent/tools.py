@@ -5,6 +5,7 @@ import logging
 import os
 import re
 import time
+from collections.abc import Iterator
 from datetime import datetime
 from time import strftime, gmtime
 from .errors import HTTPError
@@ -23,6 +24,15 @@ def hash_id(id):
     return m.hexdigest()
 
 
+def hash_etag(*values):
+    """
+    Build an entity tag from the representation of values.
+    """
+    m = hashlib.md5()
+    m.update(repr(values).encode('utf-8'))
+    return m.hexdigest()
+
+
 def validate_parameters(values, types):
     """
     Verify that each value of dict 'values' is valid. For doing that, we have
@@ -151,3 +161,93 @@ class JSONEncoder(json.JSONEncoder):
             return obj.isoformat()
         else:
             return super().default(obj)
+
+
+class Response:
+    """
+    Response body sent as is rather than serialized to JSON. body is either
+    bytes, str or an iterable of bytes chunks. Set compress to False for
+    streams whose chunks must reach client as soon as yielded.
+
+    detach is a callable receiving the connection once body is sent, to
+    continue the stream from another thread without holding an HTTP worker.
+    Such a body ends when the connection is closed.
+    """
+    def __init__(self, body, content_type='application/json', headers=None,
+                 compress=True, detach=None):
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.compress = compress
+        self.detach = detach
+
+
+class RawJSON(str):
+    """
+    Valid JSON text, spliced as is in JSON output by iterencode_json. Avoids
+    decoding and encoding again JSON documents read from storage.
+    """
+
+
+_JSON_CONTAINERS = (dict, list, tuple, Iterator, RawJSON)
+
+
+def iterencode_json(obj, encoder=None):
+    """
+    Serialize obj to JSON, yielding string fragments. Iterators and generators
+    are consumed lazily and serialized as arrays, so that large results are
+    never materialized.
+    """
+    if encoder is None:
+        encoder = JSONEncoder()
+
+    if isinstance(obj, RawJSON):
+        yield obj
+    elif isinstance(obj, dict):
+        if not any(isinstance(v, _JSON_CONTAINERS) for v in obj.values()):
+            # Flat dict, like a row. Let C encoder do the job.
+            yield encoder.encode(obj)
+            return
+        yield '{'
+        first = True
+        for key, value in obj.items():
+            if not first:
+                yield ', '
+            first = False
+            if not isinstance(key, str):
+                key = encoder.encode(key)
+            yield encoder.encode(key)
+            yield ': '
+            yield from iterencode_json(value, encoder)
+        yield '}'
+    elif isinstance(obj, (list, tuple, Iterator)):
+        if isinstance(obj, (list, tuple)) and \
+           not any(isinstance(v, _JSON_CONTAINERS) for v in obj):
+            yield encoder.encode(obj)
+            return
+        yield '['
+        first = True
+        for value in obj:
+            if not first:
+                yield ', '
+            first = False
+            yield from iterencode_json(value, encoder)
+        yield ']'
+    else:
+        yield encoder.encode(obj)
+
+
+def size_pretty(size):
+    # Same as pg_size_pretty(size::bigint). Returns None for unknown size.
+    if size is None:
+        return None
+    size = int(round(size))
+    if abs(size) < 10 * 1024:
+        return '%d bytes' % size
+    # Keep one extra bit for rounding.
+    size >>= 9
+    for unit in ('kB', 'MB', 'GB', 'TB'):
+        if abs(size) < 20 * 1024 - 1 or unit == 'TB':
+            break
+        size >>= 10
+    return '%d %s' % (int((size + (1 if size > 0 else -1)) / 2), unit)
@@ -0,0 +1,131 @@
+# Micro-benchmark of route resolution.
+#
+# Compares the route index against the former linear scan of ROUTES, on a
+# route table shaped like the one of an agent with all plugins loaded.
+#
+# Usage: python tests/bench/bench_routing.py
+#
+from timeit import timeit
+
+from temboardagent.routing import RouteIndex, make_route
+
+
+T_NAME = b'(^.{1,63}$)'
+T_ID = b'(^[0-9a-f]{8}$)'
+
+
+def handler():
+    pass
+
+
+def generate_routes():
+    routes = []
+
+    def add(method, path):
+        routes.append(make_route(handler, method, path, True, False))
+
+    for path in (b'/login', b'/logout', b'/discover', b'/profile',
+                 b'/notifications', b'/status', b'/activity',
+                 b'/activity/waiting', b'/activity/blocking',
+                 b'/administration/pg_version', b'/statements'):
+        add('GET', path)
+    for probe in (b'sessions', b'xacts', b'locks', b'blocks', b'bgwriter',
+                  b'db_size', b'tblspc_size', b'filesystems_size', b'cpu',
+                  b'process', b'memory', b'loadavg', b'wal_files',
+                  b'replication_lag', b'temp_files_size_delta',
+                  b'replication_connection', b'heap_bloat', b'btree_bloat'):
+        add('GET', b'/monitoring/probe/' + probe)
+    for path in (b'/history', b'/config'):
+        add('GET', b'/monitoring' + path)
+    for path in (b'', b'/config', b'/live', b'/history', b'/buffers',
+                 b'/hitratio', b'/active_backends', b'/cpu', b'/loadaverage',
+                 b'/memory', b'/hostname', b'/os_version', b'/pg_version',
+                 b'/n_cpu', b'/databases', b'/info', b'/max_connections'):
+        add('GET', b'/dashboard' + path)
+    add('GET', b'/maintenance')
+    add('GET', b'/maintenance/' + T_NAME)
+    add('GET', b'/maintenance/' + T_NAME + b'/schema/' + T_NAME)
+    add('GET', b'/maintenance/' + T_NAME + b'/schema/' + T_NAME + b'/table/' +
+        T_NAME)
+    for op in (b'vacuum', b'analyze', b'reindex'):
+        add('POST', b'/maintenance/' + T_NAME + b'/' + op)
+        add('POST', b'/maintenance/' + T_NAME + b'/schema/' + T_NAME +
+            b'/table/' + T_NAME + b'/' + op)
+        add('GET', b'/maintenance/' + T_NAME + b'/' + op + b'/scheduled')
+        add('GET', b'/maintenance/' + T_NAME + b'/schema/' + T_NAME +
+            b'/table/' + T_NAME + b'/' + op + b'/scheduled')
+        add('DELETE', b'/maintenance/' + op + b'/' + T_ID)
+        add('GET', b'/maintenance/' + op + b'/scheduled')
+    for path in (b'/configuration', b'/configuration/categories',
+                 b'/configuration/status'):
+        add('GET', b'/pgconf' + path)
+    add('GET', b'/pgconf/configuration/category/' + T_NAME)
+    add('POST', b'/pgconf/configuration')
+    return routes
+
+
+def legacy_resolve(routes, method, path):
+    # Former RequestHandler.get_route and parse_path.
+    s_path = path.split(b'/')[1:]
+    root = s_path[0]
+    for route in routes:
+        if not (route['http_method'] == method and route['root'] == root):
+            continue
+        p = 0
+        for elt in s_path:
+            try:
+                if type(route['splitpath'][p]) not in (str, bytes):
+                    res = route['splitpath'][p].match(elt.decode('utf-8'))
+                    if not res:
+                        break
+                else:
+                    if route['splitpath'][p] != elt:
+                        break
+            except IndexError:
+                break
+            p += 1
+        if p == len(s_path) == len(route['splitpath']):
+            break
+    else:
+        return None, None
+
+    urlvars = []
+    for p, elt in enumerate(s_path):
+        if type(route['splitpath'][p]) not in (str, bytes):
+            res = route['splitpath'][p].match(elt.decode('utf-8'))
+            if res is not None:
+                urlvars.append(res.group(1))
+    return route, urlvars
+
+
+def main():
+    routes = generate_routes()
+    index = RouteIndex(routes)
+    requests = [
+        ('GET', b'/dashboard'),
+        ('GET', b'/monitoring/history'),
+        ('GET', b'/pgconf/configuration'),
+        ('GET', b'/maintenance/postgres/schema/public/table/pgbench_history'),
+        ('GET', b'/maintenance/reindex/scheduled'),
+        ('GET', b'/unknown'),
+    ]
+    number = 20000
+
+    print("%d routes." % len(routes))
+    for method, path in requests:
+        legacy = legacy_resolve(routes, method, path)
+        indexed = index.resolve(method, path)
+        assert legacy[0] is indexed[0], path
+
+        t_legacy = timeit(
+            lambda: legacy_resolve(routes, method, path), number=number)
+        t_index = timeit(
+            lambda: index.resolve(method, path), number=number)
+        print("%-7s %-60s linear=%6.2fus index=%6.2fus x%.1f" % (
+            method, path.decode('utf-8'),
+            t_legacy / number * 1e6, t_index / number * 1e6,
+            t_legacy / t_index))
+
+
+if __name__ == '__main__':
+    main()
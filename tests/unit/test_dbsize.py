@@ -0,0 +1,84 @@
+import pytest
+
+
+def test_method():
+    from temboardagent.dbsize import method
+
+    assert 'estimate' == method('estimate')
+    with pytest.raises(ValueError):
+        method('fast')
+
+
+def mock_conn(mocker, size):
+    # Connection answering size queries with size, counted in conn.sizes.
+    conn = mocker.MagicMock(name='conn')
+    conn.sizes = 0
+
+    def query_scalar(sql, vars=None):
+        if sql.startswith('SHOW'):
+            return '0'
+        conn.sizes += 1
+        if isinstance(conn.size, Exception):
+            raise conn.size
+        return conn.size
+
+    conn.size = size
+    conn.query_scalar.side_effect = query_scalar
+    return conn
+
+
+def test_size_cache(mocker, tmpdir):
+    from temboardagent.dbsize import SizeCache, bootstrap
+
+    home = str(tmpdir)
+    bootstrap(home)
+    conn = mock_conn(mocker, 8192)
+    # Estimation connects to each database.
+    postgres = mocker.MagicMock(name='postgres')
+    dbconn = mock_conn(mocker, 4096)
+    postgres.copy.return_value.connect.return_value.__enter__.return_value = \
+        dbconn
+    clock = mocker.patch('temboardagent.dbsize.time.time', return_value=1000.)
+
+    # No budget, computes a single size per call, without fallback.
+    cache = SizeCache(home, max_age=300, budget=0)
+    assert dict(db0=8192, db1=None) == \
+        cache.sizes(conn, postgres, ['db0', 'db1'])
+    assert dict(db0=8192, db1=8192) == \
+        cache.sizes(conn, postgres, ['db0', 'db1'])
+    assert 2 == conn.sizes
+    assert 0 == dbconn.sizes
+    # Size query is bounded, and previous timeout restored.
+    conn.execute.assert_any_call("SET statement_timeout = %s", (1,))
+    conn.execute.assert_called_with("SET statement_timeout = %s", ('0',))
+
+    # Fresh sizes are shared and not computed again.
+    cache = SizeCache(home, max_age=300, budget=10)
+    clock.return_value = 1200.
+    assert 2 == len(cache.sizes(conn, postgres, ['db0', 'db1']))
+    assert 2 == conn.sizes
+
+    clock.return_value = 1400.
+    conn.size = 16384
+    assert dict(db0=16384, db1=16384) == \
+        cache.sizes(conn, postgres, ['db0', 'db1'])
+    assert 4 == conn.sizes
+    conn.execute.assert_any_call("SET statement_timeout = %s", (10000,))
+
+    # Canceled size keeps previous value and is postponed. Estimation stands
+    # for unknown exact size.
+    clock.return_value = 1800.
+    conn.size = Exception("canceling statement due to statement timeout")
+    assert dict(db0=16384, db2=4096) == \
+        cache.sizes(conn, postgres, ['db0', 'db2'])
+    assert 6 == conn.sizes
+    postgres.copy.assert_called_once_with(dbname='db2')
+    clock.return_value = 1900.
+    assert dict(db0=16384, db2=4096) == \
+        cache.sizes(conn, postgres, ['db0', 'db2'])
+    assert 6 == conn.sizes
+    assert 1 == dbconn.sizes
+
+    # Unknown sizes are None.
+    dbconn.size = Exception("connection refused")
+    assert dict(db3=None) == cache.sizes(conn, postgres, ['db3'])
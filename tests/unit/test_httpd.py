@@ -0,0 +1,327 @@
+import threading
+import zlib
+from contextlib import contextmanager
+
+import pytest
+
+
+def test_negotiate_encoding():
+    from temboardagent.httpd import negotiate_encoding
+
+    assert negotiate_encoding('') is None
+    assert negotiate_encoding('identity') is None
+    assert 'gzip' == negotiate_encoding('gzip, deflate, br')
+    assert 'deflate' == negotiate_encoding('deflate')
+    assert 'deflate' == negotiate_encoding('gzip;q=0.5, deflate')
+    assert 'deflate' == negotiate_encoding('GZIP;q=0, *')
+    assert negotiate_encoding('gzip;q=0, deflate;q=0') is None
+
+
+def test_compress_chunks():
+    from temboardagent.httpd import compress_chunks
+
+    chunks = [b'{"data": [', b'1, 2, 3' * 100, b']}']
+    body = b''.join(compress_chunks(chunks, 'gzip', 6))
+    assert b''.join(chunks) == zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+    body = b''.join(compress_chunks(chunks, 'deflate', 6))
+    assert b''.join(chunks) == zlib.decompress(body)
+
+
+def test_match_etag():
+    from temboardagent.httpd import match_etag
+
+    assert match_etag(None, 'abc') is None
+    assert match_etag('"abc"', None) is None
+    assert match_etag('"def"', 'abc') is None
+    assert '"abc"' == match_etag('"def", "abc"', 'abc')
+    assert 'W/"abc"' == match_etag('W/"abc"', 'abc')
+    assert '"abc-gzip"' == match_etag('"abc-gzip"', 'abc')
+    assert '"abc"' == match_etag('*', 'abc')
+
+
+def mock_app(mocker, **options):
+    app = mocker.Mock(name='app')
+    config = app.config.temboard
+    config.keepalive_timeout = 5
+    config.keepalive_max_requests = 100
+    config.compression_min_size = 1024
+    config.compression_level = 6
+    config.http_route_concurrency = {}
+    config.http_max_body_size = 1024
+    config.http_body_timeout = 5
+    config.key = 'secret'
+    for name, value in options.items():
+        setattr(config, name, value)
+    return app
+
+
+@contextmanager
+def serve(app, workers=1, queue_size=4):
+    # Run an HTTP server in a thread, yielding its address.
+    from temboardagent.httpd import RequestHandler, ThreadedHTTPServer
+
+    httpd = ThreadedHTTPServer(
+        ('127.0.0.1', 0), lambda *a: RequestHandler(app, None, *a))
+    httpd.start_workers(
+        workers=workers, queue_size=queue_size,
+        idle_timeout=app.config.temboard.keepalive_timeout)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield httpd
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def route_to(mocker, function, concurrency=None, check_key=False):
+    # Resolve any URL to function.
+    from temboardagent.routing import make_route
+
+    route = make_route(
+        function, 'GET', b'/test', False, check_key, concurrency=concurrency)
+    mocker.patch(
+        'temboardagent.httpd.resolve_route', return_value=(route, {}))
+    return route
+
+
+def test_idle_connections_release_worker(mocker):
+    import socket
+    from http.client import HTTPConnection
+
+    with serve(mock_app(mocker)) as httpd:
+        # A silent new connection does not hold the single worker.
+        silent = socket.create_connection(httpd.server_address)
+        clients = [
+            HTTPConnection(*httpd.server_address, timeout=2)
+            for _ in range(2)
+        ]
+        # Idle persistent connections neither.
+        for client in clients + clients:
+            client.request('GET', '/unknown/route')
+            response = client.getresponse()
+            response.read()
+            assert 404 == response.status
+            assert not response.will_close
+        silent.close()
+
+
+def test_queue_full(mocker):
+    import socket
+
+    with serve(mock_app(mocker), workers=0, queue_size=1) as httpd:
+        queued, _ = socket.socketpair()
+        rejected, client = socket.socketpair()
+        httpd.dispatch(queued, ('127.0.0.1', 1))
+        httpd.dispatch(rejected, ('127.0.0.1', 2))
+        assert 1 == httpd.queue_depth()
+        client.settimeout(2)
+        assert b'' == client.recv(1)
+
+
+def limited(http_context, app):
+    return {}
+
+
+def test_route_concurrency(mocker):
+    from http.client import HTTPConnection
+
+    route = route_to(mocker, limited, concurrency=1)
+    app = mock_app(mocker)
+    with serve(app) as httpd:
+        # Simulate a request in progress.
+        semaphore = httpd.route_semaphore(route, 1)
+        semaphore.acquire()
+        client = HTTPConnection(*httpd.server_address, timeout=2)
+        client.request('GET', '/test')
+        response = client.getresponse()
+        response.read()
+        assert 503 == response.status
+        assert '1' == response.getheader('Retry-After')
+
+        # Limit is configurable, 0 disables it.
+        app.config.temboard.http_route_concurrency = {'test_httpd.limited': 0}
+        client.request('GET', '/test')
+        response = client.getresponse()
+        response.read()
+        assert 200 == response.status
+
+
+DETACHED = []
+
+
+def detached_stream(http_context, app):
+    from temboardagent.tools import Response
+
+    return Response(
+        b'hello\n', content_type='text/plain', detach=DETACHED.append)
+
+
+def test_detached_response(mocker):
+    from http.client import HTTPConnection
+
+    route_to(mocker, detached_stream)
+    with serve(mock_app(mocker)) as httpd:
+        try:
+            client = HTTPConnection(*httpd.server_address, timeout=2)
+            client.request('GET', '/stream')
+            response = client.getresponse()
+            assert 200 == response.status
+            assert response.will_close
+            assert b'hello\n' == response.readline()
+
+            # Worker is free for other requests while stream continues.
+            other = HTTPConnection(*httpd.server_address, timeout=2)
+            other.request('GET', '/stream')
+            other.getresponse().readline()
+
+            conn = DETACHED[0]
+            conn.write(b'world\n')
+            assert b'world\n' == response.readline()
+            conn.close()
+            assert b'' == response.read()
+        finally:
+            for conn in DETACHED:
+                conn.close()
+
+
+def echo(http_context, app):
+    return http_context['post']
+
+
+def raw_request(httpd, data):
+    # Send raw request data, returning response with body read.
+    import socket
+    from http.client import HTTPResponse
+
+    sock = socket.create_connection(httpd.server_address, timeout=2)
+    try:
+        sock.sendall(data)
+        response = HTTPResponse(sock)
+        response.begin()
+        response.read()
+        return response
+    finally:
+        sock.close()
+
+
+def test_read_body(mocker):
+    import json
+    from http.client import HTTPConnection
+
+    route_to(mocker, echo)
+    with serve(mock_app(mocker, http_body_timeout=.2)) as httpd:
+        client = HTTPConnection(*httpd.server_address, timeout=2)
+        client.request('POST', '/test', body=b'{"a": 1}')
+        response = client.getresponse()
+        assert 200 == response.status
+        assert dict(a=1) == json.loads(response.read())
+
+        response = raw_request(
+            httpd, b'POST /test HTTP/1.1\r\nHost: agent\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n2\r\n{}\r\n0\r\n\r\n')
+        assert 411 == response.status
+
+        response = raw_request(
+            httpd, b'POST /test HTTP/1.1\r\nHost: agent\r\n\r\n{}')
+        assert 411 == response.status
+
+        # Body is not read.
+        response = raw_request(
+            httpd, b'POST /test HTTP/1.1\r\nHost: agent\r\n'
+            b'Content-Length: 2048\r\n\r\n')
+        assert 413 == response.status
+        assert response.will_close
+
+        # Slow client.
+        response = raw_request(
+            httpd, b'POST /test HTTP/1.1\r\nHost: agent\r\n'
+            b'Content-Length: 8\r\n\r\n{"a"')
+        assert 408 == response.status
+
+
+def test_authenticate_before_body(mocker):
+    route_to(mocker, echo, check_key=True)
+    with serve(mock_app(mocker)) as httpd:
+        # Server answers without waiting for the body.
+        response = raw_request(
+            httpd, b'POST /test HTTP/1.1\r\nHost: agent\r\n'
+            b'Content-Length: 8\r\n\r\n')
+        assert 401 == response.status
+
+        response = raw_request(
+            httpd, b'POST /test HTTP/1.1\r\nHost: agent\r\n'
+            b'X-TemBoard-Agent-Key: secret\r\n'
+            b'Content-Length: 8\r\n\r\n{"a": 1}')
+        assert 200 == response.status
+
+
+def test_keepalive(mocker):
+    import socket
+    from http.client import HTTPConnection, HTTPResponse
+
+    route_to(mocker, limited)
+    with serve(mock_app(mocker, keepalive_max_requests=3)) as httpd:
+        client = HTTPConnection(*httpd.server_address, timeout=2)
+        client.request('GET', '/test')
+        response = client.getresponse()
+        response.read()
+        sock = client.sock
+        assert not response.will_close
+
+        # Connection is reused until max requests.
+        client.request('GET', '/test')
+        response = client.getresponse()
+        response.read()
+        assert sock is client.sock
+        assert not response.will_close
+
+        client.request('GET', '/test')
+        response = client.getresponse()
+        response.read()
+        assert 'close' == response.getheader('Connection')
+        assert response.will_close
+
+        # HTTP/1.0 connection is closed after response.
+        sock = socket.create_connection(httpd.server_address, timeout=2)
+        try:
+            sock.sendall(b'GET /test HTTP/1.0\r\n\r\n')
+            response = HTTPResponse(sock)
+            response.begin()
+            response.read()
+            assert 200 == response.status
+            assert b'' == sock.recv(1)
+        finally:
+            sock.close()
+
+
+def test_detached_connection_buffer():
+    import socket
+    from temboardagent.httpd import DetachedConnection
+
+    sock, client = socket.socketpair()
+    try:
+        conn = DetachedConnection(sock, ('127.0.0.1', 1), max_buffer=4096)
+        # Write to a client not reading does not block.
+        chunk = b'x' * 1024
+        sent = 0
+        while not conn.buffer:
+            conn.write(chunk)
+            sent += len(chunk)
+        # Lagging client is dropped.
+        with pytest.raises(OSError):
+            for _ in range(8):
+                sent += len(chunk)
+                conn.write(chunk)
+
+        # Buffered data is sent once client reads.
+        client.settimeout(2)
+        received = 0
+        while conn.buffer or received < sent:
+            received += len(client.recv(65536))
+            conn.flush()
+        assert sent == received
+    finally:
+        sock.close()
+        client.close()
@@ -0,0 +1,69 @@
+import os
+
+
+def test_counter():
+    from temboardagent.instrumentation import Counter, Registry
+
+    registry = Registry(size=8)
+    requests = Counter(
+        'requests_total', "Requests.", labels=('status',), registry=registry)
+    requests.inc('200')
+    requests.inc('200', amount=2)
+    requests.inc('50"0')
+
+    assert registry.exposition().splitlines() == [
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{status="200"} 3',
+        'requests_total{status="50\\"0"} 1',
+    ]
+
+
+def test_histogram():
+    from temboardagent.instrumentation import Histogram, Registry
+
+    registry = Registry(size=8)
+    duration = Histogram(
+        'duration_seconds', "Duration.", buckets=(.1, 1.), registry=registry)
+    duration.observe(.05)
+    duration.observe(.5)
+    duration.observe(2)
+
+    assert registry.exposition().splitlines()[2:] == [
+        'duration_seconds_bucket{le="0.1"} 1',
+        'duration_seconds_bucket{le="1.0"} 2',
+        'duration_seconds_bucket{le="+Inf"} 3',
+        'duration_seconds_sum 2.55',
+        'duration_seconds_count 3',
+    ]
+
+
+def test_registry_full():
+    from temboardagent.instrumentation import Gauge, Histogram, Registry
+
+    registry = Registry(size=4)
+    Histogram('h', "H.", buckets=(1.,), registry=registry).observe(1)
+    gauge = Gauge('g', "G.", labels=('i',), registry=registry)
+    gauge.set(1, 'a')
+    # Full, ignored.
+    gauge.set(2, 'b')
+    assert 'g{i="a"} 1' in registry.exposition()
+    assert 'g{i="b"}' not in registry.exposition()
+
+
+def test_shared_between_processes():
+    from temboardagent.instrumentation import Counter, Registry
+
+    registry = Registry(size=8)
+    counter = Counter('c', "C.", labels=('pid',), registry=registry)
+    counter.inc('parent')
+    pid = os.fork()
+    if 0 == pid:
+        counter.inc('child')
+        counter.inc('parent')
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    lines = registry.exposition().splitlines()
+    assert 'c{pid="parent"} 2' in lines
+    assert 'c{pid="child"} 1' in lines
@@ -0,0 +1,20 @@
+def test_last_change(mocker, tmpdir):
+    from temboardagent.notification import Notification, NotificationMgmt
+
+    config = mocker.Mock(name='config')
+    config.temboard.home = str(tmpdir)
+    NotificationMgmt.bootstrap(config)
+    assert NotificationMgmt.get_last_change(config) is None
+
+    notifications = [Notification('alice', 'Login') for _ in range(1001)]
+    for i, n in enumerate(notifications):
+        n.time = 1000. + i
+    NotificationMgmt.push_many(config, notifications)
+    last = NotificationMgmt.get_last_change(config)
+
+    # Table is full, and new notification has the same time as the last one.
+    n = Notification('alice', 'Logout')
+    n.time = 2000.
+    NotificationMgmt.push(config, n)
+    assert 1000 == len(list(NotificationMgmt.get_last_n(config, -1)))
+    assert last != NotificationMgmt.get_last_change(config)
@@ -0,0 +1,77 @@
+def test_broadcaster(mocker):
+    from queue import Queue
+    from temboardagent.sharedmemory import RingBuffer
+    from temboardagent.plugins.dashboard.stream import Broadcaster
+
+    mocker.patch(
+        'temboardagent.plugins.dashboard.stream.DashboardMetrics.'
+        'get_notifications', return_value=[])
+    app = mocker.Mock(name='app')
+    app.config.dashboard.scheduler_interval = 2
+    app.config.dashboard.stream_max_clients = 2
+    history = RingBuffer(length=4, slot_size=64)
+    history.append(1., b'{"cpu": 1}')
+
+    broadcaster = Broadcaster(history, app)
+    broadcaster.poll_interval = .01
+    assert (
+        b'retry: 2000\n\n'
+        b'data: {"cpu": 1, "notifications": []}\n\n'
+    ) == broadcaster.greeting()
+
+    received = Queue()
+    conn = mocker.Mock(name='conn')
+    conn.write.side_effect = received.put
+    gone = mocker.Mock(name='gone', client_address=('127.0.0.1', 1234))
+    gone.write.side_effect = BrokenPipeError()
+    broadcaster.subscribe(conn)
+    broadcaster.subscribe(gone)
+    assert broadcaster.full()
+
+    history.append(2., b'{"cpu": 2}')
+    event = received.get(timeout=5)
+    assert b'data: {"cpu": 2, "notifications": []}\n\n' == event
+    # Event is formatted once for all subscribers.
+    assert event is gone.write.call_args[0][0]
+
+    broadcaster.keepalive = .01
+    assert b': keepalive\n\n' == received.get(timeout=5)
+    # Disconnected subscriber is dropped.
+    assert gone.close.called
+    assert not broadcaster.full()
+
+
+def test_snapshot(mocker):
+    from temboardagent.plugins.dashboard.metrics import (
+        HITRATIO_SQL, STAT_DB_SQL, DashboardMetrics,
+    )
+
+    conn = mocker.Mock(name='conn')
+    conn.queryone.return_value = dict(
+        buffers=1024, hitratio=99., active_backends=3, max_connections=100,
+        databases=2, datnames=['db0', 'db1'], time='12:00', total_commit=50,
+        total_rollback=1, pg_uptime=3600, pg_version='PostgreSQL 14.1',
+        pg_data='/var/lib/postgresql/14/main', pg_port='5432',
+    )
+
+    size_cache = mocker.Mock(name='size_cache')
+    size_cache.sizes.return_value = dict(db0=4 << 20, db1=6 << 20)
+
+    snapshot = DashboardMetrics(conn).get_snapshot(size_cache, None)
+
+    assert 1 == conn.queryone.call_count
+    # Snapshot shares queries of single metric endpoints.
+    sql, = conn.queryone.call_args[0]
+    assert HITRATIO_SQL in sql
+    assert STAT_DB_SQL in sql
+    assert 1024 == snapshot['buffers']['nb']
+    assert 3 == snapshot['active_backends']['nb']
+    assert 2 == snapshot['databases']['databases']
+    assert '10 MB' == snapshot['databases']['total_size']
+    assert 'PostgreSQL 14.1' == snapshot['pg_version']
+    assert '5432' == snapshot['pg_port']
+
+    # No undercounted total while a database size is unknown.
+    size_cache.sizes.return_value = dict(db0=4 << 20, db1=None)
+    snapshot = DashboardMetrics(conn).get_snapshot(size_cache, None)
+    assert snapshot['databases']['total_size'] is None
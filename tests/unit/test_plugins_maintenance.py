@@ -0,0 +1,43 @@
+def test_bloat_cache(mocker, tmpdir):
+    from temboardagent.plugins.maintenance import bloat
+
+    home = str(tmpdir)
+    bloat.bootstrap(home)
+    cache = bloat.BloatCache(home, 'db0')
+    conn = mocker.Mock(name='conn')
+    conn.queryone.return_value = dict(n_mod=100, n_live=50000)
+    conn.query.side_effect = [
+        [dict(schemaname='public', tblname='t0',
+              real_size=8000., bloat_size=2000.)],
+        [dict(schemaname='public', tblname='t0', idxname='i0',
+              real_size=4000., bloat_size=1000.),
+         dict(schemaname='public', tblname='t0', idxname='i1',
+              real_size=4000., bloat_size=0.)],
+    ]
+
+    assert cache.is_stale(conn)
+    assert not cache.tables()
+    assert cache.ratio('tables') is None
+
+    cache.refresh_if_stale(conn)
+
+    assert 2 == conn.query.call_count
+    # Estimation queries are bounded.
+    conn.execute.assert_any_call(
+        "SET statement_timeout = %s", (bloat.TIMEOUT * 1000,))
+    assert {('public', 't0'): 2000.} == cache.tables()
+    assert 1000. == cache.indexes('public', 't0')['public', 't0', 'i0']
+    assert 25. == cache.ratio('tables')
+    assert 12.5 == cache.ratio('indexes')
+    # Other databases are not estimated.
+    assert not bloat.BloatCache(home, 'db1').tables()
+
+    # Few modifications don't invalidate estimation.
+    conn.queryone.return_value = dict(n_mod=1000, n_live=50000)
+    assert not cache.is_stale(conn)
+    assert cache.is_stale(conn, max_age=-1)
+    conn.queryone.return_value = dict(n_mod=6000, n_live=50000)
+    assert cache.is_stale(conn)
+    # Statistics reset.
+    conn.queryone.return_value = dict(n_mod=10, n_live=50000)
+    assert cache.is_stale(conn)
@@ -0,0 +1,180 @@
+def test_run_sql_batch(mocker):
+    from temboardagent.plugins.monitoring.probes import (
+        probe_locks, probe_tblspc_size, run_sql_batch,
+    )
+
+    probes = [probe_locks({}), probe_tblspc_size({})]
+    conn = mocker.Mock(name='conn')
+    conn.queryone.return_value = dict(
+        p0=[dict(dbname='postgres', access_share=1, waiting_access_share=0)],
+        p1=[dict(spcname='pg_default', size=16000)],
+    )
+    conninfo = dict(dbname='postgres', instance='main', port=5432)
+
+    rows = run_sql_batch(probes, conn, conninfo)
+
+    sql, = conn.queryone.call_args[0]
+    # Don't override statement_timeout of role or database.
+    assert 'statement_timeout' not in sql
+    assert not conn.execute.called
+    assert 'AS p1' in sql
+    assert [dict(
+        dbname='postgres', access_share=1, waiting_access_share=0, port=5432,
+    )] == rows[probes[0], 'postgres']
+    assert [dict(spcname='pg_default', size=16000, port=5432)] == \
+        rows[probes[1], 'postgres']
+
+    # Probe timeout is restored on long-lived connection.
+    for p in probes:
+        p.timeout = 5
+    conn.query_scalar.return_value = '1min'
+    run_sql_batch(probes, conn, conninfo)
+    assert [
+        mocker.call("SET statement_timeout = %s", (5000,)),
+        mocker.call("SET statement_timeout = %s", ('1min',)),
+    ] == conn.execute.call_args_list
+
+    # On failure, let probes run one by one.
+    conn.queryone.side_effect = Exception('boom')
+    assert {} == run_sql_batch(probes, conn, conninfo)
+
+
+def test_run_probes_timeout(mocker):
+    from contextlib import contextmanager
+    from datetime import datetime
+    from threading import Event
+    from temboardagent.plugins.monitoring.probes import SqlProbe, run_probes
+
+    canceled = Event()
+
+    class probe_slow(SqlProbe):
+        level = 'database'
+
+        def run(self, conn, conninfo):
+            if conninfo['dbname'] == 'slow':
+                # Wait for the query to be canceled.
+                assert canceled.wait(5)
+                raise Exception("canceling statement due to user request")
+            return [dict(dbname=conninfo['dbname'])]
+
+    conn = mocker.Mock(name='conn')
+    conn.query_scalar.return_value = datetime.now()
+    conn.cancel.side_effect = canceled.set
+    pool = mocker.Mock(name='pool', max_connections=None)
+    pool.get.return_value = conn
+
+    @contextmanager
+    def borrow(dbname):
+        if dbname == 'down':
+            raise Exception("connection refused")
+        yield conn
+
+    pool.borrow = borrow
+    instance = dict(
+        available=True, version_num=140000, database='postgres',
+        dbnames=[
+            dict(dbname='fast'), dict(dbname='slow'), dict(dbname='down'),
+        ],
+    )
+
+    output, completed = run_probes(
+        [probe_slow({})], pool, [instance], parallelism=3, timeout=.2)
+
+    assert canceled.is_set()
+    assert ['fast'] == [r['dbname'] for r in output['slow']]
+    # Probe is not complete, to run it again on next collect.
+    assert not completed
+
+    instance['dbnames'] = [dict(dbname='fast')]
+    output, completed = run_probes([probe_slow({})], pool, [instance])
+    assert {'slow'} == completed
+
+
+def test_delta_store(mocker, tmpdir):
+    from temboardagent.plugins.monitoring import db
+    from temboardagent.plugins.monitoring.probes import DeltaStore, probe_cpu
+
+    db.bootstrap(str(tmpdir), 'monitoring.db')
+    store = DeltaStore(str(tmpdir))
+    probe = probe_cpu({})
+    probe.set_store(store)
+
+    assert (None, None) == probe.delta('key', dict(a=1))
+    mocker.patch(
+        'temboardagent.plugins.monitoring.probes.time.time',
+        return_value=store.get('cpukey')['time'] + 10)
+    assert (10, dict(a=2)) == probe.delta('key', dict(a=3))
+    assert db.get_last_measures(str(tmpdir), 'monitoring.db') == []
+
+    store.flush()
+    assert not store.dirty
+    store = DeltaStore(str(tmpdir))
+    assert dict(a=3) == store.get('cpukey')['data']
+
+
+def test_history_cursor(tmpdir):
+    import sqlite3
+    from time import time
+    from temboardagent.plugins.monitoring import db
+
+    home = str(tmpdir)
+    now = time()
+    # Metrics table without cursor is upgraded.
+    with sqlite3.connect(str(tmpdir.join('monitoring.db'))) as conn:
+        conn.execute("CREATE TABLE metrics (time REAL PRIMARY KEY, data TEXT)")
+        conn.execute("INSERT INTO metrics VALUES (?, '0')", (now,))
+    db.bootstrap(home, 'monitoring.db')
+
+    for i in range(1, 4):
+        db.add_metric(home, 'monitoring.db', now + i, i)
+
+    assert 4 == db.get_last_cursor(home, 'monitoring.db')
+    cursor = db.get_cursor(home, 'monitoring.db', 1, limit=2)
+    assert 3 == cursor
+    assert [('1',), ('2',)] == list(
+        db.get_metrics_between(home, 'monitoring.db', 1, cursor))
+
+    assert 3 == db.ack_metrics(home, 'monitoring.db', cursor)
+    assert 4 == db.get_cursor(home, 'monitoring.db', cursor)
+    assert db.get_cursor(home, 'monitoring.db', 4) is None
+    assert 4 == db.get_last_cursor(home, 'monitoring.db')
+
+
+def test_due_probes():
+    from temboardagent.plugins.monitoring import probe_intervals
+    from temboardagent.plugins.monitoring.probes import (
+        due_probes, probe_heap_bloat, probe_loadavg, probe_xacts,
+    )
+
+    assert dict(xacts=300) == probe_intervals('xacts:300, ')
+    probes = [probe_heap_bloat({}), probe_loadavg({}), probe_xacts({})]
+    options = dict(scheduler_interval=60, probe_intervals=dict(xacts=300))
+
+    assert probes == due_probes(probes, options, {}, 1000)
+    history = dict(heap_bloat=1000, loadavg=1000, xacts=1000)
+    # Scheduler may wake up a bit early.
+    due = due_probes(probes, options, history, 1059)
+    assert ['loadavg'] == [p.get_name() for p in due]
+    due = due_probes(probes, options, history, 4599)
+    assert ['heap_bloat', 'loadavg', 'xacts'] == [p.get_name() for p in due]
+
+
+def test_bloat_probe(mocker):
+    from temboardagent.plugins.monitoring.probes import probe_heap_bloat
+
+    cache = mocker.patch(
+        'temboardagent.plugins.monitoring.probes.BloatCache').return_value
+    cache.ratio.return_value = 25.
+    options = dict(scheduler_interval=60, probe_intervals={})
+    probe = probe_heap_bloat(options)
+    probe.set_store(mocker.Mock(name='store'))
+    conninfo = dict(dbname='db0', instance='main', port=5432)
+
+    rows = probe.run(mocker.Mock(name='conn'), conninfo)
+    assert 25. == rows[0]['ratio']
+    # Estimation is refreshed before next run of probe, even if early.
+    assert 3540 == cache.refresh_if_stale.call_args[0][1]
+
+    options['probe_intervals'] = dict(heap_bloat=600)
+    probe.run(mocker.Mock(name='conn'), conninfo)
+    assert 540 == cache.refresh_if_stale.call_args[0][1]
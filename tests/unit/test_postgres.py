@@ -1,3 +1,6 @@
+import pytest
+
+
 def test_postgres_connect(mocker):
     mocker.patch('temboardagent.postgres.connect', autospec=True)
 
@@ -33,3 +36,134 @@ def test_pickle():
     orig = Postgres(host='myhost')
     copy = unpickle(pickle(orig))
     assert 'myhost' == copy.host
+
+
+def test_pool(mocker):
+    c = mocker.patch('temboardagent.postgres.connect', autospec=True)
+    c.side_effect = lambda **kw: mocker.Mock(
+        name='conn-%s' % c.call_count, closed=False, autocommit=True)
+
+    from psycopg2 import OperationalError
+    from temboardagent.postgres import Pool, Postgres
+
+    pool = Pool(max_size=2)
+    postgres = Postgres(host='myhost', pool=pool)
+
+    with postgres.connect() as conn0:
+        pass
+    assert conn0.close.called is False
+    conn0.execute.assert_called_with("DISCARD ALL")
+
+    # Idle connection is reused.
+    with postgres.connect() as conn1:
+        assert conn1 is conn0
+        # Other database, other connection.
+        with postgres.copy(dbname='other').connect() as conn2:
+            assert conn2 is not conn0
+    assert 2 == c.call_count
+
+    # Broken connection is discarded.
+    try:
+        with postgres.connect() as conn3:
+            raise OperationalError()
+    except OperationalError:
+        pass
+    assert conn3.close.called is True
+
+    with postgres.connect() as conn4:
+        assert conn4 is not conn3
+    assert 3 == c.call_count
+
+    # Old connections are not reused.
+    conn4.created_at -= 7200
+    with postgres.connect():
+        pass
+    assert conn4.close.called is True
+
+    pool.close()
+    assert 0 == sum(pool.opened.values())
+
+
+def test_pool_timeout(mocker):
+    mocker.patch('temboardagent.postgres.connect', autospec=True)
+
+    from temboardagent.errors import UserError
+    from temboardagent.postgres import Pool, Postgres
+
+    pool = Pool(max_size=1, timeout=0)
+    postgres = Postgres(host='myhost', pool=pool)
+    with postgres.connect():
+        with pytest.raises(UserError):
+            with postgres.connect():
+                pass
+
+
+def test_pool_max_total(mocker):
+    c = mocker.patch('temboardagent.postgres.connect', autospec=True)
+    c.side_effect = lambda **kw: mocker.Mock(
+        name=kw['database'], closed=False, autocommit=True)
+
+    from temboardagent.errors import UserError
+    from temboardagent.postgres import Pool, Postgres
+
+    pool = Pool(max_size=2, max_total=2, timeout=0)
+    postgres = Postgres(host='myhost', pool=pool)
+
+    with postgres.copy(dbname='db0').connect() as conn0:
+        pass
+    with postgres.copy(dbname='db1').connect() as conn1:
+        pass
+    conn0.last_used -= 10
+
+    # Least recently used idle connection is closed.
+    with postgres.copy(dbname='db2').connect():
+        assert conn0.close.called is True
+        assert conn1.close.called is False
+        with postgres.copy(dbname='db1').connect():
+            # No idle connection to close.
+            with pytest.raises(UserError):
+                with postgres.copy(dbname='db3').connect():
+                    pass
+    assert 2 == sum(pool.opened.values())
+
+
+def test_connection_pool_lru(mocker):
+    c = mocker.patch('temboardagent.postgres.connect', autospec=True)
+    c.side_effect = lambda **kw: mocker.Mock(
+        name=kw['database'], closed=False, server_version=140000)
+
+    from temboardagent.postgres import ConnectionPool
+
+    pool = ConnectionPool(max_connections=2, host='myhost', database='db0')
+
+    conn0 = pool.get()
+    assert conn0 is pool.get(dbname='db0')
+    conn1 = pool.get(dbname='db1')
+    # db0 is now more recently used than db1.
+    pool.get()
+    assert 2 == c.call_count
+
+    # Least recently used connection is closed at cap.
+    conn2 = pool.get(dbname='db2')
+    assert conn1.close.called is True
+    assert conn0.close.called is False
+    assert ['db0', 'db2'] == list(pool.pool)
+
+    conn0.last_used -= 120
+    pool.evict_idle(60)
+    assert conn0.close.called is True
+    assert ['db2'] == list(pool.pool)
+
+    pool.close()
+    assert conn2.close.called is True
+    assert not pool.pool
+
+    # Without cap, a connection is kept for each database.
+    pool = ConnectionPool(host='myhost', database='db0')
+    for i in range(20):
+        pool.get(dbname='db%d' % i)
+    for i in range(20):
+        pool.get(dbname='db%d' % i)
+    assert 20 == len(pool.pool)
+    # Second run reuses connections.
+    assert 23 == c.call_count
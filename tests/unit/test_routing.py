@@ -30,3 +30,62 @@ def test_make_route():
     assert r['splitpath'][1].match('bar')
     assert not r['splitpath'][1].match('dude')
     assert r['splitpath'][2].match('4nyth1ng')
+
+
+def test_route_index():
+    from temboardagent.routing import RouteIndex, make_route
+
+    def f():
+        pass
+
+    def g():
+        pass
+
+    T_NAME = b'(^[a-z]{1,100}$)'
+    routes = [
+        make_route(f, 'GET', b'/foo', True, True),
+        make_route(f, 'GET', b'/foo/' + T_NAME + b'/bar', True, True),
+        make_route(g, 'GET', b'/foo/toto/bar', True, True),
+        make_route(g, 'POST', b'/foo/' + T_NAME, True, True),
+    ]
+    index = RouteIndex(routes)
+
+    route, urlvars = index.resolve('GET', b'/foo')
+    assert route is routes[0]
+    assert [] == urlvars
+
+    # First registered route wins, like a linear scan.
+    route, urlvars = index.resolve('GET', b'/foo/toto/bar')
+    assert route is routes[1]
+    assert ['toto'] == urlvars
+
+    route, urlvars = index.resolve('POST', b'/foo/toto')
+    assert route is routes[3]
+    assert ['toto'] == urlvars
+
+    assert (None, None) == index.resolve('GET', b'/foo/toto')
+    assert (None, None) == index.resolve('GET', b'/foo/')
+    assert (None, None) == index.resolve('GET', b'/foo/0/bar')
+    assert (None, None) == index.resolve('DELETE', b'/foo')
+    assert (None, None) == index.resolve('GET', b'/bar')
+
+
+def test_router_index(mocker):
+    from temboardagent import routing
+
+    mocker.patch('temboardagent.routing.ROUTES', [])
+    mocker.patch('temboardagent.routing.INDEX', routing.RouteIndex())
+
+    def f():
+        pass
+
+    routes = routing.RouteSet(prefix=b'/foo')
+    routes.get(b'/bar')(f)
+    router = routing.Router()
+
+    router.add(routes)
+    route, _ = routing.resolve_route('GET', b'/foo/bar')
+    assert route is routes[0]
+
+    router.remove(routes)
+    assert (None, None) == routing.resolve_route('GET', b'/foo/bar')
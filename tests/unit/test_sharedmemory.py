@@ -0,0 +1,116 @@
+import time
+
+import pytest
+
+
+def test_sessions_pop_expired():
+    from temboardagent.sharedmemory import Session, Sessions
+
+    sessions = Sessions(size=4)
+    assert ([], None) == sessions.pop_expired(ttl=60)
+
+    now = time.time()
+    sessions.add(Session(b'a' * 64, now - 120, b'alice'))
+    sessions.add(Session(b'b' * 64, now - 90, b'bob'))
+    sessions.add(Session(b'c' * 64, now - 30, b'carol'))
+    assert sessions.added.is_set()
+
+    # Refreshed session is rescheduled.
+    session = sessions.get_by_sessionid(b'b' * 64)
+    session.time = now
+    sessions.update(session)
+    # Deleted session is ignored.
+    sessions.delete(b'c' * 64)
+
+    expired, next_expiry = sessions.pop_expired(ttl=60)
+    assert [b'alice'] == [s.username for s in expired]
+    # Stale entry of deleted session remains until popped.
+    assert now + 30 == next_expiry
+    assert sessions.get_by_username(b'alice') is None
+    assert sessions.get_by_username(b'bob')
+
+
+def test_sessions_index():
+    from temboardagent.errors import SharedItem_exists, SharedItem_not_found
+    from temboardagent.sharedmemory import Session, Sessions
+
+    sessions = Sessions(size=2)
+    for i in range(50):
+        sessions.add(Session(b'%064d' % i, i, b'user%d' % i))
+    # Grown.
+    assert 64 == sessions.size
+    assert b'user7' == sessions.get_by_sessionid(b'%064d' % 7).username
+    assert 42 == sessions.get_by_username(b'user42').time
+
+    with pytest.raises(SharedItem_exists):
+        sessions.add(Session(b'%064d' % 3, 0, b'other'))
+
+    # Deletion moves last session in the hole.
+    for i in range(0, 50, 2):
+        sessions.delete(b'%064d' % i)
+    assert 25 == sessions.count
+    with pytest.raises(SharedItem_not_found):
+        sessions.get_by_sessionid(b'%064d' % 2)
+    for i in range(1, 50, 2):
+        assert i == sessions.get_by_username(b'user%d' % i).time
+
+    # Login again replaces session of same user.
+    sessions.add(Session(b'x' * 64, 100, b'user1'))
+    assert 25 == sessions.count
+    with pytest.raises(SharedItem_not_found):
+        sessions.get_by_sessionid(b'%064d' % 1)
+
+    session = sessions.touch(b'x' * 64)
+    assert session.time > 100
+    assert session.time == sessions.get_by_username(b'user1').time
+
+
+def test_ring_buffer():
+    import os
+    from temboardagent.errors import SharedItem_bad_type_size
+    from temboardagent.sharedmemory import RingBuffer
+
+    ring = RingBuffer(length=3, slot_size=8)
+    assert [] == ring.read()
+    assert ring.last() is None
+
+    ring.append(1., b'one')
+    assert [(1., b'one')] == ring.read()
+
+    pid = os.fork()
+    if 0 == pid:  # pragma: no cover
+        for i in range(2, 6):
+            ring.append(float(i), b'%d' % i)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    # Samples written by child are visible, oldest are overwritten.
+    assert [(3., b'3'), (4., b'4'), (5., b'5')] == ring.read()
+    assert [(5., b'5')] == ring.read(since=4.)
+    assert (5., b'5') == ring.last()
+
+    with pytest.raises(SharedItem_bad_type_size):
+        ring.append(6., b'too long sample')
+
+
+def test_cpu_sampler():
+    from temboardagent.sharedmemory import CPUSampler
+
+    sampler = CPUSampler(min_interval=1.)
+    stat = dict(
+        time_user=100, time_system=100, time_idle=800, time_iowait=0,
+        time_steal=0,
+    )
+    # Usage since boot.
+    usage = sampler.usage(1000., stat)
+    assert 10. == usage['user']
+    assert 80. == usage['idle']
+
+    stat.update(time_user=150, time_idle=850)
+    # Too close, previous usage.
+    assert usage == sampler.usage(1000.5, stat)
+
+    usage = sampler.usage(1001., stat)
+    assert 50. == usage['user']
+    assert 50. == usage['idle']
+    assert 0. == usage['system']
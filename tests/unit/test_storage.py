@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+
+def test_transaction(tmpdir):
+    from temboardagent import storage
+
+    path = str(tmpdir.join('test.db'))
+    with storage.transaction(path) as conn:
+        conn.execute("CREATE TABLE t (i INTEGER)")
+
+    assert conn is storage.connect(path)
+    assert 'wal' == conn.execute("PRAGMA journal_mode").fetchone()[0]
+
+    with storage.transaction(path):
+        conn.execute("INSERT INTO t VALUES (1)")
+        # Nested transaction joins the outer one.
+        with storage.transaction(path):
+            conn.execute("INSERT INTO t VALUES (2)")
+        assert conn.in_transaction
+
+    with pytest.raises(Exception):
+        with storage.transaction(path):
+            conn.execute("INSERT INTO t VALUES (3)")
+            raise Exception("Rollback")
+
+    assert [(1,), (2,)] == conn.execute("SELECT i FROM t").fetchall()
+
+
+def test_fork(tmpdir):
+    from temboardagent import storage
+
+    path = str(tmpdir.join('test.db'))
+    conn = storage.connect(path)
+    pid = os.fork()
+    if 0 == pid:
+        # Child opens its own connection.
+        os._exit(0 if storage.connect(path) is not conn else 1)
+    _, status = os.waitpid(pid, 0)
+    assert 0 == status
@@ -0,0 +1,52 @@
+import json
+from datetime import datetime
+
+
+def test_iterencode_json():
+    from temboardagent.tools import iterencode_json
+
+    def rows():
+        yield dict(id=1, at=datetime(2020, 1, 1))
+        yield dict(id=2, tags=['a', 'b'])
+
+    obj = dict(
+        data=rows(),
+        nested=[dict(values=iter(range(3))), (1, 2)],
+        empty=iter([]),
+        scalar=None,
+    )
+    obj[1] = 'int key'
+    out = ''.join(iterencode_json(obj))
+    assert json.loads(out) == {
+        'data': [
+            {'id': 1, 'at': '2020-01-01T00:00:00'},
+            {'id': 2, 'tags': ['a', 'b']},
+        ],
+        'nested': [{'values': [0, 1, 2]}, [1, 2]],
+        'empty': [],
+        'scalar': None,
+        '1': 'int key',
+    }
+
+    assert '"a"' == ''.join(iterencode_json('a'))
+    assert [] == json.loads(''.join(iterencode_json(iter(()))))
+
+
+def test_iterencode_raw_json():
+    from temboardagent.tools import RawJSON, iterencode_json
+
+    docs = iter([RawJSON('{"a": 1}'), RawJSON('[]')])
+    out = ''.join(iterencode_json(dict(docs=docs, raw=[RawJSON('null')])))
+    assert '{"docs": [{"a": 1}, []], "raw": [null]}' == out
+
+
+def test_size_pretty():
+    from temboardagent.tools import size_pretty
+
+    assert size_pretty(None) is None
+    assert '10239 bytes' == size_pretty(10239)
+    assert '10 kB' == size_pretty(10240)
+    assert '121 kB' == size_pretty(123456.4)
+    assert '20 MB' == size_pretty(20 * 1024 * 1024)
+    assert '3072 GB' == size_pretty(3 * 1024 ** 4)
+    assert '909 TB' == size_pretty(10 ** 15)